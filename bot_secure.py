@@ -6,24 +6,34 @@ import asyncio
 import re
 import hmac
 import hashlib
+import queue
+import threading
+import time
+import uuid
 import xml.etree.ElementTree as ET
-from datetime import datetime, timedelta, timezone
+from collections import defaultdict
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from functools import lru_cache, wraps
+from itertools import islice
+from datetime import date, datetime, timedelta, timezone
 from urllib.parse import quote, quote_plus
-from typing import Optional, Any
+from typing import Optional, Any, Awaitable, Callable, Iterator, NamedTuple
 
 import aiohttp
 from zoneinfo import ZoneInfo
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
+from telegram.error import RetryAfter
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes, JobQueue
 import anthropic
 
 # ML imports (for prediction learning)
 try:
     import numpy as np
-    from sklearn.ensemble import RandomForestClassifier, GradientBoostingClassifier
+    from sklearn.ensemble import RandomForestClassifier, HistGradientBoostingClassifier
     from sklearn.model_selection import train_test_split
     from sklearn.metrics import accuracy_score
     import joblib
+    from threadpoolctl import threadpool_limits
     ML_AVAILABLE = True
 except ImportError:
     ML_AVAILABLE = False
@@ -53,8 +63,13 @@ async def get_http_session() -> aiohttp.ClientSession:
     """Get or create global aiohttp session"""
     global _http_session
     if _http_session is None or _http_session.closed:
-        timeout = aiohttp.ClientTimeout(total=HTTP_TIMEOUT)
-        _http_session = aiohttp.ClientSession(timeout=timeout)
+        timeout = aiohttp.ClientTimeout(total=HTTP_TIMEOUT, connect=5)
+        # Keep idle TLS connections around between job runs / analyses so
+        # follow-up requests skip the handshake
+        connector = aiohttp.TCPConnector(limit=100, limit_per_host=20, keepalive_timeout=75,
+                                         enable_cleanup_closed=True, use_dns_cache=True, ttl_dns_cache=300)
+        _http_session = aiohttp.ClientSession(timeout=timeout, connector=connector,
+                                              headers={"User-Agent": "betting-bot/1.0"})
     return _http_session
 
 async def close_http_session() -> None:
@@ -64,6 +79,153 @@ async def close_http_session() -> None:
         await _http_session.close()
         _http_session = None
 
+# Token bucket for football-data.org (Standard plan: 60 req/min) - 1 token/s, burst 10
+FOOTBALL_API_RATE = 1.0
+FOOTBALL_API_BURST = 10
+_api_bucket = {"tokens": float(FOOTBALL_API_BURST), "updated": time.monotonic()}
+_api_bucket_lock = asyncio.Lock()
+
+
+async def _take_bucket_token(bucket: dict, lock: asyncio.Lock, rate: float, burst: float) -> None:
+    """Wait for one token from a {"tokens", "updated"} bucket refilled at rate/s up to burst."""
+    async with lock:
+        while True:
+            now = time.monotonic()
+            bucket["tokens"] = min(burst, bucket["tokens"] + (now - bucket["updated"]) * rate)
+            bucket["updated"] = now
+            if bucket["tokens"] >= 1:
+                bucket["tokens"] -= 1
+                return
+            await asyncio.sleep((1 - bucket["tokens"]) / rate)
+
+
+async def acquire_api_token() -> None:
+    """Wait until the football-data rate budget allows another request."""
+    await _take_bucket_token(_api_bucket, _api_bucket_lock, FOOTBALL_API_RATE, FOOTBALL_API_BURST)
+
+
+# AIMD concurrency limit for football-data.org: halved on 429/5xx, +1 after
+# FOOTBALL_API_AIMD_STEP successes in a row (up to FOOTBALL_API_MAX_CONCURRENCY)
+FOOTBALL_API_MAX_CONCURRENCY = 8
+FOOTBALL_API_AIMD_STEP = 5
+_api_limiter = {"limit": FOOTBALL_API_MAX_CONCURRENCY, "in_flight": 0, "successes": 0}
+_api_limiter_cond = asyncio.Condition()
+
+
+def _record_api_status(status: int) -> None:
+    """Adjust the AIMD limit from a response status (caller holds _api_limiter_cond)."""
+    if status == 429 or status >= 500:
+        _api_limiter["limit"] = max(1, _api_limiter["limit"] // 2)
+        _api_limiter["successes"] = 0
+        logger.warning(f"Football API {status}: concurrency limit -> {_api_limiter['limit']}")
+    else:
+        _api_limiter["successes"] += 1
+        if (_api_limiter["successes"] >= FOOTBALL_API_AIMD_STEP and
+                _api_limiter["limit"] < FOOTBALL_API_MAX_CONCURRENCY):
+            _api_limiter["limit"] += 1
+            _api_limiter["successes"] = 0
+
+
+@asynccontextmanager
+async def football_api_get(session: aiohttp.ClientSession, url: str, **kwargs):
+    """session.get() for football-data.org behind the rate bucket and AIMD limiter."""
+    async with _api_limiter_cond:
+        await _api_limiter_cond.wait_for(lambda: _api_limiter["in_flight"] < _api_limiter["limit"])
+        _api_limiter["in_flight"] += 1
+    status = None
+    try:
+        await acquire_api_token()
+        async with session.get(url, **kwargs) as r:
+            status = r.status
+            yield r
+    finally:
+        async with _api_limiter_cond:
+            _api_limiter["in_flight"] -= 1
+            if status is not None:
+                _record_api_status(status)
+            _api_limiter_cond.notify_all()
+
+
+def async_ttl_cache(ttl_seconds: int, maxsize: int = 1024):
+    """Cache non-None results of a coroutine function per arguments for ttl_seconds.
+
+    Concurrent callers with the same arguments share one in-flight call.
+    Expired entries are evicted lazily; beyond maxsize the least recently
+    used entry goes first.
+    """
+    def decorator(func):
+        cache: dict = {}  # key -> (expires_at, value)
+        in_flight: dict = {}  # key -> Task
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            key = (args, tuple(sorted(kwargs.items())))
+            entry = cache.pop(key, None)
+            if entry and entry[0] > time.monotonic():
+                cache[key] = entry  # re-insert as most recently used
+                return entry[1]
+
+            task = in_flight.get(key)
+            if task is None:
+                task = asyncio.ensure_future(func(*args, **kwargs))
+                in_flight[key] = task
+
+                def store(t, key=key):
+                    in_flight.pop(key, None)
+                    if t.cancelled() or t.exception() is not None or t.result() is None:
+                        return
+                    if len(cache) >= maxsize:
+                        now = time.monotonic()
+                        for k in [k for k, (expires_at, _) in cache.items() if expires_at <= now]:
+                            del cache[k]
+                        while len(cache) >= maxsize:
+                            del cache[next(iter(cache))]
+                    cache[key] = (time.monotonic() + ttl_seconds, t.result())
+
+                task.add_done_callback(store)
+            return await asyncio.shield(task)
+
+        wrapper.cache = cache
+        return wrapper
+    return decorator
+
+
+# Per-user handler locks: user_id -> [Lock, handlers holding or waiting for it, owner task]
+_user_locks: dict = {}
+
+
+def per_user_lock(func):
+    """Serialize a handler per user: one user's requests run in order,
+    different users run concurrently. Locks are dropped once idle.
+
+    Reentrant per task, so a locked handler may dispatch to another locked
+    handler for the same user (handle_message -> recommend_cmd).
+    """
+    @wraps(func)
+    async def wrapper(update, context, *args, **kwargs):
+        if update.effective_user is None:
+            return await func(update, context, *args, **kwargs)
+        uid = update.effective_user.id
+        entry = _user_locks.get(uid)
+        if entry is not None and entry[2] is asyncio.current_task():
+            return await func(update, context, *args, **kwargs)
+        if entry is None:
+            entry = _user_locks[uid] = [asyncio.Lock(), 0, None]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                entry[2] = asyncio.current_task()
+                try:
+                    return await func(update, context, *args, **kwargs)
+                finally:
+                    entry[2] = None
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                _user_locks.pop(uid, None)
+    return wrapper
+
+
 # Live mode subscribers
 live_subscribers = set()
 inplay_subscribers = set()
@@ -118,10 +280,15 @@ TOP_CLUBS = [
 # Cup competitions (higher upset risk)
 CUP_KEYWORDS = ["Cup", "Copa", "Coupe", "Pokal", "Coppa", "EFL", "FA Cup"]
 
+# Lookup forms prepared once: club names lowered (matched case-insensitively),
+# cup keywords kept case-sensitive as before
+_TOP_CLUBS_LOWER = tuple(club.lower() for club in TOP_CLUBS)
+_CUP_KEYWORDS = tuple(CUP_KEYWORDS)
+
 def is_cup_match(match: dict) -> bool:
     """Check if match is a cup competition"""
     competition = match.get("competition", {}).get("name") or ""
-    return any(kw in competition for kw in CUP_KEYWORDS)
+    return any(kw in competition for kw in _CUP_KEYWORDS)
 
 def filter_cup_matches(matches: list, exclude: bool = False) -> list:
     """Filter matches - if exclude=True, remove cup matches"""
@@ -1152,8 +1319,9 @@ def get_text(key, lang="ru"):
         return TRANSLATIONS[lang][key]
     return TRANSLATIONS["ru"].get(key, key)
 
+@lru_cache(maxsize=16)
 def get_main_keyboard(lang="ru"):
-    """Get main reply keyboard - always visible at bottom"""
+    """Get main reply keyboard - always visible at bottom (one immutable markup per language)"""
     keyboard = [
         [KeyboardButton(get_text("top_bets", lang)), KeyboardButton(get_text("matches", lang))],
         [KeyboardButton(get_text("stats", lang)), KeyboardButton(get_text("favorites", lang))],
@@ -1235,6 +1403,24 @@ LANGUAGE_NAMES = {
     "id": "🇮🇩 Indonesia",
 }
 
+# Reply-language instruction prepended to Claude prompts
+LANG_INSTRUCTIONS = {
+    "ru": "Отвечай на русском языке.",
+    "en": "Respond in English.",
+    "pt": "Responda em português.",
+    "es": "Responde en español.",
+    "id": "Jawab dalam Bahasa Indonesia."
+}
+
+# Localized settings labels (settings_cmd)
+SETTINGS_LABELS = {
+    "ru": {"title": "⚙️ **НАСТРОЙКИ**", "min": "Мин. коэфф", "max": "Макс. коэфф", "risk": "Риск", "tz": "Часовой пояс", "premium": "Премиум", "yes": "Да", "no": "Нет", "tap_to_change": "Нажми на параметр чтобы изменить:", "exclude_cups": "Исключить кубки"},
+    "en": {"title": "⚙️ **SETTINGS**", "min": "Min odds", "max": "Max odds", "risk": "Risk", "tz": "Timezone", "premium": "Premium", "yes": "Yes", "no": "No", "tap_to_change": "Tap to change:", "exclude_cups": "Exclude cups"},
+    "pt": {"title": "⚙️ **CONFIGURAÇÕES**", "min": "Odds mín", "max": "Odds máx", "risk": "Risco", "tz": "Fuso horário", "premium": "Premium", "yes": "Sim", "no": "Não", "tap_to_change": "Toque para alterar:", "exclude_cups": "Excluir copas"},
+    "es": {"title": "⚙️ **AJUSTES**", "min": "Cuota mín", "max": "Cuota máx", "risk": "Riesgo", "tz": "Zona horaria", "premium": "Premium", "yes": "Sí", "no": "No", "tap_to_change": "Toca para cambiar:", "exclude_cups": "Excluir copas"},
+    "id": {"title": "⚙️ **PENGATURAN**", "min": "Odds min", "max": "Odds maks", "risk": "Risiko", "tz": "Zona waktu", "premium": "Premium", "yes": "Ya", "no": "Tidak", "tap_to_change": "Ketuk untuk mengubah:", "exclude_cups": "Kecualikan piala"},
+}
+
 
 def detect_timezone(user) -> str:
     """Detect timezone from Telegram language_code"""
@@ -1278,6 +1464,15 @@ TIMEZONES = {
     "new_york": ("America/New_York", "🇺🇸 Нью-Йорк (EST)"),
 }
 
+# Characters legacy Telegram Markdown treats as entity markers
+_MD_SPECIALS = re.compile(r"([_*`\[])")
+
+
+def md_escape(value) -> str:
+    """Escape user/team supplied text for parse_mode="Markdown" messages."""
+    return _MD_SPECIALS.sub(r"\\\1", str(value))
+
+
 def convert_utc_to_user_tz(utc_time_str, user_tz="Europe/Moscow"):
     """Convert UTC time string to user's timezone"""
     try:
@@ -1373,6 +1568,79 @@ def get_db_connection(timeout: int = 30):
     return conn
 
 
+_write_conn: Optional[sqlite3.Connection] = None
+_write_lock = threading.RLock()
+
+
+@contextmanager
+def write_cursor():
+    """Cursor on the shared writer connection, serialized by a lock.
+
+    Commits on success and rolls back on error. Avoids per-call connection
+    setup for small, frequent writes.
+    """
+    global _write_conn
+    with _write_lock:
+        if _write_conn is None:
+            _write_conn = sqlite3.connect(DB_PATH, timeout=30, check_same_thread=False)
+            _write_conn.execute("PRAGMA journal_mode=WAL")
+            _write_conn.execute("PRAGMA synchronous=NORMAL")  # Safe with WAL, fsync only at checkpoint
+            _write_conn.execute("PRAGMA busy_timeout=30000")
+            _write_conn.execute("PRAGMA temp_store=MEMORY")
+            _write_conn.execute("PRAGMA mmap_size=268435456")  # 256MB memory-mapped reads
+        try:
+            yield _write_conn.cursor()
+            _write_conn.commit()
+        except Exception:
+            _write_conn.rollback()
+            raise
+
+
+_RO_POOL_SIZE = 4
+_ro_pool: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+_ro_pool_created = 0
+_ro_pool_lock = threading.Lock()
+
+
+def _open_ro_connection() -> sqlite3.Connection:
+    """Open a read-only connection (WAL readers never block the writer)."""
+    conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True, timeout=30, check_same_thread=False)
+    conn.execute("PRAGMA busy_timeout=30000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    return conn
+
+
+@contextmanager
+def ro_cursor():
+    """Borrow a cursor from the read-only connection pool.
+
+    Use for pure SELECT helpers so reads run concurrently with writes
+    instead of competing for the writer lock.
+    """
+    global _ro_pool_created
+    try:
+        conn = _ro_pool.get_nowait()
+    except queue.Empty:
+        with _ro_pool_lock:
+            can_open = _ro_pool_created < _RO_POOL_SIZE
+            if can_open:
+                _ro_pool_created += 1
+        if can_open:
+            try:
+                conn = _open_ro_connection()
+            except Exception:
+                with _ro_pool_lock:
+                    _ro_pool_created -= 1
+                raise
+        else:
+            conn = _ro_pool.get()
+    try:
+        yield conn.cursor()
+    finally:
+        _ro_pool.put(conn)
+
+
 def init_db():
     """Initialize SQLite database"""
     conn = get_db_connection()
@@ -1431,6 +1699,19 @@ def init_db():
         FOREIGN KEY (user_id) REFERENCES users(user_id)
     )''')
 
+    # Admin broadcasts - progress is checkpointed so a restart resumes instead of resending
+    c.execute('''CREATE TABLE IF NOT EXISTS broadcasts (
+        id TEXT PRIMARY KEY,
+        message TEXT NOT NULL,
+        admin_chat_id INTEGER,
+        last_sent_user_id INTEGER DEFAULT -1,
+        sent INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        status TEXT DEFAULT 'running',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        finished_at TIMESTAMP
+    )''')
+
     # Live alert subscribers (persistent storage)
     c.execute('''CREATE TABLE IF NOT EXISTS live_subscribers (
         user_id INTEGER PRIMARY KEY,
@@ -1886,6 +2167,13 @@ def migrate_database():
     except Exception as e:
         logger.warning(f"Could not clean favorite_leagues duplicates: {e}")
 
+    # Enforce uniqueness so duplicate favorites can't accumulate again
+    try:
+        c.execute("CREATE UNIQUE INDEX IF NOT EXISTS uq_favorite_teams ON favorite_teams(user_id, team_name)")
+        c.execute("CREATE UNIQUE INDEX IF NOT EXISTS uq_favorite_leagues ON favorite_leagues(user_id, league_code)")
+    except Exception as e:
+        logger.warning(f"Could not create favorites unique indexes: {e}")
+
     # Add match_time column to predictions for smart result checking
     try:
         c.execute("ALTER TABLE predictions ADD COLUMN match_time TEXT")
@@ -1893,18 +2181,55 @@ def migrate_database():
     except sqlite3.OperationalError:
         pass  # Column already exists
 
+    # Premium expiry as epoch seconds (INTEGER) - replaces ISO text premium_expires
+    try:
+        c.execute("ALTER TABLE users ADD COLUMN premium_expires_ts INTEGER")
+        logger.info("Added premium_expires_ts column to users")
+    except sqlite3.OperationalError:
+        pass  # Column already exists
+
+    # Backfill epoch expiry from legacy ISO strings (stored in local time)
+    try:
+        c.execute("""
+            UPDATE users
+            SET premium_expires_ts = CAST(strftime('%s', premium_expires, 'utc') AS INTEGER)
+            WHERE premium_expires_ts IS NULL AND premium_expires IS NOT NULL
+        """)
+        if c.rowcount > 0:
+            logger.info(f"Backfilled premium_expires_ts for {c.rowcount} users")
+    except Exception as e:
+        logger.warning(f"Could not backfill premium_expires_ts: {e}")
+
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_premium_expires ON users(is_premium, premium_expires_ts)")
+
+    # Packed float32 ML feature vector (ML_FEATURE_NAMES order)
+    try:
+        c.execute("ALTER TABLE ml_training_data ADD COLUMN features_blob BLOB")
+        logger.info("Added features_blob column to ml_training_data")
+    except sqlite3.OperationalError:
+        pass  # Column already exists
+
+    # Covering index for per-user stats aggregation (get_user_stats)
+    c.execute("CREATE INDEX IF NOT EXISTS ix_pred_user_cat ON predictions(user_id, bet_category, is_correct, bet_rank)")
+
+    # /history: newest-first per user, optionally filtered by result (no temp sort)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_pred_user_correct_date ON predictions(user_id, is_correct, predicted_at DESC)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_pred_user_date ON predictions(user_id, predicted_at DESC)")
+
+    # Covering partial index for global accuracy aggregation (get_bot_accuracy_stats)
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_predictions_agg
+                 ON predictions(is_correct, bet_category, confidence) WHERE is_correct IS NOT NULL""")
+
     conn.commit()
     conn.close()
 
 
 def get_user(user_id):
     """Get user settings"""
-    conn = get_db_connection()
-    conn.row_factory = sqlite3.Row  # Read by column names
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-    row = c.fetchone()
-    conn.close()
+    with ro_cursor() as c:
+        c.row_factory = sqlite3.Row  # Read by column names
+        c.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
+        row = c.fetchone()
     
     if row:
         # Convert to dict for safe access
@@ -1920,10 +2245,42 @@ def get_user(user_id):
             "daily_requests": data.get("daily_requests", 0),
             "last_request_date": data.get("last_request_date"),
             "timezone": data.get("timezone", "Europe/Moscow"),
-            "exclude_cups": data.get("exclude_cups", 0)
+            "exclude_cups": data.get("exclude_cups", 0),
+            "premium_expires_ts": data.get("premium_expires_ts")
         }
     return None
 
+
+# get_user() results for handlers that only need language/timezone/settings.
+# Limit checks keep calling get_user() directly; writers call invalidate_user_cache().
+USER_CACHE_TTL = 60
+USER_CACHE_MAX = 10_000
+_user_cache: dict = {}  # user_id -> (expires_at, user dict)
+
+
+def get_user_cached(user_id):
+    """get_user() behind a short per-user TTL cache. Returns a copy; misses are not cached."""
+    entry = _user_cache.pop(user_id, None)
+    if entry and entry[0] > time.monotonic():
+        _user_cache[user_id] = entry  # re-insert as most recently used
+        return dict(entry[1])
+
+    user = get_user(user_id)
+    if user is None:
+        return None
+    if len(_user_cache) >= USER_CACHE_MAX:
+        _user_cache.pop(next(iter(_user_cache)))
+    _user_cache[user_id] = (time.monotonic() + USER_CACHE_TTL, user)
+    return dict(user)
+
+
+def invalidate_user_cache(user_id=None) -> None:
+    """Drop one user's cached row, or every entry when user_id is None."""
+    if user_id is None:
+        _user_cache.clear()
+    else:
+        _user_cache.pop(user_id, None)
+
 def save_pending_utm(user_id: int, utm_source: str, referrer_id: int = None):
     """Save UTM source for user before they complete registration.
     This persists UTM even if bot restarts between /start and language selection."""
@@ -2051,18 +2408,21 @@ ALLOWED_USER_SETTINGS = frozenset({
 
 def update_user_settings(user_id: int, **kwargs) -> None:
     """Update user settings (SQL injection safe)"""
-    conn = get_db_connection()
-    c = conn.cursor()
+    # Only allow whitelisted fields
+    fields = [(key, value) for key, value in kwargs.items() if key in ALLOWED_USER_SETTINGS]
+    if not fields:
+        return
 
-    for key, value in kwargs.items():
-        # Only allow whitelisted fields
-        if key in ALLOWED_USER_SETTINGS:
-            # Use parameterized query with validated column name
-            query = f"UPDATE users SET {key} = ? WHERE user_id = ?"
-            c.execute(query, (value, user_id))
+    # Single UPDATE with parameterized values and validated column names
+    set_clause = ", ".join(f"{key} = ?" for key, _ in fields)
+    params = tuple(value for _, value in fields) + (user_id,)
 
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute(f"UPDATE users SET {set_clause} WHERE user_id = ?", params)
     conn.commit()
     conn.close()
+    invalidate_user_cache(user_id)
 
 def check_daily_limit(user_id):
     """Check if user has reached daily limit. Returns (can_use, remaining, use_bonus)
@@ -2077,14 +2437,14 @@ def check_daily_limit(user_id):
     # Check premium status (including expiry)
     if user.get("is_premium", 0):
         # Verify premium hasn't expired
-        expired = check_premium_expired(user_id)
+        expired = check_premium_expired(user_id, user)
         if not expired:
             logger.info(f"User {user_id} is PREMIUM (valid), no limit")
             return True, 999, False
         else:
             logger.info(f"User {user_id} premium EXPIRED, applying limit")
 
-    today = datetime.now().strftime("%Y-%m-%d")
+    today = date.today().isoformat()
     last_date = user.get("last_request_date") or ""  # Handle None
     daily_requests = user.get("daily_requests") or 0  # Handle None
     bonus_predictions = user.get("bonus_predictions") or 0  # Referral bonus
@@ -2123,7 +2483,7 @@ def increment_daily_usage(user_id, use_bonus: bool = False):
         logger.info(f"User {user_id} is premium, not incrementing")
         return
 
-    today = datetime.now().strftime("%Y-%m-%d")
+    today = date.today().isoformat()
     last_date = user.get("last_request_date") or ""  # Handle None
     current = user.get("daily_requests") or 0  # Handle None
     bonus_predictions = user.get("bonus_predictions") or 0
@@ -2147,11 +2507,9 @@ def add_favorite_team(user_id, team_name):
     """Add favorite team (ignores if already exists)"""
     conn = get_db_connection()
     c = conn.cursor()
-    # Check if already exists
-    c.execute("SELECT 1 FROM favorite_teams WHERE user_id = ? AND team_name = ?", (user_id, team_name))
-    if not c.fetchone():
-        c.execute("INSERT INTO favorite_teams (user_id, team_name) VALUES (?, ?)", (user_id, team_name))
-        conn.commit()
+    # Duplicates are rejected by the uq_favorite_teams index
+    c.execute("INSERT OR IGNORE INTO favorite_teams (user_id, team_name) VALUES (?, ?)", (user_id, team_name))
+    conn.commit()
     conn.close()
 
 def remove_favorite_team(user_id, team_name):
@@ -2164,31 +2522,25 @@ def remove_favorite_team(user_id, team_name):
 
 def get_favorite_teams(user_id):
     """Get user's favorite teams"""
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT team_name FROM favorite_teams WHERE user_id = ?", (user_id,))
-    teams = [row[0] for row in c.fetchall()]
-    conn.close()
+    with ro_cursor() as c:
+        c.execute("SELECT team_name FROM favorite_teams WHERE user_id = ?", (user_id,))
+        teams = [row[0] for row in c.fetchall()]
     return teams
 
 def add_favorite_league(user_id, league_code):
     """Add favorite league (ignores if already exists)"""
     conn = get_db_connection()
     c = conn.cursor()
-    # Check if already exists
-    c.execute("SELECT 1 FROM favorite_leagues WHERE user_id = ? AND league_code = ?", (user_id, league_code))
-    if not c.fetchone():
-        c.execute("INSERT INTO favorite_leagues (user_id, league_code) VALUES (?, ?)", (user_id, league_code))
-        conn.commit()
+    # Duplicates are rejected by the uq_favorite_leagues index
+    c.execute("INSERT OR IGNORE INTO favorite_leagues (user_id, league_code) VALUES (?, ?)", (user_id, league_code))
+    conn.commit()
     conn.close()
 
 def get_favorite_leagues(user_id):
     """Get user's favorite leagues"""
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT league_code FROM favorite_leagues WHERE user_id = ?", (user_id,))
-    leagues = [row[0] for row in c.fetchall()]
-    conn.close()
+    with ro_cursor() as c:
+        c.execute("SELECT league_code FROM favorite_leagues WHERE user_id = ?", (user_id,))
+        leagues = [row[0] for row in c.fetchall()]
     return leagues
 
 
@@ -2261,6 +2613,12 @@ GEO_PREMIUM_TIERS = {
     "DEFAULT": PREMIUM_TIERS_USD
 }
 
+# Tiers pre-sorted from highest to lowest threshold (avoids sorting per postback)
+_GEO_PREMIUM_TIERS_DESC = {
+    geo: tuple(sorted(tiers.items(), reverse=True))
+    for geo, tiers in GEO_PREMIUM_TIERS.items()
+}
+
 # Geo-specific price display texts
 GEO_PRICE_DISPLAY = {
     "NG": {
@@ -2382,10 +2740,10 @@ def calculate_premium_reward(amount: float, currency: str = "BRL", geo: str = "D
     amount_usd = convert_to_usd(amount, currency)
 
     # Get geo-specific tiers (falls back to DEFAULT if unknown)
-    tiers = get_premium_tiers_for_geo(geo)
+    tiers_desc = _GEO_PREMIUM_TIERS_DESC.get(geo, _GEO_PREMIUM_TIERS_DESC["DEFAULT"])
 
     # Check tiers from highest to lowest
-    for threshold, reward in sorted(tiers.items(), reverse=True):
+    for threshold, reward in tiers_desc:
         if amount_usd >= threshold:
             if reward == "bonus_5":
                 return {
@@ -2413,43 +2771,38 @@ def calculate_premium_days(amount: float, currency: str = "BRL", geo: str = "DEF
     return reward.get("days", 0)
 
 
+def _apply_premium_grant(c, user_id: int, days: int) -> int:
+    """Grant premium using caller's cursor/transaction. Returns new expiry (epoch seconds)."""
+    # Check if user exists first
+    c.execute("SELECT premium_expires_ts FROM users WHERE user_id = ?", (user_id,))
+    row = c.fetchone()
+
+    if row is None:
+        # User doesn't exist - create them first
+        c.execute("INSERT INTO users (user_id, is_premium, daily_requests) VALUES (?, 0, 0)", (user_id,))
+        logger.info(f"Created user {user_id} for premium grant")
+
+    # Extend existing premium if still active, otherwise start from now
+    current_expiry = row[0] if row and row[0] else 0
+    new_expiry = max(int(time.time()), current_expiry) + days * 86400
+
+    # Update premium status
+    c.execute("""UPDATE users SET is_premium = 1, premium_expires_ts = ?
+                 WHERE user_id = ?""", (new_expiry, user_id))
+    invalidate_user_cache(user_id)
+    return new_expiry
+
+
 def grant_premium(user_id: int, days: int) -> bool:
     """Grant premium to user for specified days."""
     try:
         conn = get_db_connection()
         c = conn.cursor()
-
-        # Check if user exists first
-        c.execute("SELECT premium_expires FROM users WHERE user_id = ?", (user_id,))
-        row = c.fetchone()
-
-        if row is None:
-            # User doesn't exist - create them first
-            c.execute("INSERT INTO users (user_id, is_premium, daily_requests) VALUES (?, 0, 0)", (user_id,))
-            conn.commit()
-            logger.info(f"Created user {user_id} for premium grant")
-
-        now = datetime.now()
-        if row and row[0]:
-            # Extend existing premium
-            try:
-                current_expiry = datetime.fromisoformat(row[0])
-                if current_expiry > now:
-                    new_expiry = current_expiry + timedelta(days=days)
-                else:
-                    new_expiry = now + timedelta(days=days)
-            except:
-                new_expiry = now + timedelta(days=days)
-        else:
-            new_expiry = now + timedelta(days=days)
-
-        # Update premium status
-        c.execute("""UPDATE users SET is_premium = 1, premium_expires = ?
-                     WHERE user_id = ?""", (new_expiry.isoformat(), user_id))
+        new_expiry = _apply_premium_grant(c, user_id, days)
         conn.commit()
         conn.close()
 
-        logger.info(f"Granted {days} days premium to user {user_id}, expires {new_expiry}")
+        logger.info(f"Granted {days} days premium to user {user_id}, expires at {new_expiry}")
         return True
     except Exception as e:
         logger.error(f"Error granting premium: {e}")
@@ -2481,6 +2834,7 @@ def grant_bonus_predictions(user_id: int, count: int = 5) -> bool:
 
         conn.commit()
         conn.close()
+        invalidate_user_cache(user_id)
 
         logger.info(f"Granted {count} bonus predictions to user {user_id}")
         return True
@@ -2489,36 +2843,39 @@ def grant_bonus_predictions(user_id: int, count: int = 5) -> bool:
         return False
 
 
-def check_premium_expired(user_id: int) -> bool:
-    """Check if user's premium has expired and update status if needed."""
-    try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT is_premium, premium_expires FROM users WHERE user_id = ?", (user_id,))
-        row = c.fetchone()
-        conn.close()
+def check_premium_expired(user_id: int, user: Optional[dict] = None) -> bool:
+    """Check if user's premium has expired.
 
-        if not row or not row[0]:
-            return True  # Not premium
+    Expiry itself is applied in batch by expire_premium_subscriptions(), so
+    is_premium is authoritative here. Pass an already loaded user dict to
+    skip the DB lookup.
+    """
+    if user is None:
+        user = get_user(user_id)
+    return not user or not user.get("is_premium")
 
-        if not row[1]:
-            return False  # Premium without expiry (legacy)
 
-        expiry = datetime.fromisoformat(row[1])
-        if expiry < datetime.now():
-            # Premium expired - update status
-            conn = get_db_connection()
-            c = conn.cursor()
-            c.execute("UPDATE users SET is_premium = 0 WHERE user_id = ?", (user_id,))
-            conn.commit()
-            conn.close()
-            logger.info(f"Premium expired for user {user_id}")
-            return True
+def expire_premium_subscriptions() -> int:
+    """Reset is_premium for every user whose premium has expired (single UPDATE).
 
-        return False  # Still premium
+    Returns number of users whose premium was expired.
+    """
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("""UPDATE users SET is_premium = 0
+                     WHERE is_premium = 1 AND premium_expires_ts IS NOT NULL AND premium_expires_ts < ?""",
+                  (int(time.time()),))
+        expired = c.rowcount
+        conn.commit()
+        conn.close()
+        if expired > 0:
+            invalidate_user_cache()
+            logger.info(f"Premium expired for {expired} users")
+        return expired
     except Exception as e:
-        logger.error(f"Error checking premium: {e}")
-        return True
+        logger.error(f"Error expiring premium: {e}")
+        return 0
 
 
 # ===== REFERRAL SYSTEM =====
@@ -2757,8 +3114,9 @@ def update_user_streak(user_id: int) -> dict:
         conn = get_db_connection()
         c = conn.cursor()
 
-        today = datetime.now().strftime("%Y-%m-%d")
-        yesterday = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
+        today_date = date.today()
+        today = today_date.isoformat()
+        yesterday = (today_date - timedelta(days=1)).isoformat()
 
         c.execute("""SELECT streak_days, streak_record, last_streak_date
                      FROM users WHERE user_id = ?""", (user_id,))
@@ -2826,8 +3184,9 @@ def get_social_stats() -> dict:
         conn = get_db_connection()
         c = conn.cursor()
 
-        today = datetime.now().strftime("%Y-%m-%d")
-        week_ago = (datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d")
+        today_date = date.today()
+        today = today_date.isoformat()
+        week_ago = (today_date - timedelta(days=7)).isoformat()
 
         # Wins today
         c.execute("""SELECT COUNT(DISTINCT user_id) FROM predictions
@@ -2955,13 +3314,11 @@ def process_1win_postback(data: dict) -> dict:
         except:
             return {"status": "error", "reason": "invalid sub1 (telegram user_id)"}
 
-        # Check for duplicate transaction
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT id FROM deposits_1win WHERE transaction_id = ?", (transaction_id,))
-        if c.fetchone():
-            conn.close()
-            return {"status": "duplicate", "reason": "transaction already processed"}
+        # Cheap early exit for replays; the INSERT below still guards against races
+        with ro_cursor() as c:
+            c.execute("SELECT 1 FROM deposits_1win WHERE transaction_id = ?", (transaction_id,))
+            if c.fetchone():
+                return {"status": "duplicate", "reason": "transaction already processed"}
 
         # Get user's geo for personalized thresholds
         user_geo = get_user_geo(telegram_user_id)
@@ -2970,7 +3327,6 @@ def process_1win_postback(data: dict) -> dict:
         reward = calculate_premium_reward(amount, currency, user_geo)
 
         if reward["type"] == "none":
-            conn.close()
             # Get minimum threshold for this geo
             min_threshold = min(get_premium_tiers_for_geo(user_geo).keys())
             return {"status": "ignored", "reason": f"deposit {amount} {currency} (${reward['amount_usd']:.2f}) below minimum ${min_threshold} for geo={user_geo}"}
@@ -2978,18 +3334,35 @@ def process_1win_postback(data: dict) -> dict:
         premium_days = reward.get("days", 0)
         bonus_predictions = reward.get("predictions", 0)
 
-        # Save deposit record
-        c.execute("""INSERT INTO deposits_1win
-                     (user_id, onewin_user_id, amount, currency, event, transaction_id, country, premium_days)
-                     VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
-                  (telegram_user_id, onewin_user_id, amount, currency, event, transaction_id, country, premium_days))
-        conn.commit()
-        conn.close()
+        # Save deposit record + grant premium in one write transaction.
+        # Duplicate transaction_id is detected by the UNIQUE constraint (race-free).
+        conn = get_db_connection()
+        conn.isolation_level = None
+        c = conn.cursor()
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            c.execute("""INSERT INTO deposits_1win
+                         (user_id, onewin_user_id, amount, currency, event, transaction_id, country, premium_days)
+                         VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                         ON CONFLICT(transaction_id) DO NOTHING""",
+                      (telegram_user_id, onewin_user_id, amount, currency, event, transaction_id, country, premium_days))
+            if c.rowcount == 0:
+                c.execute("ROLLBACK")
+                return {"status": "duplicate", "reason": "transaction already processed"}
+
+            if reward["type"] == "premium":
+                new_expiry = _apply_premium_grant(c, telegram_user_id, premium_days)
+            c.execute("COMMIT")
+        except Exception:
+            if conn.in_transaction:
+                c.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
 
         # Grant reward based on type
         if reward["type"] == "premium":
-            grant_premium(telegram_user_id, premium_days)
-            logger.info(f"Granted {premium_days} days premium to user {telegram_user_id} for ${reward['amount_usd']:.2f} deposit")
+            logger.info(f"Granted {premium_days} days premium to user {telegram_user_id} for ${reward['amount_usd']:.2f} deposit, expires at {new_expiry}")
         elif reward["type"] == "bonus_predictions":
             grant_bonus_predictions(telegram_user_id, bonus_predictions)
             logger.info(f"Granted {bonus_predictions} bonus predictions to user {telegram_user_id} for ${reward['amount_usd']:.2f} deposit")
@@ -3181,17 +3554,16 @@ def process_crypto_webhook(data: dict) -> dict:
 
 def load_live_subscribers() -> set[int]:
     """Load live subscribers from database"""
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT user_id FROM live_subscribers")
-    subscribers = {row[0] for row in c.fetchall()}
-    conn.close()
+    with ro_cursor() as c:
+        c.execute("SELECT user_id FROM live_subscribers")
+        subscribers = {row[0] for row in c.fetchall()}
     logger.info(f"Loaded {len(subscribers)} live subscribers from DB")
     return subscribers
 
 
 def add_live_subscriber(user_id: int) -> None:
-    """Add user to live subscribers in DB"""
+    """Add user to live subscribers (in-memory set + DB)"""
+    live_subscribers.add(user_id)
     conn = get_db_connection()
     c = conn.cursor()
     c.execute("INSERT OR IGNORE INTO live_subscribers (user_id) VALUES (?)", (user_id,))
@@ -3200,7 +3572,8 @@ def add_live_subscriber(user_id: int) -> None:
 
 
 def remove_live_subscriber(user_id: int) -> None:
-    """Remove user from live subscribers in DB"""
+    """Remove user from live subscribers (in-memory set + DB)"""
+    live_subscribers.discard(user_id)
     conn = get_db_connection()
     c = conn.cursor()
     c.execute("DELETE FROM live_subscribers WHERE user_id = ?", (user_id,))
@@ -3208,8 +3581,9 @@ def remove_live_subscriber(user_id: int) -> None:
     conn.close()
 
 
+@lru_cache(maxsize=512)
 def categorize_bet(bet_type):
-    """Categorize bet type for statistics"""
+    """Categorize bet type for statistics (pure, memoized per bet_type string)"""
     if not bet_type:
         return "other"
     bet_lower = bet_type.lower()
@@ -3233,8 +3607,9 @@ def categorize_bet(bet_type):
     return "other"
 
 
+@lru_cache(maxsize=1024)
 def parse_bet_from_text(text: str) -> tuple:
-    """Parse bet type, confidence and odds from text.
+    """Parse bet type, confidence and odds from text (pure, memoized).
 
     Returns: (bet_type, confidence, odds) or (None, None, None) if parsing fails
     """
@@ -3470,7 +3845,6 @@ def save_prediction(user_id, match_id, home, away, bet_type, confidence, odds, m
         # Already have this prediction
         existing_id = existing[0]
         existing_type = existing[1]
-        conn.close()
         if bet_rank == 1:
             logger.info(f"Skipping duplicate MAIN: match {match_id} already has main bet {existing_type}")
         else:
@@ -3478,17 +3852,17 @@ def save_prediction(user_id, match_id, home, away, bet_type, confidence, odds, m
 
         # IMPORTANT: Still save ML data if features provided but not saved before
         if ml_features and category:
-            # Check if ML data exists for this prediction
-            conn2 = get_db_connection()
-            c2 = conn2.cursor()
-            c2.execute("SELECT id FROM ml_training_data WHERE prediction_id = ?", (existing_id,))
-            ml_exists = c2.fetchone()
-            conn2.close()
-
-            if not ml_exists:
-                save_ml_training_data(existing_id, category, ml_features, target=None, bet_rank=bet_rank)
-                logger.info(f"Added missing ML data for existing prediction {existing_id}")
+            # Check if ML data exists for this prediction (same connection)
+            c.execute("SELECT id FROM ml_training_data WHERE prediction_id = ?", (existing_id,))
+            if not c.fetchone():
+                try:
+                    _insert_ml_training_data(c, existing_id, category, ml_features, None, bet_rank)
+                    conn.commit()
+                    logger.info(f"Added missing ML data for existing prediction {existing_id}")
+                except Exception as e:
+                    logger.error(f"❌ Failed to save ML data: {e}")
 
+        conn.close()
         return existing_id  # Return existing prediction ID
 
     # Serialize ml_features to JSON for smart learning
@@ -3503,42 +3877,66 @@ def save_prediction(user_id, match_id, home, away, bet_type, confidence, odds, m
                  VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
               (user_id, match_id, home, away, bet_type, category, confidence, odds, bet_rank, league_code, ml_features_json, ev, stake, match_time))
     prediction_id = c.lastrowid
-    conn.commit()
-    conn.close()
 
     # Save ML training data if features provided (with bet_rank for MAIN vs ALT analysis)
+    # in the same transaction, so both rows cost a single commit
     if ml_features and category:
-        save_ml_training_data(prediction_id, category, ml_features, target=None, bet_rank=bet_rank)
+        try:
+            _insert_ml_training_data(c, prediction_id, category, ml_features, None, bet_rank)
+        except Exception as e:
+            logger.error(f"❌ Failed to save ML data: {e}")
+
+    conn.commit()
+    conn.close()
 
     rank_label = "MAIN" if bet_rank == 1 else f"ALT{bet_rank-1}"
     logger.info(f"Saved prediction [{rank_label}]: {home} vs {away}, {bet_type} ({confidence}%)")
 
     return prediction_id
 
-def get_pending_predictions():
-    """Get predictions that haven't been checked yet.
+def iter_pending_predictions(user_id: Optional[int] = None, limit: Optional[int] = None,
+                             batch_size: int = 1000) -> Iterator[dict]:
+    """Stream predictions that haven't been checked yet, batch_size rows at a time.
 
     Sorted by match_time (oldest first) for smart result checking -
     matches that should have ended get checked first.
+    Holds a pooled read connection until exhausted - don't await between items.
     """
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("""SELECT id, user_id, match_id, home_team, away_team, bet_type, confidence, odds, bet_rank, match_time
-                 FROM predictions
-                 WHERE is_correct IS NULL
-                 AND predicted_at > datetime('now', '-7 days')
-                 ORDER BY
-                    CASE WHEN match_time IS NOT NULL
-                         THEN match_time
-                         ELSE predicted_at
-                    END ASC""")
-    rows = c.fetchall()
-    conn.close()
+    query = """SELECT id, user_id, match_id, home_team, away_team, bet_type, confidence, odds, bet_rank, match_time
+               FROM predictions
+               WHERE is_correct IS NULL
+               AND predicted_at > datetime('now', '-7 days')"""
+    params: tuple = ()
+    if user_id is not None:
+        query += " AND user_id = ?"
+        params += (user_id,)
+    query += """
+               ORDER BY
+                  CASE WHEN match_time IS NOT NULL
+                       THEN match_time
+                       ELSE predicted_at
+                  END ASC"""
+    if limit is not None:
+        query += " LIMIT ?"
+        params += (limit,)
+
+    with ro_cursor() as c:
+        c.arraysize = batch_size
+        c.execute(query, params)
+        while True:
+            rows = c.fetchmany()
+            if not rows:
+                break
+            for r in rows:
+                yield {"id": r[0], "user_id": r[1], "match_id": r[2], "home": r[3],
+                       "away": r[4], "bet_type": r[5], "confidence": r[6], "odds": r[7],
+                       "bet_rank": r[8],
+                       "match_time": r[9]}
+
 
-    return [{"id": r[0], "user_id": r[1], "match_id": r[2], "home": r[3],
-             "away": r[4], "bet_type": r[5], "confidence": r[6], "odds": r[7],
-             "bet_rank": r[8] if len(r) > 8 else 1,
-             "match_time": r[9] if len(r) > 9 else None} for r in rows]
+def get_pending_predictions(user_id: Optional[int] = None, limit: Optional[int] = None) -> list:
+    """Get predictions that haven't been checked yet (optionally for one user / first N)."""
+    return list(iter_pending_predictions(user_id, limit))
 
 def update_prediction_result(pred_id, result, is_correct):
     """Update prediction with result and ML training data + trigger learning"""
@@ -3554,6 +3952,7 @@ def update_prediction_result(pred_id, result, is_correct):
                  WHERE id = ?""", (result, is_correct, pred_id))
     conn.commit()
     conn.close()
+    invalidate_accuracy_stats()
 
     # Update ML training target (1 = correct, 0 = incorrect)
     if is_correct is not None:
@@ -3639,6 +4038,7 @@ def clean_duplicate_predictions() -> dict:
 
     conn.commit()
     conn.close()
+    invalidate_accuracy_stats()
 
     logger.info(f"Cleaned {deleted_count} duplicates from {affected_matches} matches, {orphaned_ml} orphaned ML records")
 
@@ -3705,36 +4105,32 @@ def get_clean_stats() -> dict:
     Different bet types or ranks (main vs alt) are NOT duplicates.
     """
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-
-        # Count unique predictions (first per user+match+bet_type+bet_rank)
-        c.execute("""
-            WITH unique_preds AS (
-                SELECT *, ROW_NUMBER() OVER (
-                    PARTITION BY user_id, match_id, bet_type, bet_rank
-                    ORDER BY predicted_at ASC
-                ) as rn
-                FROM predictions
-                WHERE is_correct IS NOT NULL
-            )
-            SELECT
-                COUNT(*) as total,
-                SUM(CASE WHEN is_correct = 1 THEN 1 ELSE 0 END) as correct
-            FROM unique_preds WHERE rn = 1
-        """)
-        row = c.fetchone()
-        total = row[0] or 0
-        correct = row[1] or 0
-
-        # Current stats (with duplicates)
-        c.execute("""SELECT COUNT(*), SUM(CASE WHEN is_correct = 1 THEN 1 ELSE 0 END)
-                     FROM predictions WHERE is_correct IS NOT NULL""")
-        row2 = c.fetchone()
-        total_with_dups = row2[0] or 0
-        correct_with_dups = row2[1] or 0
+        with ro_cursor() as c:
+            # Count unique predictions (first per user+match+bet_type+bet_rank)
+            c.execute("""
+                WITH unique_preds AS (
+                    SELECT *, ROW_NUMBER() OVER (
+                        PARTITION BY user_id, match_id, bet_type, bet_rank
+                        ORDER BY predicted_at ASC
+                    ) as rn
+                    FROM predictions
+                    WHERE is_correct IS NOT NULL
+                )
+                SELECT
+                    COUNT(*) as total,
+                    SUM(CASE WHEN is_correct = 1 THEN 1 ELSE 0 END) as correct
+                FROM unique_preds WHERE rn = 1
+            """)
+            row = c.fetchone()
+            total = row[0] or 0
+            correct = row[1] or 0
 
-        conn.close()
+            # Current stats (with duplicates)
+            c.execute("""SELECT COUNT(*), SUM(CASE WHEN is_correct = 1 THEN 1 ELSE 0 END)
+                         FROM predictions WHERE is_correct IS NOT NULL""")
+            row2 = c.fetchone()
+            total_with_dups = row2[0] or 0
+            correct_with_dups = row2[1] or 0
 
         return {
             "clean_total": total,
@@ -3761,21 +4157,18 @@ def get_clean_stats() -> dict:
 def get_roi_stats(user_id: int = None) -> dict:
     """Calculate ROI (Return on Investment) for predictions.
     Assumes flat betting (1 unit per bet)."""
-    conn = get_db_connection()
-    c = conn.cursor()
-
     where_clause = "WHERE is_correct IS NOT NULL"
     params = ()
     if user_id:
         where_clause += " AND user_id = ?"
         params = (user_id,)
 
-    c.execute(f"""
-        SELECT odds, is_correct FROM predictions
-        {where_clause}
-    """, params)
-    rows = c.fetchall()
-    conn.close()
+    with ro_cursor() as c:
+        c.execute(f"""
+            SELECT odds, is_correct FROM predictions
+            {where_clause}
+        """, params)
+        rows = c.fetchall()
 
     if not rows:
         return {"total_bets": 0, "roi": 0, "profit": 0, "units_won": 0, "units_lost": 0}
@@ -3807,22 +4200,19 @@ def get_roi_stats(user_id: int = None) -> dict:
 
 def get_streak_info(user_id: int = None) -> dict:
     """Get current streak and best/worst streaks."""
-    conn = get_db_connection()
-    c = conn.cursor()
-
     where_clause = "WHERE is_correct IS NOT NULL"
     params = ()
     if user_id:
         where_clause += " AND user_id = ?"
         params = (user_id,)
 
-    c.execute(f"""
-        SELECT is_correct FROM predictions
-        {where_clause}
-        ORDER BY checked_at DESC
-    """, params)
-    rows = c.fetchall()
-    conn.close()
+    with ro_cursor() as c:
+        c.execute(f"""
+            SELECT is_correct FROM predictions
+            {where_clause}
+            ORDER BY checked_at DESC
+        """, params)
+        rows = c.fetchall()
 
     if not rows:
         return {"current_streak": 0, "streak_type": None, "best_win_streak": 0, "worst_lose_streak": 0}
@@ -3871,29 +4261,26 @@ def get_streak_info(user_id: int = None) -> dict:
 
 def get_stats_by_league() -> dict:
     """Get accuracy statistics broken down by league/competition."""
-    conn = get_db_connection()
-    c = conn.cursor()
-
-    c.execute("""
-        SELECT
-            CASE
-                WHEN home_team LIKE '%Premier%' OR away_team LIKE '%Premier%' THEN 'Premier League'
-                WHEN home_team LIKE '%Barcelona%' OR home_team LIKE '%Madrid%' OR home_team LIKE '%Atletico%' THEN 'La Liga'
-                WHEN home_team LIKE '%Bayern%' OR home_team LIKE '%Dortmund%' THEN 'Bundesliga'
-                WHEN home_team LIKE '%Juventus%' OR home_team LIKE '%Milan%' OR home_team LIKE '%Inter%' OR home_team LIKE '%Roma%' THEN 'Serie A'
-                WHEN home_team LIKE '%PSG%' OR home_team LIKE '%Lyon%' OR home_team LIKE '%Marseille%' THEN 'Ligue 1'
-                ELSE 'Other'
-            END as league,
-            COUNT(*) as total,
-            SUM(CASE WHEN is_correct = 1 THEN 1 ELSE 0 END) as wins,
-            bet_category
-        FROM predictions
-        WHERE is_correct IS NOT NULL
-        GROUP BY league, bet_category
-        ORDER BY total DESC
-    """)
-    rows = c.fetchall()
-    conn.close()
+    with ro_cursor() as c:
+        c.execute("""
+            SELECT
+                CASE
+                    WHEN home_team LIKE '%Premier%' OR away_team LIKE '%Premier%' THEN 'Premier League'
+                    WHEN home_team LIKE '%Barcelona%' OR home_team LIKE '%Madrid%' OR home_team LIKE '%Atletico%' THEN 'La Liga'
+                    WHEN home_team LIKE '%Bayern%' OR home_team LIKE '%Dortmund%' THEN 'Bundesliga'
+                    WHEN home_team LIKE '%Juventus%' OR home_team LIKE '%Milan%' OR home_team LIKE '%Inter%' OR home_team LIKE '%Roma%' THEN 'Serie A'
+                    WHEN home_team LIKE '%PSG%' OR home_team LIKE '%Lyon%' OR home_team LIKE '%Marseille%' THEN 'Ligue 1'
+                    ELSE 'Other'
+                END as league,
+                COUNT(*) as total,
+                SUM(CASE WHEN is_correct = 1 THEN 1 ELSE 0 END) as wins,
+                bet_category
+            FROM predictions
+            WHERE is_correct IS NOT NULL
+            GROUP BY league, bet_category
+            ORDER BY total DESC
+        """)
+        rows = c.fetchall()
 
     stats = {}
     for league, total, wins, category in rows:
@@ -4620,9 +5007,9 @@ async def update_key_players_from_api(league_code: str) -> int:
     try:
         # Step 1: Get top scorers (these are definitely key players)
         url = f"{FOOTBALL_API_URL}/competitions/{league_code}/scorers"
-        async with session.get(url, headers=headers, params={"limit": 30}) as r:
+        async with football_api_get(session, url, headers=headers, params={"limit": 30}) as r:
             if r.status == 200:
-                data = await r.json()
+                data = json.loads(await r.read())
                 scorers = data.get("scorers", [])
 
                 for scorer in scorers:
@@ -4669,9 +5056,9 @@ async def update_key_players_from_api(league_code: str) -> int:
 
         # Step 2: Get teams and their key defenders/goalkeepers
         url = f"{FOOTBALL_API_URL}/competitions/{league_code}/teams"
-        async with session.get(url, headers=headers) as r:
+        async with football_api_get(session, url, headers=headers) as r:
             if r.status == 200:
-                data = await r.json()
+                data = json.loads(await r.read())
                 teams = data.get("teams", [])
 
                 for team in teams[:20]:  # Top 20 teams
@@ -5657,8 +6044,8 @@ def get_ensemble_prediction(features: dict, bet_category: str = "match_result")
             feature_vector = np.array([[features.get(f, 0) for f in feature_names]])
 
             # Get prediction and probability
-            pred = model.predict(feature_vector)[0]
             prob = model.predict_proba(feature_vector)[0]
+            pred = model.classes_[prob.argmax()]
 
             # Get probability of predicted class
             pred_prob = prob[pred] if pred < len(prob) else 0.5
@@ -5809,6 +6196,9 @@ LEAGUE_AVG_GOALS = {
     "default": 2.60
 }
 
+# league_avg / 2.60 baseline, precomputed for calculate_expected_goals
+_LEAGUE_GOALS_FACTOR = {code: avg / 2.60 for code, avg in LEAGUE_AVG_GOALS.items()}
+
 
 def calculate_expected_goals(home_form: dict, away_form: dict, league_code: str = None) -> dict:
     """Calculate expected goals using HOME/AWAY specific stats.
@@ -5833,8 +6223,8 @@ def calculate_expected_goals(home_form: dict, away_form: dict, league_code: str
         "confidence": "low"
     }
 
-    # Get league average for normalization
-    league_avg = LEAGUE_AVG_GOALS.get(league_code, LEAGUE_AVG_GOALS["default"]) if league_code else 2.60
+    # League normalization factor (league average vs 2.60 baseline)
+    league_factor = _LEAGUE_GOALS_FACTOR.get(league_code, _LEAGUE_GOALS_FACTOR["default"]) if league_code else 1.0
 
     try:
         # Try to use HOME/AWAY specific stats (best method)
@@ -5847,7 +6237,7 @@ def calculate_expected_goals(home_form: dict, away_form: dict, league_code: str
         away_away_conceded = away_away.get("avg_goals_conceded")
 
         # Check if we have HOME/AWAY specific data
-        if all([home_home_scored, home_home_conceded, away_away_scored, away_away_conceded]):
+        if home_home_scored and home_home_conceded and away_away_scored and away_away_conceded:
             # Best method: use home/away specific averages
             # Weight: team's attack (0.6) + opponent's defense weakness (0.4)
             expected_home = home_home_scored * 0.6 + away_away_conceded * 0.4
@@ -5877,9 +6267,9 @@ def calculate_expected_goals(home_form: dict, away_form: dict, league_code: str
             away_scored = away_overall.get("avg_goals_scored", 1.2)
             away_conceded = away_overall.get("avg_goals_conceded", 1.4)
 
-            # Simple average method
-            expected_home = (home_scored + away_conceded) / 2
-            expected_away = (away_scored + home_conceded) / 2
+            # Simple average method (x * 0.5 is bit-identical to x / 2)
+            expected_home = (home_scored + away_conceded) * 0.5
+            expected_away = (away_scored + home_conceded) * 0.5
 
             result["expected_home"] = round(expected_home, 2)
             result["expected_away"] = round(expected_away, 2)
@@ -5889,7 +6279,6 @@ def calculate_expected_goals(home_form: dict, away_form: dict, league_code: str
 
         # Apply league normalization (optional boost/reduction)
         # If league is high-scoring (like Bundesliga), slightly increase expectation
-        league_factor = league_avg / 2.60  # 2.60 is our baseline
         if league_factor > 1.05 or league_factor < 0.95:
             result["expected_total"] = round(result["expected_total"] * league_factor, 2)
             result["league_adjustment"] = round((league_factor - 1) * 100, 1)
@@ -5902,6 +6291,10 @@ def calculate_expected_goals(home_form: dict, away_form: dict, league_code: str
     return result
 
 
+# Totals keywords for validate_totals_prediction (one regex scan instead of 7 substring checks)
+_TOTALS_TOKEN_RE = re.compile(r'тб|тм|over|under|больше|меньше')
+
+
 def validate_totals_prediction(bet_type: str, confidence: int, home_form: dict, away_form: dict,
                                 league_code: str = None) -> tuple:
     """Validate totals prediction against expected goals (using improved calculation).
@@ -5910,10 +6303,11 @@ def validate_totals_prediction(bet_type: str, confidence: int, home_form: dict,
     if not bet_type or not home_form or not away_form:
         return bet_type, confidence, None
 
-    bet_lower = bet_type.lower()
+    # Single pass over the bet string collects all totals keywords
+    tokens = set(_TOTALS_TOKEN_RE.findall(bet_type.lower()))
 
     # Only validate totals bets
-    if "тб" not in bet_lower and "тм" not in bet_lower and "over" not in bet_lower and "under" not in bet_lower:
+    if tokens.isdisjoint(("тб", "тм", "over", "under")):
         return bet_type, confidence, None
 
     # Use improved expected goals calculation
@@ -5924,8 +6318,8 @@ def validate_totals_prediction(bet_type: str, confidence: int, home_form: dict,
 
         logger.info(f"Totals validation: expected={expected_total:.2f} ({method}), bet={bet_type}, league={league_code}")
 
-        is_over = "тб" in bet_lower or "over" in bet_lower or "больше" in bet_lower
-        is_under = "тм" in bet_lower or "under" in bet_lower or "меньше" in bet_lower
+        is_over = not tokens.isdisjoint(("тб", "over", "больше"))
+        is_under = not tokens.isdisjoint(("тм", "under", "меньше"))
 
         # STRICT VALIDATION
         if is_over and expected_total < 2.3:
@@ -5954,8 +6348,32 @@ def validate_totals_prediction(bet_type: str, confidence: int, home_form: dict,
     return bet_type, confidence, None
 
 
+# Precompiled handicap value parser for check_bet_result
+_HANDICAP_RE = re.compile(r'\(?([-+]?\d+\.?\d*)\)?')
+
+# Exact bet_type -> result check (hot path: canonical bet types saved by the bot).
+# Anything not listed falls through to the keyword scan in check_bet_result.
+_BET_RESULT_EXACT = {
+    "П1": lambda h, a: h > a,
+    "1": lambda h, a: h > a,
+    "П2": lambda h, a: a > h,
+    "2": lambda h, a: a > h,
+    "Х": lambda h, a: h == a,
+    "12": lambda h, a: h != a,
+    "ТБ 2.5": lambda h, a: h + a > 2.5,
+    "ТМ 2.5": lambda h, a: h + a < 2.5,
+    "BTTS": lambda h, a: h > 0 and a > 0,
+    "1X": lambda h, a: h >= a,
+    "X2": lambda h, a: a >= h,
+}
+
+
 def check_bet_result(bet_type, home_score, away_score):
     """Check if bet was correct based on score"""
+    exact_check = _BET_RESULT_EXACT.get(bet_type)
+    if exact_check is not None:
+        return exact_check(home_score, away_score)
+
     total_goals = home_score + away_score
     bet_lower = bet_type.lower() if bet_type else ""
     bet_upper = bet_type.upper() if bet_type else ""
@@ -5963,7 +6381,7 @@ def check_bet_result(bet_type, home_score, away_score):
     # Handicaps (Фора)
     if "фора" in bet_lower or "handicap" in bet_lower:
         # Parse handicap value
-        handicap_match = re.search(r'\(?([-+]?\d+\.?\d*)\)?', bet_type)
+        handicap_match = _HANDICAP_RE.search(bet_type)
         if handicap_match:
             handicap = float(handicap_match.group(1))
             
@@ -6181,20 +6599,76 @@ ML_FEATURE_COLUMNS = {
     "flat_track_available": 0,
 }
 
+# Fixed feature order + defaults (derived from ML_FEATURE_COLUMNS, used for vectors/blobs)
+ML_FEATURE_NAMES = tuple(ML_FEATURE_COLUMNS)
+ML_FEATURE_COUNT = len(ML_FEATURE_NAMES)
+ML_FEATURE_DEFAULTS = (
+    np.array(list(ML_FEATURE_COLUMNS.values()), dtype=np.float32) if ML_AVAILABLE else None
+)
 
-def extract_features(home_form: dict, away_form: dict, standings: dict,
-                     odds: dict, h2h: list, home_team: str, away_team: str,
-                     referee_stats: dict = None, has_web_news: bool = False,
-                     congestion: dict = None, motivation: dict = None,
-                     team_class: dict = None, coach_factor: dict = None,
-                     lineups: dict = None, xg_data: dict = None,
-                     player_impact: dict = None, flat_track_context: dict = None) -> dict:
-    """Extract numerical features for ML model including all factors + player impact + flat track bully"""
-    features = {}
 
-    # Home team form features
-    if home_form:
-        home_overall = home_form.get("overall", {})
+def featurize(features: dict):
+    """Convert features dict to a float32 vector in ML_FEATURE_NAMES order.
+
+    Missing (or None) values fall back to ML_FEATURE_COLUMNS defaults.
+    """
+    get = features.get
+    return np.fromiter(
+        (v if (v := get(name)) is not None else default
+         for name, default in ML_FEATURE_COLUMNS.items()),
+        dtype=np.float32, count=ML_FEATURE_COUNT
+    )
+
+
+# id(standings table) -> (table, {lowercased team name: position})
+_standings_index_cache: dict = {}
+
+
+def _index_standings(standings: Optional[dict], table_key: str = "standings") -> dict:
+    """Index a standings table ("standings", "home" or "away") by lowercased team name, once per table."""
+    table = standings.get(table_key, []) if standings else []
+    cached = _standings_index_cache.get(id(table))
+    if cached and cached[0] is table:
+        return cached[1]
+    index = {}
+    for team in table:
+        index[team.get("team", {}).get("name", "").lower()] = team.get("position", 10)
+    if len(_standings_index_cache) > 64:
+        _standings_index_cache.clear()
+    _standings_index_cache[id(table)] = (table, index)
+    return index
+
+
+def _standings_position(index: dict, team_name: str, default: Optional[int] = 10,
+                        key_in_name: bool = True) -> Optional[int]:
+    """Position for team_name: exact name first, then substring match (last wins).
+
+    The substring match accepts team_name inside a table name and, unless
+    key_in_name is False, a table name inside team_name.
+    """
+    name = team_name.lower()
+    if name in index:
+        return index[name]
+    position = default
+    for key, pos in index.items():
+        if name in key or (key_in_name and key in name):
+            position = pos
+    return position
+
+
+def extract_features(home_form: dict, away_form: dict, standings: dict,
+                     odds: dict, h2h: list, home_team: str, away_team: str,
+                     referee_stats: dict = None, has_web_news: bool = False,
+                     congestion: dict = None, motivation: dict = None,
+                     team_class: dict = None, coach_factor: dict = None,
+                     lineups: dict = None, xg_data: dict = None,
+                     player_impact: dict = None, flat_track_context: dict = None) -> dict:
+    """Extract numerical features for ML model including all factors + player impact + flat track bully"""
+    features = {}
+
+    # Home team form features
+    if home_form:
+        home_overall = home_form.get("overall", {})
         home_home = home_form.get("home", {})
         features["home_wins"] = home_overall.get("wins", 0)
         features["home_draws"] = home_overall.get("draws", 0)
@@ -6237,15 +6711,9 @@ def extract_features(home_form: dict, away_form: dict, standings: dict,
         features["away_over25_pct"] = 50
 
     # Standings features
-    features["home_position"] = 10
-    features["away_position"] = 10
-    if standings:
-        for team in standings.get("standings", []):
-            team_name = team.get("team", {}).get("name", "").lower()
-            if home_team.lower() in team_name or team_name in home_team.lower():
-                features["home_position"] = team.get("position", 10)
-            if away_team.lower() in team_name or team_name in away_team.lower():
-                features["away_position"] = team.get("position", 10)
+    standings_index = _index_standings(standings)
+    features["home_position"] = _standings_position(standings_index, home_team)
+    features["away_position"] = _standings_position(standings_index, away_team)
 
     features["position_diff"] = features["home_position"] - features["away_position"]
 
@@ -6314,16 +6782,12 @@ def extract_features(home_form: dict, away_form: dict, standings: dict,
     h2h_draws = 0
     h2h_away_wins = 0
     if h2h:
-        for match in h2h[:10]:
-            score = match.get("score", {}).get("fullTime", {})
-            h_goals = score.get("home", 0) or 0
-            a_goals = score.get("away", 0) or 0
-            if h_goals > a_goals:
-                h2h_home_wins += 1
-            elif h_goals < a_goals:
-                h2h_away_wins += 1
-            else:
-                h2h_draws += 1
+        # Goal difference per match (home - away); sign gives the outcome
+        diffs = [(score.get("home") or 0) - (score.get("away") or 0)
+                 for score in (m.get("score", {}).get("fullTime", {}) for m in h2h[:10])]
+        h2h_home_wins = sum(d > 0 for d in diffs)
+        h2h_away_wins = sum(d < 0 for d in diffs)
+        h2h_draws = len(diffs) - h2h_home_wins - h2h_away_wins
 
     features["h2h_home_wins"] = h2h_home_wins
     features["h2h_draws"] = h2h_draws
@@ -6596,29 +7060,35 @@ def extract_features(home_form: dict, away_form: dict, standings: dict,
     return features
 
 
+def _insert_ml_training_data(c, prediction_id: int, bet_category: str, features: dict,
+                             target: Optional[int], bet_rank: int) -> int:
+    """Insert ML training row using caller's cursor (caller commits). Returns row id.
+
+    Besides features_json, stores packed float32 vector (features_blob) in
+    ML_FEATURE_NAMES order so training can load X without JSON parsing.
+    """
+    features_blob = featurize(features).tobytes() if ML_AVAILABLE else None
+    c.execute("""INSERT INTO ml_training_data (prediction_id, bet_category, features_json, features_blob, target, bet_rank)
+                 VALUES (?, ?, ?, ?, ?, ?)""",
+              (prediction_id, bet_category, json.dumps(features), features_blob, target, bet_rank))
+    ml_id = c.lastrowid
+    logger.info(f"✅ ML data saved: id={ml_id}, pred={prediction_id}, cat={bet_category}, rank={bet_rank}, features={len(features)} keys")
+    return ml_id
+
+
 def save_ml_training_data(prediction_id: int, bet_category: str, features: dict, target: int = None, bet_rank: int = 1):
     """Save features for ML training with bet rank (1=MAIN, 2+=ALT)"""
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("""INSERT INTO ml_training_data (prediction_id, bet_category, features_json, target, bet_rank)
-                     VALUES (?, ?, ?, ?, ?)""",
-                  (prediction_id, bet_category, json.dumps(features), target, bet_rank))
-        conn.commit()
-        ml_id = c.lastrowid
-        conn.close()
-        logger.info(f"✅ ML data saved: id={ml_id}, pred={prediction_id}, cat={bet_category}, rank={bet_rank}, features={len(features)} keys")
+        with write_cursor() as c:
+            _insert_ml_training_data(c, prediction_id, bet_category, features, target, bet_rank)
     except Exception as e:
         logger.error(f"❌ Failed to save ML data: {e}")
 
 
 def update_ml_training_target(prediction_id: int, target: int):
     """Update target (result) for ML training data"""
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("UPDATE ml_training_data SET target = ? WHERE prediction_id = ?", (target, prediction_id))
-    conn.commit()
-    conn.close()
+    with write_cursor() as c:
+        c.execute("UPDATE ml_training_data SET target = ? WHERE prediction_id = ?", (target, prediction_id))
 
 
 def get_ml_training_data(bet_category: str) -> tuple:
@@ -6626,37 +7096,47 @@ def get_ml_training_data(bet_category: str) -> tuple:
 
     Uses ML_FEATURE_COLUMNS for consistent feature ordering.
     Automatically uses all defined features - just add to ML_FEATURE_COLUMNS!
-    """
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("""SELECT features_json, target FROM ml_training_data
-                 WHERE bet_category = ? AND target IS NOT NULL""", (bet_category,))
-    rows = c.fetchall()
-    conn.close()
 
-    if not rows:
+    Rows with a features_blob of the current width are decoded in one
+    np.frombuffer call; older rows (no blob, or blob from a previous
+    feature schema) fall back to features_json.
+    Returns (X float32 ndarray, y int8 ndarray) or (None, None); both go to
+    train_test_split/fit as-is, without another conversion.
+    """
+    row_size = ML_FEATURE_COUNT * 4  # float32
+    with ro_cursor() as c:
+        c.execute("""SELECT features_blob, target FROM ml_training_data
+                     WHERE bet_category = ? AND target IS NOT NULL
+                       AND length(features_blob) = ?""", (bet_category, row_size))
+        blob_rows = c.fetchall()
+        # JSON text is only read (and parsed) for legacy rows without a usable blob
+        c.execute("""SELECT features_json, target FROM ml_training_data
+                     WHERE bet_category = ? AND target IS NOT NULL
+                       AND (features_blob IS NULL OR length(features_blob) != ?)""", (bet_category, row_size))
+        json_rows = c.fetchall()
+
+    if not blob_rows and not json_rows:
         return None, None
 
-    X = []
-    y = []
+    X = np.empty((len(blob_rows) + len(json_rows), ML_FEATURE_COUNT), dtype=np.float32)
+    y = np.empty(len(blob_rows) + len(json_rows), dtype=np.int8)  # targets are 0/1
 
-    # Get feature names in consistent order
-    feature_names = list(ML_FEATURE_COLUMNS.keys())
+    if blob_rows:
+        X[:len(blob_rows)] = np.frombuffer(b"".join(r[0] for r in blob_rows), dtype=np.float32).reshape(-1, ML_FEATURE_COUNT)
+        y[:len(blob_rows)] = np.fromiter((r[1] for r in blob_rows), dtype=np.int8, count=len(blob_rows))
 
-    for features_json, target in rows:
+    n = len(blob_rows)
+    for features_json, target in json_rows:
         try:
-            features = json.loads(features_json)
-            # Convert to list using ML_FEATURE_COLUMNS order and defaults
-            feature_values = [
-                features.get(name, default)
-                for name, default in ML_FEATURE_COLUMNS.items()
-            ]
-            X.append(feature_values)
-            y.append(target)
-        except:
+            # Convert to vector using ML_FEATURE_COLUMNS order and defaults
+            X[n] = featurize(json.loads(features_json))
+            y[n] = target
+            n += 1
+        except Exception:
             continue
 
-    logger.info(f"ML training data for {bet_category}: {len(X)} samples, {len(feature_names)} features")
+    X, y = X[:n], y[:n]
+    logger.info(f"ML training data for {bet_category}: {n} samples ({len(blob_rows)} packed), {ML_FEATURE_COUNT} features")
     return X, y
 
 
@@ -6665,10 +7145,7 @@ def features_to_vector(features: dict) -> list:
 
     Used for predictions - ensures same order as training.
     """
-    return [
-        features.get(name, default)
-        for name, default in ML_FEATURE_COLUMNS.items()
-    ]
+    return featurize(features).tolist()
 
 
 def train_ml_model(bet_category: str) -> Optional[dict]:
@@ -6680,7 +7157,7 @@ def train_ml_model(bet_category: str) -> Optional[dict]:
     X, y = get_ml_training_data(bet_category)
 
     if X is None or len(X) < ML_MIN_SAMPLES:
-        logger.info(f"Not enough data for {bet_category}: {len(X) if X else 0} samples")
+        logger.info(f"Not enough data for {bet_category}: {len(X) if X is not None else 0} samples")
         return None
 
     # Create models directory
@@ -6688,12 +7165,12 @@ def train_ml_model(bet_category: str) -> Optional[dict]:
 
     # Split data
     X_train, X_test, y_train, y_test = train_test_split(
-        np.array(X), np.array(y), test_size=0.2, random_state=42
+        X, y, test_size=0.2, random_state=42
     )
 
-    # Train model (Gradient Boosting works well for tabular data)
-    model = GradientBoostingClassifier(
-        n_estimators=100,
+    # Train model (histogram-based Gradient Boosting: same family, much faster fit/predict)
+    model = HistGradientBoostingClassifier(
+        max_iter=100,
         max_depth=5,
         learning_rate=0.1,
         random_state=42
@@ -6728,13 +7205,23 @@ def train_ml_model(bet_category: str) -> Optional[dict]:
 
 
 def train_all_models():
-    """Train models for all bet categories with enough data"""
+    """Train models for all bet categories with enough data (categories in parallel)"""
     categories = ["outcomes_home", "outcomes_away", "outcomes_draw",
                   "totals_over", "totals_under", "btts"]
 
+    if not ML_AVAILABLE:
+        return {}
+
+    # Threads: fits release the GIL, and workers share the already-imported module/DB setup.
+    # One OpenMP thread per fit, so parallel fits don't oversubscribe the CPU.
+    n_jobs = min(len(categories), os.cpu_count() or 1)
+    with threadpool_limits(1):
+        trained = joblib.Parallel(n_jobs=n_jobs, prefer="threads")(
+            joblib.delayed(train_ml_model)(cat) for cat in categories
+        )
+
     results = {}
-    for cat in categories:
-        result = train_ml_model(cat)
+    for cat, result in zip(categories, trained):
         if result:
             results[cat] = result
 
@@ -6742,7 +7229,7 @@ def train_all_models():
 
 
 async def train_all_models_async(progress_callback=None):
-    """Train models for all bet categories with progress updates.
+    """Train models for all bet categories concurrently with progress updates.
 
     Args:
         progress_callback: async function(category, status, result) for progress updates
@@ -6758,55 +7245,74 @@ async def train_all_models_async(progress_callback=None):
         ("totals_under", "ТМ 2.5 (тотал меньше)"),
         ("btts", "ОЗ (обе забьют)")
     ]
+    total = len(categories)
 
-    results = {}
-
-    for i, (cat_code, cat_name) in enumerate(categories):
-        # Notify progress - starting category
-        if progress_callback:
-            await progress_callback(cat_name, "training", None, i + 1, len(categories))
-
+    async def train_one(cat_code: str, cat_name: str):
         # Run training in thread pool to avoid blocking event loop
         result = await asyncio.to_thread(train_ml_model, cat_code)
+        return cat_code, cat_name, result
 
-        if result:
-            results[cat_code] = result
-            if progress_callback:
-                await progress_callback(cat_name, "done", result, i + 1, len(categories))
-        else:
-            if progress_callback:
-                await progress_callback(cat_name, "no_data", None, i + 1, len(categories))
+    # Notify progress - all categories start at once
+    if progress_callback:
+        for cat_code, cat_name in categories:
+            await progress_callback(cat_name, "training", None, 0, total)
+
+    results = {}
+    completed = 0
+
+    # One OpenMP thread per fit while all categories train at once
+    with threadpool_limits(1) if ML_AVAILABLE else nullcontext():
+        for next_done in asyncio.as_completed([train_one(code, name) for code, name in categories]):
+            cat_code, cat_name, result = await next_done
+            completed += 1
+
+            if result:
+                results[cat_code] = result
+                if progress_callback:
+                    await progress_callback(cat_name, "done", result, completed, total)
+            else:
+                if progress_callback:
+                    await progress_callback(cat_name, "no_data", None, completed, total)
 
     return results
 
 
-def ml_predict(features: dict, bet_category: str) -> Optional[dict]:
-    """Get ML prediction for a bet category.
+# Loaded per-category models: model_path -> (mtime, model)
+_ml_models: dict = {}
 
-    Uses features_to_vector() for consistent feature ordering with training.
-    """
-    if not ML_AVAILABLE:
-        return None
 
+def _load_ml_model(model_path: str):
+    """Load model from disk once per process; reloads only when the file changes (retrain)."""
+    mtime = os.path.getmtime(model_path)
+    cached = _ml_models.get(model_path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    model = joblib.load(model_path)
+    _ml_models[model_path] = (mtime, model)
+    return model
+
+
+ML_PREDICTION_CATEGORIES = ("outcomes_home", "outcomes_away", "outcomes_draw",
+                            "totals_over", "totals_under", "btts")
+
+
+def _ml_predict_vector(X, bet_category: str) -> Optional[dict]:
+    """Run category model on an already featurized (1, n_features) array."""
     model_path = os.path.join(ML_MODELS_DIR, f"model_{bet_category}.pkl")
 
     if not os.path.exists(model_path):
         return None
 
     try:
-        model = joblib.load(model_path)
+        model = _load_ml_model(model_path)
 
-        # Convert features to array using consistent ML_FEATURE_COLUMNS order
-        feature_values = features_to_vector(features)
-        X = np.array([feature_values])
-
-        # Get probability
+        # One pass over the trees: predict() is classes_[argmax(predict_proba)]
         proba = model.predict_proba(X)[0]
-        prediction = model.predict(X)[0]
+        best = int(proba.argmax())
 
         return {
-            "prediction": int(prediction),
-            "confidence": float(max(proba) * 100),
+            "prediction": int(model.classes_[best]),
+            "confidence": float(proba[best] * 100),
             "probabilities": {
                 "win": float(proba[1]) if len(proba) > 1 else float(proba[0]),
                 "lose": float(proba[0]) if len(proba) > 1 else 0
@@ -6817,30 +7323,44 @@ def ml_predict(features: dict, bet_category: str) -> Optional[dict]:
         return None
 
 
-def get_all_ml_predictions(features: dict) -> dict:
-    """Get ML predictions for all available bet types"""
-    predictions = {}
+def ml_predict(features: dict, bet_category: str) -> Optional[dict]:
+    """Get ML prediction for a bet category.
+
+    Uses featurize() for consistent feature ordering with training.
+    """
+    if not ML_AVAILABLE:
+        return None
+
+    return get_all_ml_predictions(features, (bet_category,)).get(bet_category)
 
-    # Outcomes
-    for cat in ["outcomes_home", "outcomes_away", "outcomes_draw"]:
-        pred = ml_predict(features, cat)
-        if pred:
-            predictions[cat] = pred
 
-    # Totals
-    for cat in ["totals_over", "totals_under"]:
-        pred = ml_predict(features, cat)
+def get_all_ml_predictions(features: dict, categories: tuple = ML_PREDICTION_CATEGORIES) -> dict:
+    """Get ML predictions for all available bet types (features vectorized once)"""
+    if not ML_AVAILABLE:
+        return {}
+
+    try:
+        # Convert features to array using consistent ML_FEATURE_COLUMNS order
+        X = featurize(features).reshape(1, -1)
+    except (TypeError, ValueError) as e:
+        logger.error(f"ML prediction error: {e}")
+        return {}
+
+    predictions = {}
+    for cat in categories:
+        pred = _ml_predict_vector(X, cat)
         if pred:
             predictions[cat] = pred
 
-    # BTTS
-    pred = ml_predict(features, "btts")
-    if pred:
-        predictions["btts"] = pred
-
     return predictions
 
 
+def _compute_ml_predictions(**feature_kwargs) -> tuple:
+    """extract_features + get_all_ml_predictions for one match (CPU-bound, run via to_thread)."""
+    ml_features = extract_features(**feature_kwargs)
+    return ml_features, get_all_ml_predictions(ml_features)
+
+
 def apply_ml_correction(bet_type: str, claude_confidence: int, ml_features: dict) -> tuple:
     """Apply ML correction to Claude's confidence.
 
@@ -8807,43 +9327,82 @@ def get_personalized_advice(user_id: int, bet_category: str, lang: str = "ru") -
     return None
 
 
+STATS_BET_CATEGORIES = ("totals_over", "totals_under", "outcomes_home", "outcomes_away", "outcomes_draw",
+                        "btts", "double_chance", "handicap", "other")
+
+
 def get_user_stats(user_id, page: int = 0, per_page: int = 7):
     """Get user's prediction statistics with categories and pagination"""
-    conn = get_db_connection()
-    c = conn.cursor()
-
-    c.execute("SELECT COUNT(*) FROM predictions WHERE user_id = ?", (user_id,))
-    total = c.fetchone()[0]
+    offset = page * per_page
+    with ro_cursor() as c:
+        # All counters in one pass over the user's predictions (per category,
+        # conditional aggregation) - totals are summed in Python
+        c.execute("""SELECT
+                        bet_category,
+                        COUNT(*),
+                        SUM(is_correct = 1),
+                        SUM(is_correct = 0),
+                        SUM(is_correct = 2),
+                        SUM(is_correct IS NOT NULL),
+                        SUM(bet_rank = 1 OR bet_rank IS NULL),
+                        SUM((bet_rank = 1 OR bet_rank IS NULL) AND is_correct = 1),
+                        SUM((bet_rank = 1 OR bet_rank IS NULL) AND is_correct IS NOT NULL AND is_correct != 2),
+                        SUM(bet_rank > 1),
+                        SUM(bet_rank > 1 AND is_correct = 1),
+                        SUM(bet_rank > 1 AND is_correct IS NOT NULL AND is_correct != 2)
+                     FROM predictions
+                     WHERE user_id = ?
+                     GROUP BY bet_category""", (user_id,))
+        grouped = c.fetchall()
+
+        # Recent predictions with pagination (all bets shown, no ALT marker in display);
+        # short team names, emoji and result text come ready for stats_cmd
+        c.execute("""SELECT home_team, away_team, bet_type, confidence, result, is_correct, predicted_at, bet_rank,
+                            CASE WHEN LENGTH(home_team) > 12 THEN SUBSTR(home_team, 1, 10) || '..'
+                                 ELSE home_team END,
+                            CASE WHEN LENGTH(away_team) > 12 THEN SUBSTR(away_team, 1, 10) || '..'
+                                 ELSE away_team END,
+                            CASE WHEN is_correct IS NULL THEN '⏳'
+                                 WHEN is_correct = 1 THEN '✅'
+                                 WHEN is_correct = 2 THEN '🔄'
+                                 ELSE '❌' END,
+                            CASE WHEN is_correct IS NULL THEN 'ожидаем'
+                                 WHEN is_correct = 1 THEN COALESCE(NULLIF(result, ''), 'выиграл')
+                                 WHEN is_correct = 2 THEN COALESCE(result || ' (возврат)', 'возврат')
+                                 ELSE COALESCE(NULLIF(result, ''), 'проиграл') END
+                     FROM predictions
+                     WHERE user_id = ?
+                     ORDER BY predicted_at DESC
+                     LIMIT ? OFFSET ?""", (user_id, per_page, offset))
+        recent = c.fetchall()
+
+    total = correct = incorrect = push = checked = 0
+    # Stats by bet_rank (main vs alternatives)
+    main_stats = {"total": 0, "correct": 0, "decided": 0}
+    alt_stats = {"total": 0, "correct": 0, "decided": 0}
+    by_category = {}
+    for row in grouped:
+        cat = row[0]
+        cat_total, cat_correct, cat_incorrect, cat_push, cat_checked = (v or 0 for v in row[1:6])
+        total += cat_total
+        correct += cat_correct
+        incorrect += cat_incorrect
+        push += cat_push
+        checked += cat_checked
+        main_stats["total"] += row[6] or 0
+        main_stats["correct"] += row[7] or 0
+        main_stats["decided"] += row[8] or 0
+        alt_stats["total"] += row[9] or 0
+        alt_stats["correct"] += row[10] or 0
+        alt_stats["decided"] += row[11] or 0
+        by_category[cat] = (cat_checked, cat_correct, cat_push)
 
-    # Total predictions count is already in 'total' variable
-    
-    c.execute("SELECT COUNT(*) FROM predictions WHERE user_id = ? AND is_correct = 1", (user_id,))
-    correct = c.fetchone()[0]
-    
-    c.execute("SELECT COUNT(*) FROM predictions WHERE user_id = ? AND is_correct = 0", (user_id,))
-    incorrect = c.fetchone()[0]
-    
-    c.execute("SELECT COUNT(*) FROM predictions WHERE user_id = ? AND is_correct = 2", (user_id,))
-    push = c.fetchone()[0]
-    
-    c.execute("SELECT COUNT(*) FROM predictions WHERE user_id = ? AND is_correct IS NOT NULL", (user_id,))
-    checked = c.fetchone()[0]
-    
     # Stats by category (excluding push from win rate calculation)
     categories = {}
-    for cat in ["totals_over", "totals_under", "outcomes_home", "outcomes_away", "outcomes_draw", 
-                "btts", "double_chance", "handicap", "other"]:
-        c.execute("""SELECT 
-                        COUNT(*),
-                        SUM(CASE WHEN is_correct = 1 THEN 1 ELSE 0 END),
-                        SUM(CASE WHEN is_correct = 2 THEN 1 ELSE 0 END)
-                     FROM predictions 
-                     WHERE user_id = ? AND bet_category = ? AND is_correct IS NOT NULL""", 
-                  (user_id, cat))
-        row = c.fetchone()
-        cat_total = row[0] or 0
-        cat_correct = row[1] or 0
-        cat_push = row[2] or 0
+    for cat in STATS_BET_CATEGORIES:
+        if cat not in by_category:
+            continue
+        cat_total, cat_correct, cat_push = by_category[cat]
         # Calculate rate excluding pushes
         cat_decided = cat_total - cat_push
         if cat_decided > 0:
@@ -8853,39 +9412,6 @@ def get_user_stats(user_id, page: int = 0, per_page: int = 7):
                 "push": cat_push,
                 "rate": round(cat_correct / cat_decided * 100, 1)
             }
-    
-    # Recent predictions with pagination (all bets shown, no ALT marker in display)
-    offset = page * per_page
-    c.execute("""SELECT home_team, away_team, bet_type, confidence, result, is_correct, predicted_at, bet_rank
-                 FROM predictions
-                 WHERE user_id = ?
-                 ORDER BY predicted_at DESC
-                 LIMIT ? OFFSET ?""", (user_id, per_page, offset))
-    recent = c.fetchall()
-
-    # Stats by bet_rank (main vs alternatives)
-    main_stats = {"total": 0, "correct": 0, "decided": 0}
-    alt_stats = {"total": 0, "correct": 0, "decided": 0}
-
-    c.execute("""SELECT
-                    COUNT(*),
-                    SUM(CASE WHEN is_correct = 1 THEN 1 ELSE 0 END),
-                    SUM(CASE WHEN is_correct IS NOT NULL AND is_correct != 2 THEN 1 ELSE 0 END)
-                 FROM predictions
-                 WHERE user_id = ? AND (bet_rank = 1 OR bet_rank IS NULL)""", (user_id,))
-    row = c.fetchone()
-    main_stats = {"total": row[0] or 0, "correct": row[1] or 0, "decided": row[2] or 0}
-
-    c.execute("""SELECT
-                    COUNT(*),
-                    SUM(CASE WHEN is_correct = 1 THEN 1 ELSE 0 END),
-                    SUM(CASE WHEN is_correct IS NOT NULL AND is_correct != 2 THEN 1 ELSE 0 END)
-                 FROM predictions
-                 WHERE user_id = ? AND bet_rank > 1""", (user_id,))
-    row = c.fetchone()
-    alt_stats = {"total": row[0] or 0, "correct": row[1] or 0, "decided": row[2] or 0}
-
-    conn.close()
 
     predictions = []
     for r in recent:
@@ -8897,7 +9423,11 @@ def get_user_stats(user_id, page: int = 0, per_page: int = 7):
             "result": r[4],
             "is_correct": r[5],
             "date": r[6],
-            "bet_rank": r[7] if len(r) > 7 else 1
+            "bet_rank": r[7],
+            "home_short": r[8],
+            "away_short": r[9],
+            "emoji": r[10],
+            "result_text": r[11]
         })
 
     # Win rate excluding pushes
@@ -8932,9 +9462,77 @@ def get_user_stats(user_id, page: int = 0, per_page: int = 7):
 
 # ===== CLAUDE PARSER =====
 
+# Rule-based fast path: messages matching these are classified locally,
+# everything else goes to Claude.
+_QUERY_GREETINGS = frozenset({
+    "привет", "приветствую", "здравствуй", "здравствуйте", "хай", "салют", "ку",
+    "hi", "hello", "hey", "hola", "buenos dias", "olá", "ola", "halo",
+})
+_QUERY_KEYWORD_INTENTS = {
+    "today": "today", "сегодня": "today", "матчи сегодня": "today", "hoy": "today", "hoje": "today",
+    "tomorrow": "tomorrow", "завтра": "tomorrow", "матчи завтра": "tomorrow",
+    "mañana": "tomorrow", "amanhã": "tomorrow",
+    "help": "help", "помощь": "help", "ayuda": "help", "ajuda": "help",
+    "settings": "settings", "настройки": "settings",
+    "stats": "stats", "статистика": "stats",
+    "favorites": "favorites", "избранное": "favorites",
+}
+_LEAGUE_MAP = {
+    "немецкая лига": "BL1", "бундеслига": "BL1", "bundesliga": "BL1",
+    "английская лига": "PL", "premier league": "PL", "апл": "PL",
+    "испанская лига": "PD", "la liga": "PD", "ла лига": "PD",
+    "итальянская лига": "SA", "serie a": "SA", "серия а": "SA",
+    "французская лига": "FL1", "ligue 1": "FL1", "лига 1": "FL1",
+    "лига чемпионов": "CL", "champions league": "CL", "лч": "CL",
+    "бразильская лига": "BSA", "brasileirão": "BSA", "brasileirao": "BSA",
+}
+_LEAGUE_RE = re.compile(r"(?<!\w)(" + "|".join(
+    re.escape(k) for k in sorted(_LEAGUE_MAP, key=len, reverse=True)) + r")(?!\w)")
+_KNOWN_TEAMS = {name.lower(): name for name in (*UNDERSTAT_TEAM_NAMES.values(), *TOP_CLUBS)
+                if len(name) >= 4}
+_KNOWN_TEAM_RE = re.compile(r"(?<!\w)(" + "|".join(
+    re.escape(k) for k in sorted(_KNOWN_TEAMS, key=len, reverse=True)) + r")(?!\w)")
+_VERSUS_RE = re.compile(r"^(.{3,}?)\s+(?:vs\.?|v|против|-|—)\s+(.{3,})$")
+
+
+def _parse_user_query_fast(user_message: str) -> Optional[dict]:
+    """Classify obvious messages without Claude. Returns None when ambiguous."""
+    msg = " ".join(user_message.lower().split()).strip(" !?.,")
+    if not msg:
+        return None
+    if msg in _QUERY_GREETINGS:
+        return {"intent": "greeting", "teams": [], "league": None}
+    intent = _QUERY_KEYWORD_INTENTS.get(msg)
+    if intent:
+        return {"intent": intent, "teams": [], "league": None}
+
+    league_match = _LEAGUE_RE.search(msg)
+    league = _LEAGUE_MAP[league_match.group(1)] if league_match else None
+
+    # "X vs Y" with Latin names can go straight to find_match; other scripts
+    # need Claude to translate them to the API's team names. One side must be
+    # a known team, so ordinary text like "best bets - today" is not a match.
+    versus = _VERSUS_RE.match(msg)
+    if versus:
+        sides = (versus.group(1).strip(), versus.group(2).strip())
+        if (any(t in _KNOWN_TEAMS for t in sides)
+                and all(t in _KNOWN_TEAMS or t.isascii() for t in sides)):
+            teams = [_KNOWN_TEAMS.get(t, t) for t in sides]
+            return {"intent": "team_search", "teams": teams, "league": league}
+
+    teams = list(dict.fromkeys(_KNOWN_TEAMS[t] for t in _KNOWN_TEAM_RE.findall(msg)))
+    if teams:
+        return {"intent": "team_search", "teams": teams, "league": league}
+    return None
+
+
 def parse_user_query(user_message):
-    """Parse user query with Claude"""
-    
+    """Parse user query: local rules first, Claude for anything ambiguous"""
+
+    fast = _parse_user_query_fast(user_message)
+    if fast is not None:
+        return fast
+
     if not claude_client:
         return {"intent": "team_search", "teams": [user_message]}
     
@@ -8996,6 +9594,84 @@ Return ONLY valid JSON, no explanation."""
 
 # ===== FOOTBALL DATA API =====
 
+# Per-competition matches cache: (code, dateFrom, dateTo, status) -> {data, etag, last_modified, updated_at}
+# Stale entries are kept for ETag revalidation; windows that started before today
+# are dropped on insert, and beyond COMPETITION_MATCHES_CACHE_MAX the oldest go first.
+COMPETITION_MATCHES_CACHE_MAX = 256
+competition_matches_cache: dict = {}
+
+
+def _store_competition_matches(cache_key: tuple, entry: dict) -> None:
+    today = datetime.now().strftime("%Y-%m-%d")
+    for key in [k for k in competition_matches_cache if k[1] < today]:
+        del competition_matches_cache[key]
+    competition_matches_cache.pop(cache_key, None)
+    while len(competition_matches_cache) >= COMPETITION_MATCHES_CACHE_MAX:
+        del competition_matches_cache[next(iter(competition_matches_cache))]
+    competition_matches_cache[cache_key] = entry
+
+# Match statuses kept by get_matches (upcoming only)
+_UPCOMING_STATUSES = frozenset({"SCHEDULED", "TIMED"})
+
+async def _fetch_competition_matches(session: aiohttp.ClientSession, code: str, headers: dict,
+                                     params: dict, use_cache: bool = True) -> list[dict]:
+    """Fetch upcoming matches for one competition.
+
+    Fresh cache entries (matches_cache TTL) are returned without a request;
+    stale ones are revalidated with If-None-Match / If-Modified-Since, and a
+    304 reuses the cached list without parsing a body. Requests go through
+    football_api_get (rate bucket + AIMD limiter); 429 is retried after
+    Retry-After (or with exponential backoff).
+    """
+    cache_key = (code, params["dateFrom"], params["dateTo"], params["status"])
+    cached = competition_matches_cache.get(cache_key)
+    if (use_cache and cached and
+            (datetime.now() - cached["updated_at"]).total_seconds() < matches_cache["ttl_seconds"]):
+        return list(cached["data"])
+
+    request_headers = dict(headers)
+    if cached:
+        if cached.get("etag"):
+            request_headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            request_headers["If-Modified-Since"] = cached["last_modified"]
+
+    url = f"{FOOTBALL_API_URL}/competitions/{code}/matches"
+    backoff = 6
+    try:
+        for attempt in range(3):
+            async with football_api_get(session, url, headers=request_headers, params=params) as r:
+                if r.status == 304 and cached:
+                    cached["updated_at"] = datetime.now()
+                    logger.info(f"Not modified: {len(cached['data'])} from {code} (cached)")
+                    return list(cached["data"])
+                if r.status == 200:
+                    # Parse the raw body directly (skips aiohttp's str decode copy)
+                    matches = json.loads(await r.read()).get("matches", [])
+                    matches = [m for m in matches if m.get("status") in _UPCOMING_STATUSES]
+                    _store_competition_matches(cache_key, {
+                        "data": matches,
+                        "etag": r.headers.get("ETag"),
+                        "last_modified": r.headers.get("Last-Modified"),
+                        "updated_at": datetime.now(),
+                    })
+                    logger.info(f"Got {len(matches)} from {code}")
+                    return list(matches)
+                if r.status == 429 and attempt < 2:
+                    retry_after = r.headers.get("Retry-After", "")
+                    wait = int(retry_after) if retry_after.isdigit() else backoff
+                    logger.warning(f"Rate limit hit at {code}, waiting {wait}s...")
+                    await asyncio.sleep(wait)
+                    backoff *= 2
+                    continue
+                text = await r.text()
+                logger.error(f"API error {r.status} for {code}: {text[:100]}")
+                break
+    except Exception as e:
+        logger.error(f"Error getting matches for {code}: {e}")
+    return []
+
+
 async def get_matches(competition: Optional[str] = None, date_filter: Optional[str] = None,
                       days: int = 7, use_cache: bool = True) -> list[dict]:
     """Get matches from Football Data API - only upcoming matches (ASYNC)"""
@@ -9003,98 +9679,91 @@ async def get_matches(competition: Optional[str] = None, date_filter: Optional[s
         return []
 
     headers = {"X-Auth-Token": FOOTBALL_API_KEY}
+    now = datetime.now()
 
     # Check cache
     if use_cache and not competition and not date_filter and days == 7:
         if (matches_cache["updated_at"] and
-            (datetime.now() - matches_cache["updated_at"]).total_seconds() < matches_cache["ttl_seconds"]):
+            (now - matches_cache["updated_at"]).total_seconds() < matches_cache["ttl_seconds"]):
             logger.info(f"Using cached matches: {len(matches_cache['data'])} matches")
             return matches_cache["data"]
 
     if date_filter == "today":
-        date_from = datetime.now().strftime("%Y-%m-%d")
+        date_from = now.strftime("%Y-%m-%d")
         date_to = date_from
     elif date_filter == "tomorrow":
-        tomorrow = datetime.now() + timedelta(days=1)
-        date_from = tomorrow.strftime("%Y-%m-%d")
+        date_from = (now + timedelta(days=1)).strftime("%Y-%m-%d")
         date_to = date_from
     else:
-        date_from = datetime.now().strftime("%Y-%m-%d")
-        date_to = (datetime.now() + timedelta(days=days)).strftime("%Y-%m-%d")
+        date_from = now.strftime("%Y-%m-%d")
+        date_to = (now + timedelta(days=days)).strftime("%Y-%m-%d")
 
     # Only get SCHEDULED matches (not finished)
     params = {"dateFrom": date_from, "dateTo": date_to, "status": "SCHEDULED"}
     session = await get_http_session()
 
     if competition:
-        try:
-            url = f"{FOOTBALL_API_URL}/competitions/{competition}/matches"
-            async with session.get(url, headers=headers, params=params) as r:
-                if r.status == 200:
-                    data = await r.json()
-                    matches = data.get("matches", [])
-                    matches = [m for m in matches if m.get("status") in ["SCHEDULED", "TIMED"]]
-                    logger.info(f"Got {len(matches)} from {competition}")
-                    return matches
-                elif r.status == 429:
-                    logger.warning(f"Rate limit hit for {competition}, waiting...")
-                    await asyncio.sleep(6)
-                    async with session.get(url, headers=headers, params=params) as r2:
-                        if r2.status == 200:
-                            data = await r2.json()
-                            matches = data.get("matches", [])
-                            return [m for m in matches if m.get("status") in ["SCHEDULED", "TIMED"]]
-                else:
-                    text = await r.text()
-                    logger.error(f"API error {r.status} for {competition}: {text[:100]}")
-        except Exception as e:
-            logger.error(f"Error getting matches for {competition}: {e}")
-        return []
+        return await _fetch_competition_matches(session, competition, headers, params, use_cache)
 
     # Get from all leagues with rate limit awareness (Standard plan = 25 leagues, 60 req/min)
-    all_matches = []
-    leagues = list(COMPETITIONS.keys())
+    # Up to 8 in flight; acquire_api_token keeps the overall rate under the plan limit
+    by_competition = await get_matches_multi(COMPETITIONS.keys(), date_filter=date_filter,
+                                             days=days, use_cache=use_cache, concurrency=8)
+    all_matches = [m for matches in by_competition.values() for m in matches]
 
-    for code in leagues:
-        try:
-            url = f"{FOOTBALL_API_URL}/competitions/{code}/matches"
-            async with session.get(url, headers=headers, params=params) as r:
-                if r.status == 200:
-                    data = await r.json()
-                    matches = data.get("matches", [])
-                    matches = [m for m in matches if m.get("status") in ["SCHEDULED", "TIMED"]]
-                    all_matches.extend(matches)
-                    logger.info(f"Got {len(matches)} from {code}")
-                elif r.status == 429:
-                    logger.warning(f"Rate limit hit at {code}, waiting 6s...")
-                    await asyncio.sleep(6)
-                    async with session.get(url, headers=headers, params=params) as r2:
-                        if r2.status == 200:
-                            data = await r2.json()
-                            matches = data.get("matches", [])
-                            matches = [m for m in matches if m.get("status") in ["SCHEDULED", "TIMED"]]
-                            all_matches.extend(matches)
-                            logger.info(f"Retry got {len(matches)} from {code}")
-                else:
-                    text = await r.text()
-                    logger.error(f"API error {r.status} for {code}: {text[:100]}")
-
-            await asyncio.sleep(0.3)
-            
-        except Exception as e:
-            logger.error(f"Error: {e}")
-    
     logger.info(f"Total: {len(all_matches)} upcoming matches")
     
     # Update cache
     if not competition and not date_filter:
         matches_cache["data"] = all_matches
+        matches_cache["index"] = build_match_index(all_matches)
         matches_cache["updated_at"] = datetime.now()
         logger.info("Matches cache updated")
     
     return all_matches
 
 
+@async_ttl_cache(ttl_seconds=60, maxsize=8)
+async def get_day_matches(date_filter: str) -> list[dict]:
+    """get_matches(date_filter=...) shared by every user asking within the same minute.
+
+    The returned list is shared between callers and must not be mutated.
+    """
+    return await get_matches(date_filter=date_filter)
+
+
+@async_ttl_cache(ttl_seconds=45, maxsize=4)
+async def get_upcoming_matches(days: int = 7) -> list[dict]:
+    """get_matches(days=...) for /recommend and /sure: concurrent and back-to-back
+    requests share one fetch. The returned list is shared and must not be mutated."""
+    return await get_matches(days=days)
+
+
+async def get_matches_multi(competitions, date_filter: Optional[str] = None, days: int = 7,
+                            use_cache: bool = True, concurrency: int = 4) -> dict[str, list[dict]]:
+    """Fetch several competitions concurrently over the shared HTTP session.
+
+    Returns {code: matches} in the order the competitions were given; a
+    competition whose fetch raised is logged and maps to [].
+    """
+    sem = asyncio.Semaphore(concurrency)
+    competitions = list(competitions)
+
+    async def one(code: str) -> list[dict]:
+        async with sem:
+            return await get_matches(code, date_filter=date_filter, days=days, use_cache=use_cache)
+
+    results = await asyncio.gather(*(one(c) for c in competitions), return_exceptions=True)
+    by_competition = {}
+    for code, result in zip(competitions, results):
+        if isinstance(result, BaseException):
+            logger.error(f"Error getting matches for {code}: {result}")
+            result = []
+        by_competition[code] = result
+    return by_competition
+
+
+@async_ttl_cache(ttl_seconds=6 * 3600, maxsize=64)
 async def get_standings(competition: str = "PL") -> Optional[dict]:
     """Get league standings with home/away stats (ASYNC)"""
     headers = {"X-Auth-Token": FOOTBALL_API_KEY}
@@ -9102,9 +9771,9 @@ async def get_standings(competition: str = "PL") -> Optional[dict]:
 
     try:
         url = f"{FOOTBALL_API_URL}/competitions/{competition}/standings"
-        async with session.get(url, headers=headers) as r:
+        async with football_api_get(session, url, headers=headers) as r:
             if r.status == 200:
-                data = await r.json()
+                data = json.loads(await r.read())
                 standings = data.get("standings", [])
 
                 result = {"total": [], "home": [], "away": []}
@@ -9119,6 +9788,7 @@ async def get_standings(competition: str = "PL") -> Optional[dict]:
     return None
 
 
+@async_ttl_cache(ttl_seconds=10 * 60, maxsize=512)
 async def get_team_form(team_id: int, limit: int = 5) -> Optional[dict]:
     """Get team's recent form (last N matches) (ASYNC)"""
     headers = {"X-Auth-Token": FOOTBALL_API_KEY}
@@ -9127,45 +9797,30 @@ async def get_team_form(team_id: int, limit: int = 5) -> Optional[dict]:
     try:
         url = f"{FOOTBALL_API_URL}/teams/{team_id}/matches"
         params = {"status": "FINISHED", "limit": limit}
-        async with session.get(url, headers=headers, params=params) as r:
+        async with football_api_get(session, url, headers=headers, params=params) as r:
             if r.status == 200:
-                data = await r.json()
+                data = json.loads(await r.read())
                 matches = data.get("matches", [])
 
                 form = []
+                tally = {"w": 0, "d": 0, "l": 0}
                 goals_scored = 0
                 goals_conceded = 0
 
-                for m in matches[:limit]:
-                    home_id = m.get("homeTeam", {}).get("id")
-                    score = m.get("score", {}).get("fullTime", {})
-                    home_goals = score.get("home", 0) or 0
-                    away_goals = score.get("away", 0) or 0
-
-                    if home_id == team_id:
-                        goals_scored += home_goals
-                        goals_conceded += away_goals
-                        if home_goals > away_goals:
-                            form.append("W")
-                        elif home_goals < away_goals:
-                            form.append("L")
-                        else:
-                            form.append("D")
-                    else:
-                        goals_scored += away_goals
-                        goals_conceded += home_goals
-                        if away_goals > home_goals:
-                            form.append("W")
-                        elif away_goals < home_goals:
-                            form.append("L")
-                        else:
-                            form.append("D")
+                for home_goals, away_goals, is_home in _team_match_goals(matches[:limit], team_id):
+                    team_goals = home_goals if is_home else away_goals
+                    opp_goals = away_goals if is_home else home_goals
+                    goals_scored += team_goals
+                    goals_conceded += opp_goals
+                    result = _RESULT_KEYS[(team_goals > opp_goals) - (team_goals < opp_goals)]
+                    tally[result] += 1
+                    form.append(result.upper())
 
                 return {
                     "form": "".join(form),
-                    "wins": form.count("W"),
-                    "draws": form.count("D"),
-                    "losses": form.count("L"),
+                    "wins": tally["w"],
+                    "draws": tally["d"],
+                    "losses": tally["l"],
                     "goals_scored": goals_scored,
                     "goals_conceded": goals_conceded,
                     "matches": matches[:limit]
@@ -9175,6 +9830,21 @@ async def get_team_form(team_id: int, limit: int = 5) -> Optional[dict]:
     return None
 
 
+# Sign of the goal difference -> tally key ("w" / "d" / "l")
+_RESULT_KEYS = {1: "w", 0: "d", -1: "l"}
+
+
+def _team_match_goals(matches: list, team_id: int = None) -> list:
+    """(home_goals, away_goals, team_is_home) per match, read once from score.fullTime."""
+    rows = []
+    for m in matches:
+        score = m.get("score", {}).get("fullTime", {})
+        rows.append((score.get("home") or 0, score.get("away") or 0,
+                     m.get("homeTeam", {}).get("id") == team_id))
+    return rows
+
+
+@async_ttl_cache(ttl_seconds=2 * 3600)
 async def get_h2h(match_id: int) -> Optional[dict]:
     """Get head-to-head history (ASYNC)"""
     headers = {"X-Auth-Token": FOOTBALL_API_KEY}
@@ -9183,46 +9853,32 @@ async def get_h2h(match_id: int) -> Optional[dict]:
     try:
         url = f"{FOOTBALL_API_URL}/matches/{match_id}/head2head"
         params = {"limit": 10}
-        async with session.get(url, headers=headers, params=params) as r:
+        async with football_api_get(session, url, headers=headers, params=params) as r:
             if r.status == 200:
-                data = await r.json()
+                data = json.loads(await r.read())
                 matches = data.get("matches", [])
                 aggregates = data.get("aggregates", {})
 
-                home_wins = 0
-                away_wins = 0
-                draws = 0
+                tally = {"w": 0, "d": 0, "l": 0}  # from the home side's perspective
                 total_goals = 0
                 btts_count = 0
                 over25_count = 0
 
-                for m in matches:
-                    score = m.get("score", {}).get("fullTime", {})
-                    home_goals = score.get("home", 0) or 0
-                    away_goals = score.get("away", 0) or 0
-
+                for home_goals, away_goals, _ in _team_match_goals(matches):
                     total_goals += home_goals + away_goals
-
                     if home_goals > 0 and away_goals > 0:
                         btts_count += 1
-
                     if home_goals + away_goals > 2.5:
                         over25_count += 1
-
-                    if home_goals > away_goals:
-                        home_wins += 1
-                    elif away_goals > home_goals:
-                        away_wins += 1
-                    else:
-                        draws += 1
+                    tally[_RESULT_KEYS[(home_goals > away_goals) - (home_goals < away_goals)]] += 1
 
                 num_matches = len(matches)
                 return {
                     "matches": matches,
                     "aggregates": aggregates,
-                    "home_wins": home_wins,
-                    "away_wins": away_wins,
-                    "draws": draws,
+                    "home_wins": tally["w"],
+                    "away_wins": tally["l"],
+                    "draws": tally["d"],
                     "avg_goals": total_goals / num_matches if num_matches > 0 else 0,
                     "btts_percent": btts_count / num_matches * 100 if num_matches > 0 else 0,
                     "over25_percent": over25_count / num_matches * 100 if num_matches > 0 else 0
@@ -9232,6 +9888,7 @@ async def get_h2h(match_id: int) -> Optional[dict]:
     return None
 
 
+@async_ttl_cache(ttl_seconds=30 * 60)
 async def get_team_form_enhanced(team_id: int, limit: int = 10, upcoming_match_date: datetime = None) -> Optional[dict]:
     """Get enhanced team form with home/away split and average goals.
 
@@ -9246,10 +9903,9 @@ async def get_team_form_enhanced(team_id: int, limit: int = 10, upcoming_match_d
     try:
         url = f"{FOOTBALL_API_URL}/teams/{team_id}/matches"
         params = {"status": "FINISHED", "limit": limit}
-        async with session.get(url, headers=headers, params=params) as r:
+        async with football_api_get(session, url, headers=headers, params=params) as r:
             if r.status == 200:
-                data = await r.json()
-                matches = data.get("matches", [])
+                matches = json.loads(await r.read()).get("matches", [])
 
                 # CRITICAL: Sort matches by date DESCENDING to get most recent first
                 # API doesn't guarantee order, so we must sort explicitly
@@ -9266,81 +9922,57 @@ async def get_team_form_enhanced(team_id: int, limit: int = 10, upcoming_match_d
                 over25_count = 0
 
                 # Rest days calculation - calculate days between last match and UPCOMING match
+                # (first match in list is most recent; later ones are used only
+                # when it has no usable date)
                 last_match_date = None
                 rest_days = None
-
                 for m in matches[:limit]:
-                    # Get last match date (first match in list is most recent)
-                    if last_match_date is None:
-                        match_date_str = m.get("utcDate", "")
-                        if match_date_str:
-                            try:
-                                last_match_date = datetime.fromisoformat(match_date_str.replace("Z", "+00:00"))
-                                # Calculate rest days to UPCOMING match, not to now
-                                if upcoming_match_date:
-                                    # Ensure both dates have timezone info
-                                    if upcoming_match_date.tzinfo is None:
-                                        upcoming_with_tz = upcoming_match_date.replace(tzinfo=timezone.utc)
-                                    else:
-                                        upcoming_with_tz = upcoming_match_date
-                                    rest_days = (upcoming_with_tz - last_match_date).days
-                                    logger.info(f"🔄 Team {team_id}: last match {last_match_date.date()}, upcoming {upcoming_with_tz.date()}, rest_days={rest_days}")
-                                else:
-                                    # Fallback to now if upcoming date not provided
-                                    rest_days = (datetime.now(last_match_date.tzinfo) - last_match_date).days
-                                    logger.warning(f"⚠️ Team {team_id}: no upcoming date provided, using now. last match {last_match_date.date()}, rest_days={rest_days}")
-                            except Exception as e:
-                                logger.warning(f"Rest days calculation error: {e}")
-                    home_id = m.get("homeTeam", {}).get("id")
-                    score = m.get("score", {}).get("fullTime", {})
-                    home_goals = score.get("home", 0) or 0
-                    away_goals = score.get("away", 0) or 0
+                    match_date_str = m.get("utcDate", "")
+                    if not match_date_str:
+                        continue
+                    try:
+                        last_match_date = datetime.fromisoformat(match_date_str.replace("Z", "+00:00"))
+                        # Calculate rest days to UPCOMING match, not to now
+                        if upcoming_match_date:
+                            # Ensure both dates have timezone info
+                            if upcoming_match_date.tzinfo is None:
+                                upcoming_with_tz = upcoming_match_date.replace(tzinfo=timezone.utc)
+                            else:
+                                upcoming_with_tz = upcoming_match_date
+                            rest_days = (upcoming_with_tz - last_match_date).days
+                            logger.info(f"🔄 Team {team_id}: last match {last_match_date.date()}, upcoming {upcoming_with_tz.date()}, rest_days={rest_days}")
+                        else:
+                            # Fallback to now if upcoming date not provided
+                            rest_days = (datetime.now(last_match_date.tzinfo) - last_match_date).days
+                            logger.warning(f"⚠️ Team {team_id}: no upcoming date provided, using now. last match {last_match_date.date()}, rest_days={rest_days}")
+                    except Exception as e:
+                        logger.warning(f"Rest days calculation error: {e}")
+                    if last_match_date is not None:
+                        break
 
+                for home_goals, away_goals, is_home in _team_match_goals(matches[:limit], team_id):
                     # BTTS and totals
                     if home_goals > 0 and away_goals > 0:
                         btts_count += 1
                     if home_goals + away_goals > 2.5:
                         over25_count += 1
 
-                    is_home = (home_id == team_id)
                     team_goals = home_goals if is_home else away_goals
                     opp_goals = away_goals if is_home else home_goals
+                    result = _RESULT_KEYS[(team_goals > opp_goals) - (team_goals < opp_goals)]
 
                     # Overall
                     overall["gf"] += team_goals
                     overall["ga"] += opp_goals
-
-                    if team_goals > opp_goals:
-                        overall["w"] += 1
-                        overall["form"].append("W")
-                    elif team_goals < opp_goals:
-                        overall["l"] += 1
-                        overall["form"].append("L")
-                    else:
-                        overall["d"] += 1
-                        overall["form"].append("D")
+                    overall[result] += 1
+                    overall["form"].append(result.upper())
 
                     # Home/Away split
-                    if is_home:
-                        home["matches"] += 1
-                        home["gf"] += team_goals
-                        home["ga"] += opp_goals
-                        if team_goals > opp_goals:
-                            home["w"] += 1
-                        elif team_goals < opp_goals:
-                            home["l"] += 1
-                        else:
-                            home["d"] += 1
-                    else:
-                        away["matches"] += 1
-                        away["gf"] += team_goals
-                        away["ga"] += opp_goals
-                        if team_goals > opp_goals:
-                            away["w"] += 1
-                        elif team_goals < opp_goals:
-                            away["l"] += 1
-                        else:
-                            away["d"] += 1
+                    split = home if is_home else away
+                    split["matches"] += 1
+                    split["gf"] += team_goals
+                    split["ga"] += opp_goals
+                    split[result] += 1
 
                 num_matches = len(matches[:limit])
                 home_matches = home["matches"] or 1
@@ -10287,9 +10919,9 @@ async def get_coach_from_api(team_id: int, team_name: str) -> Optional[dict]:
 
     try:
         url = f"{FOOTBALL_API_URL}/teams/{team_id}"
-        async with session.get(url, headers=headers) as r:
+        async with football_api_get(session, url, headers=headers) as r:
             if r.status == 200:
-                data = await r.json()
+                data = json.loads(await r.read())
                 coach_data = data.get("coach")
 
                 if not coach_data:
@@ -10803,7 +11435,7 @@ def is_elite_team(team_name: str) -> bool:
     if not team_name:
         return False
     team_lower = team_name.lower()
-    return any(club.lower() in team_lower or team_lower in club.lower() for club in TOP_CLUBS)
+    return any(club in team_lower or team_lower in club for club in _TOP_CLUBS_LOWER)
 
 
 def calculate_team_class(team_name: str, position: int, total_teams: int = 20) -> int:
@@ -10976,6 +11608,7 @@ def format_team_class_context(class_analysis: dict, home_team: str, away_team: s
     return context
 
 
+@async_ttl_cache(ttl_seconds=6 * 3600)
 async def get_top_scorers(competition: str = "PL", limit: int = 10) -> Optional[list]:
     """Get top scorers of the competition (Standard plan feature)"""
     headers = {"X-Auth-Token": FOOTBALL_API_KEY}
@@ -10984,9 +11617,9 @@ async def get_top_scorers(competition: str = "PL", limit: int = 10) -> Optional[
     try:
         url = f"{FOOTBALL_API_URL}/competitions/{competition}/scorers"
         params = {"limit": limit}
-        async with session.get(url, headers=headers, params=params) as r:
+        async with football_api_get(session, url, headers=headers, params=params) as r:
             if r.status == 200:
-                data = await r.json()
+                data = json.loads(await r.read())
                 scorers = data.get("scorers", [])
 
                 return [{
@@ -11025,10 +11658,88 @@ def calculate_value_bet(confidence: float, odds: float) -> dict:
     }
 
 
+# Human-readable category names for get_bot_accuracy_stats
+_CATEGORY_NAMES = {
+    "totals_over": "ТБ (Тотал больше)",
+    "totals_under": "ТМ (Тотал меньше)",
+    "outcomes_home": "П1 (Победа хозяев)",
+    "outcomes_away": "П2 (Победа гостей)",
+    "outcomes_draw": "Ничья (X)",
+    "btts": "ОЗ (Обе забьют)",
+    "double_chance": "Двойной шанс",
+    "handicap": "Фора",
+    "other": "Другое"
+}
+
+# Category names for the ML block of the analysis prompt
+ML_CATEGORY_NAMES = {
+    "outcomes_home": "П1 (победа хозяев)",
+    "outcomes_away": "П2 (победа гостей)",
+    "outcomes_draw": "Ничья",
+    "totals_over": "ТБ 2.5",
+    "totals_under": "ТМ 2.5",
+    "btts": "Обе забьют"
+}
+
+# Short category names for stats_cmd
+STATS_CATEGORY_NAMES = {
+    "totals_over": "ТБ 2.5",
+    "totals_under": "ТМ 2.5",
+    "outcomes_home": "П1",
+    "outcomes_away": "П2",
+    "outcomes_draw": "Ничья",
+    "btts": "Обе забьют",
+    "double_chance": "Двойной шанс",
+    "handicap": "Форы",
+    "other": "Другое"
+}
+
+# Short category names for mlstatus_cmd
+MLSTATUS_CATEGORY_NAMES = {
+    "outcomes_home": "П1",
+    "outcomes_away": "П2",
+    "outcomes_draw": "Ничья",
+    "totals_over": "ТБ 2.5",
+    "totals_under": "ТМ 2.5",
+    "btts": "BTTS",
+    "double_chance": "Двойной шанс",
+    "handicap": "Фора"
+}
+
+# "Refresh" button label for the stats screen
+REFRESH_LABELS = {"ru": "🔄 Обновить", "en": "🔄 Refresh", "pt": "🔄 Atualizar", "es": "🔄 Actualizar", "id": "🔄 Perbarui"}
+
+# History filter labels, shared by history_cmd and the history callback
+HISTORY_FILTER_LABELS = {
+    "all": {"ru": "ВСЕ", "en": "ALL", "pt": "TODOS", "es": "TODOS", "id": "SEMUA"},
+    "wins": {"ru": "ПОБЕДЫ", "en": "WINS", "pt": "VITÓRIAS", "es": "VICTORIAS", "id": "MENANG"},
+    "losses": {"ru": "ПОРАЖЕНИЯ", "en": "LOSSES", "pt": "DERROTAS", "es": "DERROTAS", "id": "KALAH"},
+    "pending": {"ru": "ОЖИДАЮТ", "en": "PENDING", "pt": "PENDENTES", "es": "PENDIENTES", "id": "MENUNGGU"}
+}
+
+# Empty-history message for history_cmd
+NO_HISTORY_TEXT = {
+    "ru": "📜 История пуста. Сделайте прогноз!",
+    "en": "📜 No history yet. Make a prediction!",
+    "pt": "📜 Histórico vazio. Faça uma previsão!",
+    "es": "📜 Sin historial. ¡Haz una predicción!",
+    "id": "📜 Riwayat kosong. Buat prediksi!"
+}
+
+# get_bot_accuracy_stats result, reused until it expires or predictions are resolved
+ACCURACY_STATS_TTL = 300
+_accuracy_stats_cache = {"value": None, "expires": 0.0}
+
+
+def invalidate_accuracy_stats() -> None:
+    """Drop the cached get_bot_accuracy_stats result (call after predictions change)."""
+    _accuracy_stats_cache["expires"] = 0.0
+
+
 def get_bot_accuracy_stats() -> dict:
-    """Analyze historical predictions to find what works best"""
-    conn = get_db_connection()
-    c = conn.cursor()
+    """Analyze historical predictions to find what works best (cached for ACCURACY_STATS_TTL)"""
+    if time.monotonic() < _accuracy_stats_cache["expires"]:
+        return dict(_accuracy_stats_cache["value"])
 
     stats = {
         "total": 0,
@@ -11042,78 +11753,66 @@ def get_bot_accuracy_stats() -> dict:
     }
 
     try:
-        # Overall accuracy
-        c.execute("""
-            SELECT COUNT(*), SUM(CASE WHEN is_correct = 1 THEN 1 ELSE 0 END)
-            FROM predictions WHERE is_correct IS NOT NULL
-        """)
-        row = c.fetchone()
-        if row and row[0] > 0:
-            stats["total"] = row[0]
-            stats["correct"] = row[1] or 0
-            stats["overall_accuracy"] = round(stats["correct"] / stats["total"] * 100, 1)
-
-        # Accuracy by bet category (grouped properly)
-        c.execute("""
-            SELECT bet_category, COUNT(*) as total,
-                   SUM(CASE WHEN is_correct = 1 THEN 1 ELSE 0 END) as wins
-            FROM predictions
-            WHERE is_correct IS NOT NULL AND bet_category IS NOT NULL
-            GROUP BY bet_category
-            HAVING total >= 3
-            ORDER BY (wins * 1.0 / total) DESC
-        """)
-        # Human-readable category names
-        category_names = {
-            "totals_over": "ТБ (Тотал больше)",
-            "totals_under": "ТМ (Тотал меньше)",
-            "outcomes_home": "П1 (Победа хозяев)",
-            "outcomes_away": "П2 (Победа гостей)",
-            "outcomes_draw": "Ничья (X)",
-            "btts": "ОЗ (Обе забьют)",
-            "double_chance": "Двойной шанс",
-            "handicap": "Фора",
-            "other": "Другое"
-        }
+        # One statement for all three groupings; group_kind tells the rows apart
+        with ro_cursor() as c:
+            c.execute("""
+                SELECT 'overall', NULL, COUNT(*), SUM(CASE WHEN is_correct = 1 THEN 1 ELSE 0 END)
+                FROM predictions WHERE is_correct IS NOT NULL
+                UNION ALL
+                SELECT 'bet_category', bet_category, COUNT(*), SUM(CASE WHEN is_correct = 1 THEN 1 ELSE 0 END)
+                FROM predictions
+                WHERE is_correct IS NOT NULL AND bet_category IS NOT NULL
+                GROUP BY bet_category
+                HAVING COUNT(*) >= 3
+                UNION ALL
+                SELECT 'conf_range', conf_range, COUNT(*), SUM(CASE WHEN is_correct = 1 THEN 1 ELSE 0 END)
+                FROM (
+                    SELECT is_correct,
+                           CASE
+                               WHEN confidence >= 80 THEN '80-100%'
+                               WHEN confidence >= 70 THEN '70-79%'
+                               WHEN confidence >= 60 THEN '60-69%'
+                               ELSE 'under 60%'
+                           END as conf_range
+                    FROM predictions
+                    WHERE is_correct IS NOT NULL AND confidence IS NOT NULL
+                )
+                GROUP BY conf_range
+            """)
+            rows = c.fetchall()
+
+        by_category = []
+        for group_kind, key, total, wins in rows:
+            if group_kind == "overall":
+                if total > 0:
+                    stats["total"] = total
+                    stats["correct"] = wins or 0
+                    stats["overall_accuracy"] = round(stats["correct"] / stats["total"] * 100, 1)
+            elif group_kind == "bet_category":
+                by_category.append((key, total, wins or 0))
+            else:
+                stats["by_confidence"][key] = {
+                    "total": total,
+                    "wins": wins or 0,
+                    "accuracy": round((wins or 0) / total * 100, 1) if total > 0 else 0
+                }
 
-        for row in c.fetchall():
-            category, total, wins = row
-            accuracy = round((wins or 0) / total * 100, 1)
-            display_name = category_names.get(category, category)
+        # Accuracy by bet category, best first
+        by_category.sort(key=lambda r: r[2] / r[1], reverse=True)
+        for category, total, wins in by_category:
+            accuracy = round(wins / total * 100, 1)
+            display_name = _CATEGORY_NAMES.get(category, category)
             stats["by_bet_type"][display_name] = {
                 "total": total,
-                "wins": wins or 0,
+                "wins": wins,
                 "accuracy": accuracy
             }
             if accuracy >= 55:
                 stats["best_bet_types"].append(display_name)
 
-        # Accuracy by confidence range
-        c.execute("""
-            SELECT
-                CASE
-                    WHEN confidence >= 80 THEN '80-100%'
-                    WHEN confidence >= 70 THEN '70-79%'
-                    WHEN confidence >= 60 THEN '60-69%'
-                    ELSE 'under 60%'
-                END as conf_range,
-                COUNT(*) as total,
-                SUM(CASE WHEN is_correct = 1 THEN 1 ELSE 0 END) as wins
-            FROM predictions
-            WHERE is_correct IS NOT NULL AND confidence IS NOT NULL
-            GROUP BY conf_range
-        """)
-        for row in c.fetchall():
-            conf_range, total, wins = row
-            stats["by_confidence"][conf_range] = {
-                "total": total,
-                "wins": wins or 0,
-                "accuracy": round((wins or 0) / total * 100, 1) if total > 0 else 0
-            }
-
         # Generate recommendations
         if stats["best_bet_types"]:
-            stats["recommendations"].append(f"Best performing: {', '.join(stats['best_bet_types'][:3])}")
+            stats["recommendations"].append(f"Best performing: {', '.join(islice(stats['best_bet_types'], 3))}")
 
         if stats["by_confidence"].get("80-100%", {}).get("accuracy", 0) > 65:
             stats["recommendations"].append("High confidence (80%+) predictions are reliable")
@@ -11121,10 +11820,12 @@ def get_bot_accuracy_stats() -> dict:
         if stats["by_confidence"].get("under 60%", {}).get("accuracy", 0) < 45:
             stats["recommendations"].append("Avoid predictions under 60% confidence")
 
+        _accuracy_stats_cache["value"] = stats
+        _accuracy_stats_cache["expires"] = time.monotonic() + ACCURACY_STATS_TTL
+        stats = dict(stats)
+
     except Exception as e:
         logger.error(f"Accuracy stats error: {e}")
-    finally:
-        conn.close()
 
     return stats
 
@@ -11136,9 +11837,9 @@ async def get_lineups(match_id: int) -> Optional[dict]:
 
     try:
         url = f"{FOOTBALL_API_URL}/matches/{match_id}"
-        async with session.get(url, headers=headers) as r:
+        async with football_api_get(session, url, headers=headers) as r:
             if r.status == 200:
-                data = await r.json()
+                data = json.loads(await r.read())
 
                 home_team = data.get("homeTeam", {}).get("name", "?")
                 away_team = data.get("awayTeam", {}).get("name", "?")
@@ -11212,6 +11913,7 @@ async def get_lineups(match_id: int) -> Optional[dict]:
     return None
 
 
+@async_ttl_cache(ttl_seconds=24 * 3600, maxsize=512)
 async def get_team_squad(team_id: int) -> Optional[dict]:
     """Get team squad with player details (ASYNC)"""
     headers = {"X-Auth-Token": FOOTBALL_API_KEY}
@@ -11219,9 +11921,9 @@ async def get_team_squad(team_id: int) -> Optional[dict]:
 
     try:
         url = f"{FOOTBALL_API_URL}/teams/{team_id}"
-        async with session.get(url, headers=headers) as r:
+        async with football_api_get(session, url, headers=headers) as r:
             if r.status == 200:
-                data = await r.json()
+                data = json.loads(await r.read())
                 squad = data.get("squad", [])
 
                 players_by_position = {
@@ -11353,17 +12055,24 @@ def get_line_movement(match_key: str, current_odds: dict) -> dict:
     return movements
 
 
-async def get_odds(home_team: str, away_team: str) -> Optional[dict]:
-    """Get betting odds with 1win priority and line movement tracking (ASYNC)"""
-    if not ODDS_API_KEY:
-        return None
+# Priority bookmakers (1win first, then others)
+PRIORITY_BOOKMAKERS = ["1win", "1xbet", "betway", "pinnacle", "bet365", "unibet", "williamhill"]
 
-    session = await get_http_session()
+# Odds API events, shared by all get_odds calls for ODDS_EVENTS_TTL seconds.
+# index: lowered team name -> events; rows: (home_lower, away_lower, event) in API order
+ODDS_EVENTS_TTL = 60
+ODDS_EVENTS_FAILURE_TTL = 30  # non-200 (quota, outage): don't refetch on every call
+_odds_cache = {"index": {}, "rows": [], "expires": 0.0}
+_odds_fetch_lock = asyncio.Lock()
 
-    # Priority bookmakers (1win first, then others)
-    PRIORITY_BOOKMAKERS = ["1win", "1xbet", "betway", "pinnacle", "bet365", "unibet", "williamhill"]
 
-    try:
+async def _get_odds_events() -> tuple:
+    """Return (index, rows) for the current Odds API events, refetching when stale."""
+    async with _odds_fetch_lock:
+        if time.monotonic() < _odds_cache["expires"]:
+            return _odds_cache["index"], _odds_cache["rows"]
+
+        session = await get_http_session()
         url = f"{ODDS_API_URL}/sports/soccer/odds"
         params = {
             "apiKey": ODDS_API_KEY,
@@ -11372,113 +12081,216 @@ async def get_odds(home_team: str, away_team: str) -> Optional[dict]:
             "oddsFormat": "decimal"
         }
         async with session.get(url, params=params) as r:
-            if r.status == 200:
-                events = await r.json()
-
-                home_lower = (home_team or "").lower()
-                away_lower = (away_team or "").lower()
-
-                for event in events:
-                    event_home = (event.get("home_team") or "").lower()
-                    event_away = (event.get("away_team") or "").lower()
-
-                    if (home_lower in event_home or away_lower in event_away) or \
-                       (home_lower in event_away or away_lower in event_home):
-
-                        match_key = f"{event.get('home_team')}_{event.get('away_team')}_{event.get('commence_time', '')[:10]}"
-                        bookmakers = event.get("bookmakers", [])
-
-                        # Sort bookmakers by priority
-                        def bookmaker_priority(bm):
-                            name = bm.get("key", "").lower()
-                            for i, priority in enumerate(PRIORITY_BOOKMAKERS):
-                                if priority in name:
-                                    return i
-                            return 999
-
-                        bookmakers_sorted = sorted(bookmakers, key=bookmaker_priority)
-
-                        odds = {}
-                        all_bookmaker_odds = {}  # For comparison
-                        selected_bookmaker = None
-
-                        for bookmaker in bookmakers_sorted:
-                            bm_name = bookmaker.get("key", "unknown")
-                            bm_odds = {}
-
-                            for market in bookmaker.get("markets", []):
-                                if market.get("key") == "h2h":
-                                    for outcome in market.get("outcomes", []):
-                                        bm_odds[outcome.get("name")] = outcome.get("price")
-                                elif market.get("key") == "totals":
-                                    for outcome in market.get("outcomes", []):
-                                        name = outcome.get("name")
-                                        point = outcome.get("point", 2.5)
-                                        bm_odds[f"{name}_{point}"] = outcome.get("price")
-                                elif market.get("key") == "spreads":
-                                    for outcome in market.get("outcomes", []):
-                                        name = outcome.get("name")
-                                        point = outcome.get("point", 0)
-                                        sign = "+" if point > 0 else ""
-                                        bm_odds[f"{name} ({sign}{point})"] = outcome.get("price")
-                                elif market.get("key") == "btts":
-                                    for outcome in market.get("outcomes", []):
-                                        name = outcome.get("name")
-                                        bm_odds[f"BTTS_{name}"] = outcome.get("price")
-
-                            all_bookmaker_odds[bm_name] = bm_odds
-
-                            # Use first bookmaker (highest priority) as main odds
-                            if not odds and bm_odds:
-                                odds = bm_odds.copy()
-                                selected_bookmaker = bm_name
-
-                        if odds:
-                            # Save to history for line tracking
-                            save_odds_history(match_key, selected_bookmaker, odds)
-
-                            # Get line movement
-                            movements = get_line_movement(match_key, odds)
-
-                            # Calculate average odds across bookmakers for value detection
-                            avg_odds = {}
-                            for outcome in odds.keys():
-                                values = [bm_odds.get(outcome) for bm_odds in all_bookmaker_odds.values() if bm_odds.get(outcome)]
-                                if values:
-                                    avg_odds[outcome] = sum(values) / len(values)
-
-                            # Add metadata
-                            odds["_bookmaker"] = selected_bookmaker
-                            odds["_bookmakers_count"] = len(all_bookmaker_odds)
-                            odds["_line_movements"] = movements
-                            odds["_avg_odds"] = avg_odds
-
-                            # Detect value (our odds vs average)
-                            value_bets = {}
-                            for outcome, price in odds.items():
-                                if outcome.startswith("_"):
-                                    continue
-                                avg = avg_odds.get(outcome)
-                                if avg and price > avg * 1.02:  # 2%+ above average
-                                    value_bets[outcome] = {
-                                        "odds": price,
-                                        "avg": avg,
-                                        "value_pct": ((price / avg) - 1) * 100
-                                    }
-                            odds["_value_bets"] = value_bets
-
-                            logger.info(f"Odds from {selected_bookmaker}: {len(odds)-5} markets, {len(movements)} movements, {len(value_bets)} value")
-                            return odds
+            if r.status != 200:
+                logger.warning(f"Odds API returned {r.status}, retrying in {ODDS_EVENTS_FAILURE_TTL}s")
+                _odds_cache["index"] = {}
+                _odds_cache["rows"] = []
+                _odds_cache["expires"] = time.monotonic() + ODDS_EVENTS_FAILURE_TTL
+                return {}, []
+            events = json.loads(await r.read())
+
+        index = {}
+        rows = []
+        for event in events:
+            event_home = (event.get("home_team") or "").lower()
+            event_away = (event.get("away_team") or "").lower()
+            rows.append((event_home, event_away, event))
+            index.setdefault(event_home, []).append(event)
+            if event_away != event_home:
+                index.setdefault(event_away, []).append(event)
+
+        _odds_cache["index"] = index
+        _odds_cache["rows"] = rows
+        _odds_cache["expires"] = time.monotonic() + ODDS_EVENTS_TTL
+        return index, rows
+
+
+def _bookmaker_priority(bm: dict) -> int:
+    """Sort key: position in PRIORITY_BOOKMAKERS, unknown bookmakers last."""
+    name = bm.get("key", "").lower()
+    for i, priority in enumerate(PRIORITY_BOOKMAKERS):
+        if priority in name:
+            return i
+    return 999
+
+
+def _extract_event_odds(event: dict) -> Optional[dict]:
+    """Build the odds dict (with line movement / value metadata) for one Odds API event."""
+    match_key = f"{event.get('home_team')}_{event.get('away_team')}_{event.get('commence_time', '')[:10]}"
+    bookmakers = event.get("bookmakers", [])
+
+    # Sort bookmakers by priority
+    bookmakers_sorted = sorted(bookmakers, key=_bookmaker_priority)
+
+    odds = {}
+    all_bookmaker_odds = {}  # For comparison
+    selected_bookmaker = None
+
+    for bookmaker in bookmakers_sorted:
+        bm_name = bookmaker.get("key", "unknown")
+        bm_odds = {}
+
+        for market in bookmaker.get("markets", []):
+            if market.get("key") == "h2h":
+                for outcome in market.get("outcomes", []):
+                    bm_odds[outcome.get("name")] = outcome.get("price")
+            elif market.get("key") == "totals":
+                for outcome in market.get("outcomes", []):
+                    name = outcome.get("name")
+                    point = outcome.get("point", 2.5)
+                    bm_odds[f"{name}_{point}"] = outcome.get("price")
+            elif market.get("key") == "spreads":
+                for outcome in market.get("outcomes", []):
+                    name = outcome.get("name")
+                    point = outcome.get("point", 0)
+                    sign = "+" if point > 0 else ""
+                    bm_odds[f"{name} ({sign}{point})"] = outcome.get("price")
+            elif market.get("key") == "btts":
+                for outcome in market.get("outcomes", []):
+                    name = outcome.get("name")
+                    bm_odds[f"BTTS_{name}"] = outcome.get("price")
+
+        all_bookmaker_odds[bm_name] = bm_odds
+
+        # Use first bookmaker (highest priority) as main odds
+        if not odds and bm_odds:
+            odds = bm_odds.copy()
+            selected_bookmaker = bm_name
+
+    if odds:
+        # Save to history for line tracking
+        save_odds_history(match_key, selected_bookmaker, odds)
+
+        # Get line movement
+        movements = get_line_movement(match_key, odds)
+
+        # Calculate average odds across bookmakers for value detection
+        avg_odds = {}
+        for outcome in odds.keys():
+            values = [bm_odds.get(outcome) for bm_odds in all_bookmaker_odds.values() if bm_odds.get(outcome)]
+            if values:
+                avg_odds[outcome] = sum(values) / len(values)
+
+        # Add metadata
+        odds["_bookmaker"] = selected_bookmaker
+        odds["_bookmakers_count"] = len(all_bookmaker_odds)
+        odds["_line_movements"] = movements
+        odds["_avg_odds"] = avg_odds
+
+        # Detect value (our odds vs average)
+        value_bets = {}
+        for outcome, price in odds.items():
+            if outcome.startswith("_"):
+                continue
+            avg = avg_odds.get(outcome)
+            if avg and price > avg * 1.02:  # 2%+ above average
+                value_bets[outcome] = {
+                    "odds": price,
+                    "avg": avg,
+                    "value_pct": ((price / avg) - 1) * 100
+                }
+        odds["_value_bets"] = value_bets
+
+        logger.info(f"Odds from {selected_bookmaker}: {len(odds)-5} markets, {len(movements)} movements, {len(value_bets)} value")
+        return odds
+    return None
+
+
+async def get_odds(home_team: str, away_team: str) -> Optional[dict]:
+    """Get betting odds with 1win priority and line movement tracking (ASYNC)"""
+    if not ODDS_API_KEY:
+        return None
+
+    try:
+        index, rows = await _get_odds_events()
+
+        home_lower = (home_team or "").lower()
+        away_lower = (away_team or "").lower()
+
+        # O(1) exact team-name hit first
+        exact = index.get(home_lower, []) + index.get(away_lower, [])
+        for event in exact:
+            odds = _extract_event_odds(event)
+            if odds:
+                return odds
+
+        # Substring scan over cached names only when no exact hit had odds
+        tried = {id(event) for event in exact}
+        for event_home, event_away, event in rows:
+            if id(event) in tried:
+                continue
+            if ((home_lower in event_home or away_lower in event_away) or
+                    (home_lower in event_away or away_lower in event_home)):
+                odds = _extract_event_odds(event)
+                if odds:
+                    return odds
     except Exception as e:
         logger.error(f"Odds error: {e}")
     return None
 
 
+class MatchView(NamedTuple):
+    """Flat view of the match fields the list/recommendation renderers read."""
+    home: str
+    away: str
+    comp: str
+    home_id: Optional[int]
+    away_id: Optional[int]
+    utc: str
+
+
+def match_view(m: dict) -> MatchView:
+    """Pull names, ids and kick-off time out of a football-data match dict once."""
+    ht = m.get("homeTeam") or {}
+    at = m.get("awayTeam") or {}
+    return MatchView(ht.get("name", "?"), at.get("name", "?"),
+                     (m.get("competition") or {}).get("name", "?"),
+                     ht.get("id"), at.get("id"), m.get("utcDate", ""))
+
+
+def build_match_index(matches: list) -> dict:
+    """Lookup structures for find_match.
+
+    rows: pre-lowered (home, away, home_short, away_short, home_tla, away_tla, match)
+    by_tla / by_name: lowered TLA / full or short name -> first match with that team
+    """
+    rows = []
+    by_tla = {}
+    by_name = {}
+    for m in matches:
+        home_team = m.get("homeTeam", {})
+        away_team = m.get("awayTeam", {})
+        row = (
+            (home_team.get("name") or "").lower(),
+            (away_team.get("name") or "").lower(),
+            (home_team.get("shortName") or "").lower(),
+            (away_team.get("shortName") or "").lower(),
+            (home_team.get("tla") or "").lower(),
+            (away_team.get("tla") or "").lower(),
+            m,
+        )
+        rows.append(row)
+        if not row[0] and not row[1]:
+            continue
+        for tla in (row[4], row[5]):
+            if tla:
+                by_tla.setdefault(tla, m)
+        for name in row[:4]:
+            if name:
+                by_name.setdefault(name, m)
+    return {"rows": rows, "by_tla": by_tla, "by_name": by_name}
+
+
 def find_match(team_names, matches):
     """Find match by team names - flexible matching"""
     if not matches or not team_names:
         return None
-    
+
+    # The cached all-leagues list comes with a prebuilt index
+    index = matches_cache.get("index") if matches is matches_cache["data"] else None
+    if index is None:
+        index = build_match_index(matches)
+
     for team in team_names:
         if not team:
             continue
@@ -11487,15 +12299,14 @@ def find_match(team_names, matches):
         
         if len(team_lower) < 3:
             continue
-        
-        for m in matches:
-            home = (m.get("homeTeam", {}).get("name") or "").lower()
-            away = (m.get("awayTeam", {}).get("name") or "").lower()
-            home_short = (m.get("homeTeam", {}).get("shortName") or "").lower()
-            away_short = (m.get("awayTeam", {}).get("shortName") or "").lower()
-            home_tla = (m.get("homeTeam", {}).get("tla") or "").lower()
-            away_tla = (m.get("awayTeam", {}).get("tla") or "").lower()
-            
+
+        # Exact TLA / name hit: O(1), no scan
+        m = index["by_tla"].get(team_lower) or index["by_name"].get(team_lower)
+        if m:
+            logger.info(f"Found match: {m.get('homeTeam', {}).get('name')} vs {m.get('awayTeam', {}).get('name')} for query '{team}'")
+            return m
+
+        for home, away, home_short, away_short, home_tla, away_tla, m in index["rows"]:
             # Skip if no team names
             if not home and not away:
                 continue
@@ -11521,13 +12332,15 @@ def get_match_warnings(match, home_form, away_form, lang="ru"):
     competition = match.get("competition", {}).get("name") or ""
     
     # Check if cup match
-    is_cup = any(kw in competition for kw in CUP_KEYWORDS)
+    is_cup = any(kw in competition for kw in _CUP_KEYWORDS)
     if is_cup:
         warnings.append(get_text("cup_warning", lang))
     
     # Check if playing against top club
-    home_is_top = any(club.lower() in home_team.lower() for club in TOP_CLUBS) if home_team else False
-    away_is_top = any(club.lower() in away_team.lower() for club in TOP_CLUBS) if away_team else False
+    home_lc = home_team.lower()
+    away_lc = away_team.lower()
+    home_is_top = any(club in home_lc for club in _TOP_CLUBS_LOWER) if home_team else False
+    away_is_top = any(club in away_lc for club in _TOP_CLUBS_LOWER) if away_team else False
     
     if home_is_top or away_is_top:
         top_club = home_team if home_is_top else away_team
@@ -11544,523 +12357,164 @@ def get_match_warnings(match, home_form, away_form, lang="ru"):
 
 # ===== ENHANCED ANALYSIS v2 =====
 
-async def analyze_match_enhanced(match: dict, user_settings: Optional[dict] = None,
-                                 lang: str = "ru") -> tuple:
-    """Enhanced match analysis with form, H2H, home/away stats, top scorers, and value betting (ASYNC)
-
-    Returns:
-        tuple: (analysis_text, ml_features) - analysis text and features dict for ML training
-    """
-
-    if not claude_client:
-        return "AI unavailable", None
-
-    home = match.get("homeTeam", {}).get("name", "?")
-    away = match.get("awayTeam", {}).get("name", "?")
-    home_id = match.get("homeTeam", {}).get("id")
-    away_id = match.get("awayTeam", {}).get("id")
-    match_id = match.get("id")
-    comp = match.get("competition", {}).get("name", "?")
-    comp_code = match.get("competition", {}).get("code", "PL")
-
-    # Parse upcoming match date for accurate rest days calculation
-    match_date = None
-    match_date_str = match.get("utcDate", "")
-    if match_date_str:
-        try:
-            match_date = datetime.fromisoformat(match_date_str.replace("Z", "+00:00"))
-        except Exception as e:
-            logger.warning(f"Could not parse match date: {e}")
+async def _async_none() -> None:
+    """Placeholder awaitable for optional fetches in asyncio.gather."""
+    return None
 
-    # Get all data (async) - using ENHANCED form function with match date for rest days
-    home_form = await get_team_form_enhanced(home_id, upcoming_match_date=match_date) if home_id else None
-    away_form = await get_team_form_enhanced(away_id, upcoming_match_date=match_date) if away_id else None
-    h2h = await get_h2h(match_id) if match_id else None
-    odds = await get_odds(home, away)
-    standings = await get_standings(comp_code)
-    lineups = await get_lineups(match_id) if match_id else None
-    top_scorers = await get_top_scorers(comp_code, 15)
 
-    # 📊 xG DATA: Real xG from Understat (top-5) OR calculated from form (all 25 leagues)
-    xg_data = await get_match_xg_data(home, away, comp_code, home_form, away_form)
+# Knockout-only competitions: football-data has no league table for these
+_NO_STANDINGS_COMPETITIONS = frozenset({"FAC", "DFB"})
 
-    # 🌐 WEB SEARCH: Get real-time news about injuries, lineups, team news
-    web_news = await search_match_news(home, away, comp)
-    # Get weather if we have venue
-    venue = lineups.get('venue') if lineups else None
-    weather = await get_weather_for_match(venue) if venue else None
 
-    # 👨‍⚖️ REFEREE STATS: Get referee statistics for card/penalty predictions
-    referee_name = lineups.get('referee') if lineups else None
-    # Fallback: try to get referee from web news if API doesn't have it
-    if not referee_name and web_news and web_news.get("referee"):
-        referee_name = web_news.get("referee")
-        logger.info(f"Using referee from web news: {referee_name}")
-    referee_stats = get_referee_stats(referee_name, comp_code) if referee_name else None
+def derive_context_needs(comp_code: Optional[str], match_id: Optional[int]) -> dict:
+    """Which optional per-match lookups can contribute to the analysis."""
+    return {
+        "standings": bool(comp_code) and comp_code not in _NO_STANDINGS_COMPETITIONS,
+        "top_scorers": bool(comp_code),
+        "lineups": bool(match_id),
+    }
 
-    # Get bot's historical accuracy stats
-    bot_stats = get_bot_accuracy_stats()
 
-    # Get warnings (using overall form for compatibility)
-    home_form_simple = {"losses": home_form["overall"]["losses"]} if home_form else None
-    away_form_simple = {"losses": away_form["overall"]["losses"]} if away_form else None
-    warnings = get_match_warnings(match, home_form_simple, away_form_simple, lang)
+# Claude replies for identical prompts, reused for a few minutes (odds drift)
+CLAUDE_CACHE_TTL = 300
+CLAUDE_CACHE_MAX = 1024
+_claude_cache: dict = {}  # blake2b(system + prompt) -> (expires_at, text)
 
-    # Build analysis context
-    analysis_data = f"Match: {home} vs {away}\nCompetition: {comp}\n\n"
 
-    # Add warnings to context
-    if warnings:
-        analysis_data += "⚠️ WARNINGS:\n"
-        for w in warnings:
-            analysis_data += f"  {w}\n"
-        analysis_data += "\n"
+# Minimum seconds between partial-text callbacks while streaming (Telegram edit limits)
+CLAUDE_STREAM_EDIT_INTERVAL = 1.5
 
-    # ENHANCED Form analysis with HOME/AWAY split
-    if home_form:
-        hf = home_form
-        analysis_data += f"📊 {home} ФОРМА (последние 10 матчей):\n"
-        analysis_data += f"  Общая: {hf['overall']['form']} ({hf['overall']['wins']}W-{hf['overall']['draws']}D-{hf['overall']['losses']}L)\n"
-        analysis_data += f"  🏠 ДОМА: {hf['home']['wins']}W-{hf['home']['draws']}D-{hf['home']['losses']}L (винрейт {hf['home']['win_rate']}%)\n"
-        analysis_data += f"      Средние голы: забито {hf['home']['avg_goals_scored']}, пропущено {hf['home']['avg_goals_conceded']}\n"
-        analysis_data += f"  ✈️ В гостях: {hf['away']['wins']}W-{hf['away']['draws']}D-{hf['away']['losses']}L (винрейт {hf['away']['win_rate']}%)\n"
-        analysis_data += f"  📈 BTTS: {hf['btts_percent']}% | Тотал >2.5: {hf['over25_percent']}%\n"
-        # Rest days
-        if hf.get('rest_days') is not None:
-            rest = hf['rest_days']
-            if rest <= 2:
-                analysis_data += f"  ⚠️ УСТАЛОСТЬ: только {rest} дней отдыха!\n"
-            elif rest >= 7:
-                analysis_data += f"  ✅ Свежие: {rest} дней отдыха\n"
-            else:
-                analysis_data += f"  ⏱️ Отдых: {rest} дней\n"
-        analysis_data += "\n"
 
-    if away_form:
-        af = away_form
-        analysis_data += f"📊 {away} ФОРМА (последние 10 матчей):\n"
-        analysis_data += f"  Общая: {af['overall']['form']} ({af['overall']['wins']}W-{af['overall']['draws']}D-{af['overall']['losses']}L)\n"
-        analysis_data += f"  🏠 Дома: {af['home']['wins']}W-{af['home']['draws']}D-{af['home']['losses']}L (винрейт {af['home']['win_rate']}%)\n"
-        analysis_data += f"  ✈️ В ГОСТЯХ: {af['away']['wins']}W-{af['away']['draws']}D-{af['away']['losses']}L (винрейт {af['away']['win_rate']}%)\n"
-        analysis_data += f"      Средние голы: забито {af['away']['avg_goals_scored']}, пропущено {af['away']['avg_goals_conceded']}\n"
-        analysis_data += f"  📈 BTTS: {af['btts_percent']}% | Тотал >2.5: {af['over25_percent']}%\n"
-        # Rest days
-        if af.get('rest_days') is not None:
-            rest = af['rest_days']
-            if rest <= 2:
-                analysis_data += f"  ⚠️ УСТАЛОСТЬ: только {rest} дней отдыха!\n"
-            elif rest >= 7:
-                analysis_data += f"  ✅ Свежие: {rest} дней отдыха\n"
-            else:
-                analysis_data += f"  ⏱️ Отдых: {rest} дней\n"
-        analysis_data += "\n"
+async def _claude_stream_text(request: dict, on_progress: Callable[[str], Awaitable[Any]]) -> str:
+    """Stream Claude's reply, reporting the text so far to on_progress at most every
+    CLAUDE_STREAM_EDIT_INTERVAL seconds. The sync SDK stream runs in a worker thread."""
+    loop = asyncio.get_running_loop()
+    pieces: asyncio.Queue = asyncio.Queue()
 
-    # EXPECTED GOALS calculation (using improved home/away specific method)
-    if home_form and away_form:
-        exp_goals = calculate_expected_goals(home_form, away_form, comp_code)
-        expected_home = exp_goals["expected_home"]
-        expected_away = exp_goals["expected_away"]
-        expected_total = exp_goals["expected_total"]
-        method = exp_goals["method"]
+    def _worker():
+        try:
+            with claude_client.messages.stream(**request) as stream:
+                for text in stream.text_stream:
+                    loop.call_soon_threadsafe(pieces.put_nowait, text)
+        finally:
+            loop.call_soon_threadsafe(pieces.put_nowait, None)
+
+    worker = asyncio.create_task(asyncio.to_thread(_worker))
+    chunks = []
+    last_report = time.monotonic()
+    while (piece := await pieces.get()) is not None:
+        chunks.append(piece)
+        now = time.monotonic()
+        if now - last_report >= CLAUDE_STREAM_EDIT_INTERVAL:
+            last_report = now
+            try:
+                await on_progress("".join(chunks))
+            except Exception as e:
+                logger.debug(f"Stream progress callback failed: {e}")
+    await worker  # re-raises API errors from the stream
+    return "".join(chunks)
 
-        analysis_data += f"🎯 ОЖИДАЕМЫЕ ГОЛЫ (расчёт на основе формы):\n"
-        analysis_data += f"  {home}: ~{expected_home:.1f} голов\n"
-        analysis_data += f"  {away}: ~{expected_away:.1f} голов\n"
-        analysis_data += f"  Ожидаемый тотал: ~{expected_total:.1f}\n"
-        if method == "home_away_specific":
-            analysis_data += f"  📊 Метод: домашняя/гостевая статистика (точный)\n\n"
-        else:
-            analysis_data += f"  📊 Метод: общая статистика (приблизительный)\n\n"
 
-    # 📊 xG ANALYSIS - Real Expected Goals from statistics (CRITICAL for totals!)
-    xg_context = format_xg_analysis(xg_data, home, away, lang)
-    if xg_context:
-        analysis_data += xg_context + "\n\n"
+# Sonnet only caches prompt prefixes of 1024+ tokens; ~4 characters per token
+PROMPT_CACHE_MIN_CHARS = 4 * 1024
 
-    # H2H analysis with reliability warning
-    if h2h:
-        h2h_matches_count = len(h2h.get('matches', []))
-        analysis_data += f"⚔️ H2H (последние {h2h_matches_count} матчей):\n"
-        analysis_data += f"  {home}: {h2h['home_wins']} побед | Ничьи: {h2h['draws']} | {away}: {h2h['away_wins']} побед\n"
-        analysis_data += f"  Средние голы: {h2h['avg_goals']:.1f} за матч\n"
-        analysis_data += f"  Обе забьют: {h2h['btts_percent']:.0f}%\n"
-        analysis_data += f"  Тотал >2.5: {h2h['over25_percent']:.0f}%\n"
-        # Warning for small sample size
-        if h2h_matches_count < 5:
-            analysis_data += f"  ⚠️ ВНИМАНИЕ: Малая выборка ({h2h_matches_count} матчей) - H2H ненадёжен! Приоритет → текущая форма.\n"
-        analysis_data += "\n"
 
-    # 🌐 WEB SEARCH RESULTS - Real-time news (injuries, lineups, team news)
-    web_context = format_web_context_for_claude(web_news, weather, lang)
-    if web_context:
-        analysis_data += web_context
+async def claude_complete_cached(prompt: str, max_tokens: int, system: Optional[str] = None,
+                                 on_progress: Optional[Callable[[str], Awaitable[Any]]] = None) -> str:
+    """Text of Claude's reply to a single-message prompt, cached by prompt hash.
 
-    # 👨‍⚖️ REFEREE STATS - for card and penalty predictions
-    referee_context = format_referee_context(referee_stats, lang)
-    if referee_context:
-        analysis_data += referee_context
+    A static system prompt long enough for Anthropic prompt caching (see
+    PROMPT_CACHE_MIN_CHARS) is marked cacheable; shorter ones are sent plain
+    since the API would ignore the marker. With on_progress the
+    reply is streamed and partial text is passed to the callback.
+    """
+    key = hashlib.blake2b(f"{max_tokens}:{system or ''}:{prompt}".encode(), digest_size=16).hexdigest()
+    now = time.monotonic()
+    cached = _claude_cache.get(key)
+    if cached and cached[0] > now:
+        return cached[1]
+
+    request = {
+        "model": "claude-sonnet-4-20250514",
+        "max_tokens": max_tokens,
+        "messages": [{"role": "user", "content": prompt}],
+    }
+    if system:
+        block = {"type": "text", "text": system}
+        if len(system) >= PROMPT_CACHE_MIN_CHARS:
+            block["cache_control"] = {"type": "ephemeral"}
+        request["system"] = [block]
+
+    if on_progress:
+        text = await _claude_stream_text(request, on_progress)
     else:
-        analysis_data += "\n👨‍⚖️ СУДЬЯ: Назначение ещё не объявлено (обычно за 24-48ч до матча)\n"
-
-    # 📅 FIXTURE CONGESTION - calendar load analysis
-    congestion = get_congestion_analysis(home_form, away_form)
-    congestion_context = format_congestion_context(congestion, home, away, lang)
-    if congestion_context:
-        analysis_data += congestion_context
-
-    # 🔥 MOTIVATION - derby, relegation, title race analysis
-    home_pos = 10
-    away_pos = 10
-    total_teams = 20
-    home_standings_data = None
-    away_standings_data = None
+        message = await asyncio.to_thread(claude_client.messages.create, **request)
+        text = message.content[0].text
 
-    if standings:
-        standings_list = standings.get("standings", [])
-        total_teams = len(standings_list) or 20
+    _claude_cache.pop(key, None)
+    if len(_claude_cache) >= CLAUDE_CACHE_MAX:
+        _claude_cache.pop(next(iter(_claude_cache)))
+    _claude_cache[key] = (time.monotonic() + CLAUDE_CACHE_TTL, text)
+    return text
 
-        # Use improved team matching
-        home_standings_data = find_team_in_standings(home, standings_list)
-        away_standings_data = find_team_in_standings(away, standings_list)
 
-        if home_standings_data:
-            home_pos = home_standings_data.get("position", 10)
-        if away_standings_data:
-            away_pos = away_standings_data.get("position", 10)
+# Static Claude instructions, sent as the system prompt (cacheable when long enough)
+ANALYSIS_SYSTEM_PROMPT = """You are an expert betting analyst.
 
-    is_cup = "cup" in comp.lower() or "copa" in comp.lower() or "coupe" in comp.lower()
+CRITICAL ANALYSIS RULES:
 
-    # Get recent form strings for motivation
-    home_form_str = home_form.get("overall", {}).get("form", "") if home_form else ""
-    away_form_str = away_form.get("overall", {}).get("form", "") if away_form else ""
+1. HOME/AWAY FORM IS KEY:
+   - If home team has 80%+ win rate at HOME → П1 confidence +15%
+   - If away team has <30% win rate AWAY → П1 confidence +10%
+   - Always compare HOME form vs AWAY form, not overall
 
-    motivation = get_motivation_analysis(
-        home, away, home_pos, away_pos, is_cup, total_teams,
-        home_standings=home_standings_data,
-        away_standings=away_standings_data,
-        home_form=home_form_str,
-        away_form=away_form_str
-    )
-    motivation_context = format_motivation_context(motivation, home, away, lang)
-    if motivation_context:
-        analysis_data += motivation_context
+2. EXPECTED GOALS FOR TOTALS (STRICT RULES!):
+   - CALCULATE expected_total = (home_avg_scored + away_avg_conceded)/2 + (away_avg_scored + home_avg_conceded)/2
+   - If expected_total > 2.8 → ONLY then recommend Over 2.5
+   - If expected_total < 2.2 → ONLY then recommend Under 2.5
+   - If expected_total is 2.2-2.8 → DO NOT recommend totals! Too risky.
+   - NEVER recommend Over 2.5 if expected_total < 2.5 (this is a HARD RULE!)
+   - NEVER recommend Under 2.5 if expected_total > 2.5 (this is a HARD RULE!)
+   - When in doubt about totals → recommend BTTS or outcomes instead
 
-    # 👔 COACH CHANGE - new coach boost factor (now API-based!)
-    coach_factor = await calculate_coach_factor(home, away, home_id, away_id)
-    coach_context = format_coach_context(coach_factor, home, away, lang)
-    if coach_context:
-        analysis_data += coach_context
+3. H2H RELIABILITY CHECK (CRITICAL!):
+   - If H2H has < 5 matches → IGNORE H2H for totals prediction!
+   - Small H2H sample is UNRELIABLE - prioritize current form instead
+   - Only trust H2H data when 5+ matches available
+   - Current form (10 matches) > H2H (2-3 matches)
 
-    # 👑 TEAM CLASS - elite factor analysis
-    team_class = get_team_class_analysis(home, away, home_pos, away_pos, total_teams)
-    team_class_context = format_team_class_context(team_class, home, away, lang)
-    if team_class_context:
-        analysis_data += team_class_context
+4. VALUE BETTING (MANDATORY):
+   - Calculate: your_confidence - implied_probability
+   - Only recommend bets with VALUE > 5%
+   - Show value calculation in analysis
 
-    # TOP SCORERS in this match
-    if top_scorers:
-        home_scorers = [s for s in top_scorers if s['team'].lower() in home.lower() or home.lower() in s['team'].lower()]
-        away_scorers = [s for s in top_scorers if s['team'].lower() in away.lower() or away.lower() in s['team'].lower()]
+5. TOP SCORERS MATTER:
+   - If team has top-3 league scorer → +10% goal probability
+   - Factor this into BTTS and totals
 
-        if home_scorers or away_scorers:
-            analysis_data += "⭐ ТОП-БОМБАРДИРЫ В ЭТОМ МАТЧЕ:\n"
-            for s in home_scorers[:2]:
-                analysis_data += f"  {home}: {s['name']} - {s['goals']} голов ({s['goals_per_match']} за матч)\n"
-            for s in away_scorers[:2]:
-                analysis_data += f"  {away}: {s['name']} - {s['goals']} голов ({s['goals_per_match']} за матч)\n"
-            analysis_data += "\n"
+6. 🌐 REAL-TIME NEWS (CRITICAL!):
+   - If injury news mentions key player OUT → ADJUST confidence significantly!
+   - Star striker injured → Lower totals confidence, lower team win confidence
+   - Key defender out → Higher opponent goal probability
+   - "Rotation" news before big game → Team may rest players, lower win confidence
+   - Bad weather (rain, wind) → Lower totals expected
+   - Always mention significant news in your analysis!
 
-    # Save overall table positions for flat track bully analysis (before reset)
-    home_table_pos = home_pos  # Overall league table position
-    away_table_pos = away_pos  # Overall league table position
+7. 👨‍⚖️ REFEREE IMPACT (for cards/penalties):
+   - Strict referee (4.3+ cards/game) → Consider over cards bet
+   - Lenient referee (3.6- cards/game) → Consider under cards bet
+   - High penalty referee (0.38+ pen/game) → Factor into totals (more goals likely)
+   - Very strict referee with red card history → Beware of outcomes (man down changes game)
+   - Always mention referee style if data available!
 
-    # Home/Away standings from league table
-    if standings:
-        home_pos = None
-        away_pos = None
-
-        for team in standings.get("home", []):
-            if home.lower() in team.get("team", {}).get("name", "").lower():
-                home_pos = team.get('position')
-
-        for team in standings.get("away", []):
-            if away.lower() in team.get("team", {}).get("name", "").lower():
-                away_pos = team.get('position')
-
-        if home_pos and away_pos:
-            analysis_data += f"📋 ПОЗИЦИИ В ТАБЛИЦЕ:\n"
-            analysis_data += f"  {home} (дома): {home_pos}-е место\n"
-            analysis_data += f"  {away} (в гостях): {away_pos}-е место\n"
-            analysis_data += f"  Разница: {abs(home_pos - away_pos)} позиций\n\n"
-
-    if lineups and lineups.get('venue'):
-        analysis_data += f"🏟️ Стадион: {lineups['venue']}\n\n"
-
-    # 📋 OFFICIAL LINEUPS AND INJURIES FROM API (PRIMARY SOURCE!)
-    lineups_context = format_lineups_from_api(lineups, home, away, lang)
-    if lineups_context:
-        analysis_data += lineups_context
-        analysis_data += "\n"
-
-    # 🌟 PLAYER IMPACT ANALYSIS - How missing key players affect the team
-    home_injuries = lineups.get("home_injuries", []) if lineups else []
-    away_injuries = lineups.get("away_injuries", []) if lineups else []
-
-    home_player_impact = calculate_player_impact(home, home_injuries, home_id)
-    away_player_impact = calculate_player_impact(away, away_injuries, away_id)
-
-    # Combined player impact for ML
-    player_impact_data = {
-        "home": home_player_impact,
-        "away": away_player_impact
-    }
-
-    # Format and add to analysis
-    player_impact_context = format_player_impact(home_player_impact, away_player_impact, home, away, lang)
-    if player_impact_context:
-        analysis_data += player_impact_context
-        analysis_data += "\n\n"
-
-    # 🎯 FLAT TRACK BULLY ANALYSIS - Players who score vs weak but not strong teams
-    # Get opponent positions for flat track analysis (use saved table positions)
-    opponent_home_pos = away_table_pos if away_table_pos else 10  # Home team faces away team
-    opponent_away_pos = home_table_pos if home_table_pos else 10  # Away team faces home team
-
-    flat_track_context = get_flat_track_context(
-        home_team=home,
-        away_team=away,
-        home_id=home_id,
-        away_id=away_id,
-        opponent_home_pos=opponent_home_pos,
-        opponent_away_pos=opponent_away_pos
-    )
-
-    flat_track_output = format_flat_track_context(flat_track_context, home, away, lang)
-    if flat_track_output:
-        analysis_data += flat_track_output
-        analysis_data += "\n\n"
-
-    # Odds with VALUE calculation, line movements, and bookmaker info
-    if odds:
-        bookmaker = odds.get("_bookmaker", "unknown")
-        bm_count = odds.get("_bookmakers_count", 1)
-        analysis_data += f"💰 КОЭФФИЦИЕНТЫ ({bookmaker}, из {bm_count} букмекеров):\n"
-
-        for k, v in odds.items():
-            if k.startswith("_"):  # Skip metadata
-                continue
-            if isinstance(v, (int, float)) and v > 1:
-                implied = round(1 / v * 100, 1)
-                analysis_data += f"  {k}: {v} (prob: {implied}%)\n"
-
-        # Line movements (sharp money indicator)
-        movements = odds.get("_line_movements", {})
-        has_history = movements.get("_has_history", False)
-        hours_tracked = movements.get("_hours_tracked", 0)
-
-        # Filter out metadata keys to get actual movements
-        actual_movements = {k: v for k, v in movements.items()
-                          if not k.startswith("_") and isinstance(v, dict)}
-
-        # Also check web search for odds movement info
-        web_odds_movement = web_news.get("odds_movement") if web_news else None
-
-        if actual_movements:
-            analysis_data += f"\n📉 ДВИЖЕНИЕ ЛИНИЙ (за {hours_tracked:.1f}ч):\n"
-            for outcome, mv in actual_movements.items():
-                sharp_icon = "🔥" if mv.get("sharp") else ""
-                analysis_data += f"  {outcome}: {mv['first']} → {mv['current']} ({mv['direction']}{abs(mv['pct']):.1f}%) {sharp_icon}\n"
-            sharp_moves = [m for m in actual_movements.values() if m.get("sharp")]
-            if sharp_moves:
-                analysis_data += "  ⚡ SHARP MONEY DETECTED - линия упала значительно!\n"
-        elif web_odds_movement and web_odds_movement.get("detected"):
-            # Use web search data if no DB history
-            direction = "⬇️ ПАДАЮТ" if web_odds_movement["direction"] == "drop" else "⬆️ РАСТУТ"
-            analysis_data += f"\n📉 ДВИЖЕНИЕ ЛИНИЙ (из новостей): Коэффициенты {direction}\n"
-            if web_odds_movement.get("details"):
-                analysis_data += f"  • {web_odds_movement['details']}\n"
-            if web_odds_movement["direction"] == "drop":
-                analysis_data += "  ⚡ SHARP MONEY - профессионалы ставят на эту сторону!\n"
-        elif has_history:
-            # We have history but no significant movements
-            analysis_data += f"\n📉 ДВИЖЕНИЕ ЛИНИЙ (за {hours_tracked:.1f}ч): Стабильно ✓\n"
-        else:
-            # First time seeing this match - explain
-            analysis_data += "\n📉 ДВИЖЕНИЕ ЛИНИЙ: 📊 Начато отслеживание\n"
-            analysis_data += "  ℹ️ При повторном анализе покажем изменения\n"
-
-        # Value bets (our odds vs average)
-        value_bets = odds.get("_value_bets", {})
-        if value_bets:
-            analysis_data += "\n💎 VALUE BETS (коэфф выше среднего):\n"
-            for outcome, vb in value_bets.items():
-                analysis_data += f"  {outcome}: {vb['odds']} vs avg {vb['avg']:.2f} (+{vb['value_pct']:.1f}% value)\n"
-
-        analysis_data += "\n"
-
-    # Bot's historical performance (to inform AI)
-    if bot_stats["total"] >= 10:
-        analysis_data += "📈 ИСТОРИЧЕСКАЯ ТОЧНОСТЬ БОТА:\n"
-        analysis_data += f"  Общая: {bot_stats['overall_accuracy']}% ({bot_stats['correct']}/{bot_stats['total']})\n"
-        if bot_stats["best_bet_types"]:
-            analysis_data += f"  Лучшие типы ставок: {', '.join(bot_stats['best_bet_types'][:3])}\n"
-        for rec in bot_stats["recommendations"][:2]:
-            analysis_data += f"  💡 {rec}\n"
-        analysis_data += "\n"
-
-    # ===== ML PREDICTIONS =====
-    # Extract features for ML (referee, web news, congestion, motivation, coach, lineups, xG, flat track!)
-    ml_features = extract_features(
-        home_form=home_form,
-        away_form=away_form,
-        standings=standings,
-        odds=odds,
-        h2h=h2h.get("matches", []) if h2h else [],
-        home_team=home,
-        away_team=away,
-        referee_stats=referee_stats,
-        has_web_news=web_news.get("searched", False) if web_news else False,
-        congestion=congestion,
-        motivation=motivation,
-        team_class=team_class,
-        coach_factor=coach_factor,
-        lineups=lineups,  # Injuries data for ML
-        xg_data=xg_data,  # Real xG data for totals
-        player_impact=player_impact_data,  # KEY PLAYER IMPACT!
-        flat_track_context=flat_track_context  # Flat track bully analysis
-    )
-
-    # Get ML predictions if models are trained
-    ml_predictions = get_all_ml_predictions(ml_features)
-
-    if ml_predictions:
-        analysis_data += "🤖 ML МОДЕЛЬ ПРЕДСКАЗЫВАЕТ:\n"
-        ml_names = {
-            "outcomes_home": "П1 (победа хозяев)",
-            "outcomes_away": "П2 (победа гостей)",
-            "outcomes_draw": "Ничья",
-            "totals_over": "ТБ 2.5",
-            "totals_under": "ТМ 2.5",
-            "btts": "Обе забьют"
-        }
-        for cat, pred in ml_predictions.items():
-            name = ml_names.get(cat, cat)
-            conf = pred["confidence"]
-            analysis_data += f"  {name}: {conf:.0f}% вероятность\n"
-        analysis_data += "  ⚠️ ML модель обучена на исторических данных бота\n\n"
-
-    # 🤖 ENSEMBLE ML - Multiple models voting
-    ensemble_result = get_ensemble_prediction(ml_features, "match_result")
-    ensemble_context = format_ensemble_prediction(ensemble_result, lang)
-    if ensemble_context:
-        analysis_data += ensemble_context
-        analysis_data += "\n\n"
-
-    # Store features for future ML training (will be linked to prediction later)
-    # Features are stored in match context for saving after Claude response
-
-    # ===== LEARNING FROM PAST ERRORS =====
-    # Get lessons from past prediction errors for this league
-    learning_context = get_learning_context(comp_code)
-    if learning_context:
-        analysis_data += f"\n{learning_context}\n\n"
-        analysis_data += "⚠️ ВАЖНО: Учти эти уроки при анализе! Не повторяй прошлые ошибки.\n\n"
-
-    # ===== SMART LEARNING - CONDITION-BASED FEEDBACK =====
-    # Tell Claude about specific conditions that historically led to errors/successes
-    # This influences HOW Claude analyzes, not just adjusts confidence after
-    smart_learning_context = get_smart_learning_context_for_claude(ml_features, comp_code)
-    if smart_learning_context:
-        analysis_data += f"{smart_learning_context}\n\n"
-
-    # ===== ROI-BASED RECOMMENDATIONS =====
-    # Show which bets are actually PROFITABLE, not just winning
-    roi_context = get_roi_based_recommendations(ml_features)
-    if roi_context:
-        analysis_data += f"{roi_context}\n\n"
-
-    # User settings for filtering
-    filter_info = ""
-    if user_settings:
-        filter_info = f"""
-User preferences:
-- Min odds: {user_settings.get('min_odds', 1.3)}
-- Max odds: {user_settings.get('max_odds', 3.0)}
-- Risk level: {user_settings.get('risk_level', 'medium')}
-"""
-
-    # Language instruction
-    lang_map = {
-        "ru": "Отвечай на русском языке.",
-        "en": "Respond in English.",
-        "pt": "Responda em português.",
-        "es": "Responde en español.",
-        "id": "Jawab dalam Bahasa Indonesia."
-    }
-    lang_instruction = lang_map.get(lang, lang_map["ru"])
-
-    prompt = f"""{lang_instruction}
-
-You are an expert betting analyst. Analyze this match using ALL provided data:
-
-{analysis_data}
-
-{filter_info}
-
-CRITICAL ANALYSIS RULES:
-
-1. HOME/AWAY FORM IS KEY:
-   - If home team has 80%+ win rate at HOME → П1 confidence +15%
-   - If away team has <30% win rate AWAY → П1 confidence +10%
-   - Always compare HOME form vs AWAY form, not overall
-
-2. EXPECTED GOALS FOR TOTALS (STRICT RULES!):
-   - CALCULATE expected_total = (home_avg_scored + away_avg_conceded)/2 + (away_avg_scored + home_avg_conceded)/2
-   - If expected_total > 2.8 → ONLY then recommend Over 2.5
-   - If expected_total < 2.2 → ONLY then recommend Under 2.5
-   - If expected_total is 2.2-2.8 → DO NOT recommend totals! Too risky.
-   - NEVER recommend Over 2.5 if expected_total < 2.5 (this is a HARD RULE!)
-   - NEVER recommend Under 2.5 if expected_total > 2.5 (this is a HARD RULE!)
-   - When in doubt about totals → recommend BTTS or outcomes instead
-
-3. H2H RELIABILITY CHECK (CRITICAL!):
-   - If H2H has < 5 matches → IGNORE H2H for totals prediction!
-   - Small H2H sample is UNRELIABLE - prioritize current form instead
-   - Only trust H2H data when 5+ matches available
-   - Current form (10 matches) > H2H (2-3 matches)
-
-4. VALUE BETTING (MANDATORY):
-   - Calculate: your_confidence - implied_probability
-   - Only recommend bets with VALUE > 5%
-   - Show value calculation in analysis
-
-5. TOP SCORERS MATTER:
-   - If team has top-3 league scorer → +10% goal probability
-   - Factor this into BTTS and totals
-
-6. 🌐 REAL-TIME NEWS (CRITICAL!):
-   - If injury news mentions key player OUT → ADJUST confidence significantly!
-   - Star striker injured → Lower totals confidence, lower team win confidence
-   - Key defender out → Higher opponent goal probability
-   - "Rotation" news before big game → Team may rest players, lower win confidence
-   - Bad weather (rain, wind) → Lower totals expected
-   - Always mention significant news in your analysis!
-
-7. 👨‍⚖️ REFEREE IMPACT (for cards/penalties):
-   - Strict referee (4.3+ cards/game) → Consider over cards bet
-   - Lenient referee (3.6- cards/game) → Consider under cards bet
-   - High penalty referee (0.38+ pen/game) → Factor into totals (more goals likely)
-   - Very strict referee with red card history → Beware of outcomes (man down changes game)
-   - Always mention referee style if data available!
-
-8. 📅 FIXTURE CONGESTION (CALENDAR LOAD):
-   - Team with 0-2 days rest = EXHAUSTED → Lower win confidence (-10-15%)
-   - Team with 3-4 days rest = TIRED → Slight confidence reduction (-5%)
-   - Team with 7+ days rest = FRESH → Can handle physical battles better
-   - BIG rest advantage (3+ days more) → Significant edge for fresher team!
-   - If both teams tired → Consider Under totals (less energy = fewer goals)
-   - Congested calendar → Higher rotation risk, check lineups!
-   - Always mention fatigue if one team has <3 days rest!
+8. 📅 FIXTURE CONGESTION (CALENDAR LOAD):
+   - Team with 0-2 days rest = EXHAUSTED → Lower win confidence (-10-15%)
+   - Team with 3-4 days rest = TIRED → Slight confidence reduction (-5%)
+   - Team with 7+ days rest = FRESH → Can handle physical battles better
+   - BIG rest advantage (3+ days more) → Significant edge for fresher team!
+   - If both teams tired → Consider Under totals (less energy = fewer goals)
+   - Congested calendar → Higher rotation risk, check lineups!
+   - Always mention fatigue if one team has <3 days rest!
 
 9. 🔥 MOTIVATION FACTOR (CRITICAL FOR ACCURACY!):
    - DERBY MATCH → Expect unpredictable result! Lower main bet confidence, consider X or BTTS
@@ -12181,7 +12635,51 @@ CRITICAL ANALYSIS RULES:
    - "SMART LEARNING ПРЕДУПРЕЖДЕНИЯ" section - NEVER create this!
    - Any raw data you received - only show conclusions
    - Technical warnings about win rates - factor into confidence silently
-   - Your reasoning about internal data - just apply it
+   - Your reasoning about internal data - just apply it"""
+
+RECOMMENDATIONS_SYSTEM_PROMPT = """RULES:
+1. VALUE BETTING FOR ROI - find bets where confidence × odds > 1.2 (20% edge)
+   Example: 65% confidence × 2.0 odds = 1.30 VALUE ✓ (good bet)
+   Example: 80% confidence × 1.3 odds = 1.04 VALUE ✗ (waste of confidence)
+
+2. PREFER HIGHER ODDS with solid confidence over "safe" low odds bets
+   - A 60% bet @ 2.2 odds (VALUE=1.32) beats 80% bet @ 1.3 odds (VALUE=1.04)
+   - Target odds range: 1.7 - 3.0 for best ROI potential
+   - Low odds (<1.5) only if confidence is 85%+
+
+3. ANALYZE ALL BET TYPES fairly - each has its place:
+   - П1/П2: good when there's clear class difference + form advantage
+   - Double Chance: safer but need decent odds (1.4+)
+   - Over/Under: check actual goals averages and H2H totals
+   - BTTS: check if both teams score regularly (>60% matches)
+   - Draw: only when teams are truly equal AND low-scoring history
+
+4. For TOP CLUBS - they rarely lose but draws happen, consider 1X or X2
+5. Cup matches = more upsets, adjust confidence down 10%
+6. If warnings present - lower confidence by 10-15%
+7. CRITICAL: Include 📅 date/time for EVERY match!
+
+FORMAT (STRICTLY follow this format, including the 📅 line with date/time):
+🔥 **ТОП СТАВКИ:**
+
+1️⃣ **[Home] vs [Away]** ([Competition])
+   📅 [REQUIRED: Copy the exact date/time from match data, e.g. "📅 Сегодня 21:00"]
+   ⚡ [Bet type] @ ~X.XX
+   📊 Уверенность: X%
+   📝 [1-2 sentences why]
+
+2️⃣ ...
+
+💡 **Общий совет:** [1 sentence]"""
+
+# Per-call user messages, filled in with str.format
+ANALYSIS_PROMPT_TMPL = """{lang_instruction}
+
+Analyze this match using ALL provided data:
+
+{analysis_data}
+
+{filter_info}
 
 RESPONSE FORMAT:
 
@@ -12197,47 +12695,577 @@ RESPONSE FORMAT:
 • 👑 Класс: [elite/strong/mid/weak]
 • 📉 Движение линий: [sharp money куда идёт - если есть]
 
-🎯 **EDGE STACKING (подсчёт факторов):**
-✓ Фактор 1: [описание] → в пользу [ставки]
-✓ Фактор 2: [описание] → в пользу [ставки]
-✓ Фактор 3: [описание] → в пользу [ставки]
-✗ Против: [что может помешать]
-**ИТОГО: X факторов ЗА, Y факторов ПРОТИВ**
+🎯 **EDGE STACKING (подсчёт факторов):**
+✓ Фактор 1: [описание] → в пользу [ставки]
+✓ Фактор 2: [описание] → в пользу [ставки]
+✓ Фактор 3: [описание] → в пользу [ставки]
+✗ Против: [что может помешать]
+**ИТОГО: X факторов ЗА, Y факторов ПРОТИВ**
+
+🎯 **ОСНОВНАЯ СТАВКА** (Уверенность: X%):
+[Тип ставки] @ [коэфф]
+📊 Value: [твоя вероятность]% - [implied]% = [+X% VALUE]
+💰 Банк: X%
+📝 Почему: [основано на edge stacking выше]
+
+📈 **АЛЬТЕРНАТИВЫ (3 шт):**
+[ALT1] [Ставка] @ [коэфф] | [X]%
+[ALT2] [Ставка] @ [коэфф] | [X]%
+[ALT3] [Ставка] @ [коэфф] | [X]%
+
+⚠️ **РИСКИ / TRAP GAMES:**
+[Конкретные риски + есть ли признаки trap game]
+
+✅ **ВЕРДИКТ:**
+[🔥 СИЛЬНАЯ (3+ факторов) / ⚡ ХОРОШАЯ (2 фактора) / ⚠️ РИСКОВАННАЯ (1 фактор) / 🚫 ПРОПУСТИТЬ]
+
+Bank: 85%+=5%, 75-84%=4%, 65-74%=3%, 55-64%=2%, <55%=skip"""
+
+RECOMMENDATIONS_PROMPT_TMPL = """{lang_instruction}
+
+User asked: "{user_query}"
+
+Analyze these matches with form data and give TOP 3-4 picks:
+
+{matches_text}
+
+{filter_info}
+
+{confidence_rule}"""
+
+
+async def analyze_match_enhanced(match: dict, user_settings: Optional[dict] = None,
+                                 lang: str = "ru",
+                                 on_progress: Optional[Callable[[str], Awaitable[Any]]] = None) -> tuple:
+    """Enhanced match analysis with form, H2H, home/away stats, top scorers, and value betting (ASYNC)
+
+    Args:
+        on_progress: optional async callback receiving the partial Claude reply while it streams
+
+    Returns:
+        tuple: (analysis_text, ml_features) - analysis text and features dict for ML training
+    """
+
+    if not claude_client:
+        return "AI unavailable", None
+
+    home = match.get("homeTeam", {}).get("name", "?")
+    away = match.get("awayTeam", {}).get("name", "?")
+    home_id = match.get("homeTeam", {}).get("id")
+    away_id = match.get("awayTeam", {}).get("id")
+    match_id = match.get("id")
+    comp = match.get("competition", {}).get("name", "?")
+    comp_code = match.get("competition", {}).get("code", "PL")
+
+    # Parse upcoming match date for accurate rest days calculation
+    match_date = None
+    match_date_str = match.get("utcDate", "")
+    if match_date_str:
+        try:
+            match_date = datetime.fromisoformat(match_date_str.replace("Z", "+00:00"))
+        except Exception as e:
+            logger.warning(f"Could not parse match date: {e}")
+
+    # Get all independent data concurrently - using ENHANCED form function with match date for rest days
+    # 🌐 WEB SEARCH: real-time news about injuries, lineups, team news
+    # Bot's historical accuracy stats come from SQLite, so they run in a worker thread
+    needs = derive_context_needs(comp_code, match_id)
+    results = await asyncio.gather(
+        get_team_form_enhanced(home_id, upcoming_match_date=match_date) if home_id else _async_none(),
+        get_team_form_enhanced(away_id, upcoming_match_date=match_date) if away_id else _async_none(),
+        get_h2h(match_id) if match_id else _async_none(),
+        get_odds(home, away),
+        get_standings(comp_code) if needs["standings"] else _async_none(),
+        get_lineups(match_id) if needs["lineups"] else _async_none(),
+        get_top_scorers(comp_code, 15) if needs["top_scorers"] else _async_none(),
+        search_match_news(home, away, comp),
+        asyncio.to_thread(get_bot_accuracy_stats),
+        return_exceptions=True,
+    )
+    for i, result in enumerate(results):
+        if isinstance(result, Exception):
+            logger.error(f"Match context fetch #{i} failed for {home} vs {away}: {result}")
+    (home_form, away_form, h2h, odds, standings, lineups, top_scorers,
+     web_news, bot_stats) = (None if isinstance(r, Exception) else r for r in results)
+
+    # 📊 xG DATA: Real xG from Understat (top-5) OR calculated from form (all 25 leagues)
+    xg_data = await get_match_xg_data(home, away, comp_code, home_form, away_form)
+
+    # Get weather if we have venue
+    venue = lineups.get('venue') if lineups else None
+    weather = await get_weather_for_match(venue) if venue else None
+
+    # 👨‍⚖️ REFEREE STATS: Get referee statistics for card/penalty predictions
+    referee_name = lineups.get('referee') if lineups else None
+    # Fallback: try to get referee from web news if API doesn't have it
+    if not referee_name and web_news and web_news.get("referee"):
+        referee_name = web_news.get("referee")
+        logger.info(f"Using referee from web news: {referee_name}")
+    referee_stats = get_referee_stats(referee_name, comp_code) if referee_name else None
+
+    # Get warnings (using overall form for compatibility)
+    home_form_simple = {"losses": home_form["overall"]["losses"]} if home_form else None
+    away_form_simple = {"losses": away_form["overall"]["losses"]} if away_form else None
+    warnings = get_match_warnings(match, home_form_simple, away_form_simple, lang)
+
+    # Build analysis context
+    parts = [f"Match: {home} vs {away}\nCompetition: {comp}\n\n"]
+
+    # Add warnings to context
+    if warnings:
+        parts.append("⚠️ WARNINGS:\n")
+        for w in warnings:
+            parts.append(f"  {w}\n")
+        parts.append("\n")
+
+    # ENHANCED Form analysis with HOME/AWAY split
+    if home_form:
+        hf = home_form
+        parts.append(
+            f"📊 {home} ФОРМА (последние 10 матчей):\n"
+            f"  Общая: {hf['overall']['form']} ({hf['overall']['wins']}W-{hf['overall']['draws']}D-{hf['overall']['losses']}L)\n"
+            f"  🏠 ДОМА: {hf['home']['wins']}W-{hf['home']['draws']}D-{hf['home']['losses']}L (винрейт {hf['home']['win_rate']}%)\n"
+            f"      Средние голы: забито {hf['home']['avg_goals_scored']}, пропущено {hf['home']['avg_goals_conceded']}\n"
+            f"  ✈️ В гостях: {hf['away']['wins']}W-{hf['away']['draws']}D-{hf['away']['losses']}L (винрейт {hf['away']['win_rate']}%)\n"
+            f"  📈 BTTS: {hf['btts_percent']}% | Тотал >2.5: {hf['over25_percent']}%\n")
+        # Rest days
+        if hf.get('rest_days') is not None:
+            rest = hf['rest_days']
+            if rest <= 2:
+                parts.append(f"  ⚠️ УСТАЛОСТЬ: только {rest} дней отдыха!\n")
+            elif rest >= 7:
+                parts.append(f"  ✅ Свежие: {rest} дней отдыха\n")
+            else:
+                parts.append(f"  ⏱️ Отдых: {rest} дней\n")
+        parts.append("\n")
+
+    if away_form:
+        af = away_form
+        parts.append(
+            f"📊 {away} ФОРМА (последние 10 матчей):\n"
+            f"  Общая: {af['overall']['form']} ({af['overall']['wins']}W-{af['overall']['draws']}D-{af['overall']['losses']}L)\n"
+            f"  🏠 Дома: {af['home']['wins']}W-{af['home']['draws']}D-{af['home']['losses']}L (винрейт {af['home']['win_rate']}%)\n"
+            f"  ✈️ В ГОСТЯХ: {af['away']['wins']}W-{af['away']['draws']}D-{af['away']['losses']}L (винрейт {af['away']['win_rate']}%)\n"
+            f"      Средние голы: забито {af['away']['avg_goals_scored']}, пропущено {af['away']['avg_goals_conceded']}\n"
+            f"  📈 BTTS: {af['btts_percent']}% | Тотал >2.5: {af['over25_percent']}%\n")
+        # Rest days
+        if af.get('rest_days') is not None:
+            rest = af['rest_days']
+            if rest <= 2:
+                parts.append(f"  ⚠️ УСТАЛОСТЬ: только {rest} дней отдыха!\n")
+            elif rest >= 7:
+                parts.append(f"  ✅ Свежие: {rest} дней отдыха\n")
+            else:
+                parts.append(f"  ⏱️ Отдых: {rest} дней\n")
+        parts.append("\n")
+
+    # EXPECTED GOALS calculation (using improved home/away specific method)
+    if home_form and away_form:
+        exp_goals = calculate_expected_goals(home_form, away_form, comp_code)
+        expected_home = exp_goals["expected_home"]
+        expected_away = exp_goals["expected_away"]
+        expected_total = exp_goals["expected_total"]
+        method = exp_goals["method"]
+
+        parts.append(
+            "🎯 ОЖИДАЕМЫЕ ГОЛЫ (расчёт на основе формы):\n"
+            f"  {home}: ~{expected_home:.1f} голов\n"
+            f"  {away}: ~{expected_away:.1f} голов\n"
+            f"  Ожидаемый тотал: ~{expected_total:.1f}\n")
+        if method == "home_away_specific":
+            parts.append(f"  📊 Метод: домашняя/гостевая статистика (точный)\n\n")
+        else:
+            parts.append(f"  📊 Метод: общая статистика (приблизительный)\n\n")
+
+    # 📊 xG ANALYSIS - Real Expected Goals from statistics (CRITICAL for totals!)
+    xg_context = format_xg_analysis(xg_data, home, away, lang)
+    if xg_context:
+        parts.append(xg_context + "\n\n")
+
+    # H2H analysis with reliability warning
+    if h2h:
+        h2h_matches_count = len(h2h.get('matches', []))
+        parts.append(
+            f"⚔️ H2H (последние {h2h_matches_count} матчей):\n"
+            f"  {home}: {h2h['home_wins']} побед | Ничьи: {h2h['draws']} | {away}: {h2h['away_wins']} побед\n"
+            f"  Средние голы: {h2h['avg_goals']:.1f} за матч\n"
+            f"  Обе забьют: {h2h['btts_percent']:.0f}%\n"
+            f"  Тотал >2.5: {h2h['over25_percent']:.0f}%\n")
+        # Warning for small sample size
+        if h2h_matches_count < 5:
+            parts.append(f"  ⚠️ ВНИМАНИЕ: Малая выборка ({h2h_matches_count} матчей) - H2H ненадёжен! Приоритет → текущая форма.\n")
+        parts.append("\n")
+
+    # 🌐 WEB SEARCH RESULTS - Real-time news (injuries, lineups, team news)
+    web_context = format_web_context_for_claude(web_news, weather, lang)
+    if web_context:
+        parts.append(web_context)
+
+    # 👨‍⚖️ REFEREE STATS - for card and penalty predictions
+    referee_context = format_referee_context(referee_stats, lang)
+    if referee_context:
+        parts.append(referee_context)
+    else:
+        parts.append("\n👨‍⚖️ СУДЬЯ: Назначение ещё не объявлено (обычно за 24-48ч до матча)\n")
+
+    # 📅 FIXTURE CONGESTION - calendar load analysis
+    congestion = get_congestion_analysis(home_form, away_form)
+    congestion_context = format_congestion_context(congestion, home, away, lang)
+    if congestion_context:
+        parts.append(congestion_context)
+
+    # 🔥 MOTIVATION - derby, relegation, title race analysis
+    home_pos = 10
+    away_pos = 10
+    total_teams = 20
+    home_standings_data = None
+    away_standings_data = None
+
+    if standings:
+        standings_list = standings.get("standings", [])
+        total_teams = len(standings_list) or 20
+
+        # Use improved team matching
+        home_standings_data = find_team_in_standings(home, standings_list)
+        away_standings_data = find_team_in_standings(away, standings_list)
+
+        if home_standings_data:
+            home_pos = home_standings_data.get("position", 10)
+        if away_standings_data:
+            away_pos = away_standings_data.get("position", 10)
+
+    is_cup = "cup" in comp.lower() or "copa" in comp.lower() or "coupe" in comp.lower()
+
+    # Get recent form strings for motivation
+    home_form_str = home_form.get("overall", {}).get("form", "") if home_form else ""
+    away_form_str = away_form.get("overall", {}).get("form", "") if away_form else ""
+
+    motivation = get_motivation_analysis(
+        home, away, home_pos, away_pos, is_cup, total_teams,
+        home_standings=home_standings_data,
+        away_standings=away_standings_data,
+        home_form=home_form_str,
+        away_form=away_form_str
+    )
+    motivation_context = format_motivation_context(motivation, home, away, lang)
+    if motivation_context:
+        parts.append(motivation_context)
+
+    # 👔 COACH CHANGE - new coach boost factor (now API-based!)
+    coach_factor = await calculate_coach_factor(home, away, home_id, away_id)
+    coach_context = format_coach_context(coach_factor, home, away, lang)
+    if coach_context:
+        parts.append(coach_context)
+
+    # 👑 TEAM CLASS - elite factor analysis
+    team_class = get_team_class_analysis(home, away, home_pos, away_pos, total_teams)
+    team_class_context = format_team_class_context(team_class, home, away, lang)
+    if team_class_context:
+        parts.append(team_class_context)
+
+    # TOP SCORERS in this match
+    home_lc = home.lower()
+    away_lc = away.lower()
+
+    if top_scorers:
+        home_scorers = []
+        away_scorers = []
+        for s in top_scorers:
+            team_lc = s['team'].lower()
+            if team_lc in home_lc or home_lc in team_lc:
+                home_scorers.append(s)
+            if team_lc in away_lc or away_lc in team_lc:
+                away_scorers.append(s)
+
+        if home_scorers or away_scorers:
+            parts.append("⭐ ТОП-БОМБАРДИРЫ В ЭТОМ МАТЧЕ:\n")
+            for s in islice(home_scorers, 2):
+                parts.append(f"  {home}: {s['name']} - {s['goals']} голов ({s['goals_per_match']} за матч)\n")
+            for s in islice(away_scorers, 2):
+                parts.append(f"  {away}: {s['name']} - {s['goals']} голов ({s['goals_per_match']} за матч)\n")
+            parts.append("\n")
+
+    # Save overall table positions for flat track bully analysis (before reset)
+    home_table_pos = home_pos  # Overall league table position
+    away_table_pos = away_pos  # Overall league table position
+
+    # Home/Away standings from league table (both split tables are needed for the block)
+    if standings and standings.get("home") and standings.get("away"):
+        home_pos = _standings_position(_index_standings(standings, "home"), home,
+                                       default=None, key_in_name=False)
+        away_pos = _standings_position(_index_standings(standings, "away"), away,
+                                       default=None, key_in_name=False)
+
+        if home_pos and away_pos:
+            parts.append(
+                "📋 ПОЗИЦИИ В ТАБЛИЦЕ:\n"
+                f"  {home} (дома): {home_pos}-е место\n"
+                f"  {away} (в гостях): {away_pos}-е место\n"
+                f"  Разница: {abs(home_pos - away_pos)} позиций\n\n")
+
+    if lineups and lineups.get('venue'):
+        parts.append(f"🏟️ Стадион: {lineups['venue']}\n\n")
+
+    # 📋 OFFICIAL LINEUPS AND INJURIES FROM API (PRIMARY SOURCE!)
+    lineups_context = format_lineups_from_api(lineups, home, away, lang)
+    if lineups_context:
+        parts.append(lineups_context)
+        parts.append("\n")
+
+    # 🌟 PLAYER IMPACT ANALYSIS - How missing key players affect the team
+    home_injuries = lineups.get("home_injuries", []) if lineups else []
+    away_injuries = lineups.get("away_injuries", []) if lineups else []
+
+    home_player_impact = calculate_player_impact(home, home_injuries, home_id)
+    away_player_impact = calculate_player_impact(away, away_injuries, away_id)
+
+    # Combined player impact for ML
+    player_impact_data = {
+        "home": home_player_impact,
+        "away": away_player_impact
+    }
+
+    # Format and add to analysis
+    player_impact_context = format_player_impact(home_player_impact, away_player_impact, home, away, lang)
+    if player_impact_context:
+        parts.append(player_impact_context)
+        parts.append("\n\n")
+
+    # 🎯 FLAT TRACK BULLY ANALYSIS - Players who score vs weak but not strong teams
+    # Get opponent positions for flat track analysis (use saved table positions)
+    opponent_home_pos = away_table_pos if away_table_pos else 10  # Home team faces away team
+    opponent_away_pos = home_table_pos if home_table_pos else 10  # Away team faces home team
+
+    flat_track_context = get_flat_track_context(
+        home_team=home,
+        away_team=away,
+        home_id=home_id,
+        away_id=away_id,
+        opponent_home_pos=opponent_home_pos,
+        opponent_away_pos=opponent_away_pos
+    )
+
+    flat_track_output = format_flat_track_context(flat_track_context, home, away, lang)
+    if flat_track_output:
+        parts.append(flat_track_output)
+        parts.append("\n\n")
+
+    # ===== ML PREDICTIONS =====
+    # All ML inputs are known now: extract features (referee, web news, congestion, motivation,
+    # coach, lineups, xG, flat track!) and run the models in a worker thread while the
+    # odds and accuracy sections below are formatted
+    ml_task = asyncio.create_task(asyncio.to_thread(
+        _compute_ml_predictions,
+        home_form=home_form,
+        away_form=away_form,
+        standings=standings,
+        odds=odds,
+        h2h=h2h.get("matches", []) if h2h else [],
+        home_team=home,
+        away_team=away,
+        referee_stats=referee_stats,
+        has_web_news=web_news.get("searched", False) if web_news else False,
+        congestion=congestion,
+        motivation=motivation,
+        team_class=team_class,
+        coach_factor=coach_factor,
+        lineups=lineups,  # Injuries data for ML
+        xg_data=xg_data,  # Real xG data for totals
+        player_impact=player_impact_data,  # KEY PLAYER IMPACT!
+        flat_track_context=flat_track_context  # Flat track bully analysis
+    ))
+
+    try:
+        # Odds with VALUE calculation, line movements, and bookmaker info
+        if odds:
+            bookmaker = odds.get("_bookmaker", "unknown")
+            bm_count = odds.get("_bookmakers_count", 1)
+            parts.append(f"💰 КОЭФФИЦИЕНТЫ ({bookmaker}, из {bm_count} букмекеров):\n")
+
+            # Skip metadata keys; implied probability = 100 / odds
+            parts.extend(f"  {k}: {v} (prob: {round(100 / v, 1)}%)\n"
+                         for k, v in odds.items()
+                         if not k.startswith("_") and isinstance(v, (int, float)) and v > 1)
+
+            # Line movements (sharp money indicator)
+            movements = odds.get("_line_movements", {})
+            has_history = movements.get("_has_history", False)
+            hours_tracked = movements.get("_hours_tracked", 0)
+
+            # Filter out metadata keys to get actual movements
+            actual_movements = {k: v for k, v in movements.items()
+                              if not k.startswith("_") and isinstance(v, dict)}
+
+            # Also check web search for odds movement info
+            web_odds_movement = web_news.get("odds_movement") if web_news else None
+
+            if actual_movements:
+                parts.append(f"\n📉 ДВИЖЕНИЕ ЛИНИЙ (за {hours_tracked:.1f}ч):\n")
+                for outcome, mv in actual_movements.items():
+                    sharp_icon = "🔥" if mv.get("sharp") else ""
+                    parts.append(f"  {outcome}: {mv['first']} → {mv['current']} ({mv['direction']}{abs(mv['pct']):.1f}%) {sharp_icon}\n")
+                sharp_moves = [m for m in actual_movements.values() if m.get("sharp")]
+                if sharp_moves:
+                    parts.append("  ⚡ SHARP MONEY DETECTED - линия упала значительно!\n")
+            elif web_odds_movement and web_odds_movement.get("detected"):
+                # Use web search data if no DB history
+                direction = "⬇️ ПАДАЮТ" if web_odds_movement["direction"] == "drop" else "⬆️ РАСТУТ"
+                parts.append(f"\n📉 ДВИЖЕНИЕ ЛИНИЙ (из новостей): Коэффициенты {direction}\n")
+                if web_odds_movement.get("details"):
+                    parts.append(f"  • {web_odds_movement['details']}\n")
+                if web_odds_movement["direction"] == "drop":
+                    parts.append("  ⚡ SHARP MONEY - профессионалы ставят на эту сторону!\n")
+            elif has_history:
+                # We have history but no significant movements
+                parts.append(f"\n📉 ДВИЖЕНИЕ ЛИНИЙ (за {hours_tracked:.1f}ч): Стабильно ✓\n")
+            else:
+                # First time seeing this match - explain
+                parts.append("\n📉 ДВИЖЕНИЕ ЛИНИЙ: 📊 Начато отслеживание\n")
+                parts.append("  ℹ️ При повторном анализе покажем изменения\n")
+
+            # Value bets (our odds vs average)
+            value_bets = odds.get("_value_bets", {})
+            if value_bets:
+                parts.append("\n💎 VALUE BETS (коэфф выше среднего):\n")
+                for outcome, vb in value_bets.items():
+                    parts.append(f"  {outcome}: {vb['odds']} vs avg {vb['avg']:.2f} (+{vb['value_pct']:.1f}% value)\n")
+
+            parts.append("\n")
+
+        # Bot's historical performance (to inform AI)
+        if bot_stats and bot_stats["total"] >= 10:
+            parts.append("📈 ИСТОРИЧЕСКАЯ ТОЧНОСТЬ БОТА:\n")
+            parts.append(f"  Общая: {bot_stats['overall_accuracy']}% ({bot_stats['correct']}/{bot_stats['total']})\n")
+            if bot_stats["best_bet_types"]:
+                parts.append(f"  Лучшие типы ставок: {', '.join(islice(bot_stats['best_bet_types'], 3))}\n")
+            for rec in islice(bot_stats["recommendations"], 2):
+                parts.append(f"  💡 {rec}\n")
+            parts.append("\n")
+
+        # Features + ML predictions (if models are trained) from the worker thread
+        ml_features, ml_predictions = await ml_task
+    finally:
+        ml_task.cancel()  # no-op once finished; a formatting error must not orphan the task
+
+    if ml_predictions:
+        parts.append("🤖 ML МОДЕЛЬ ПРЕДСКАЗЫВАЕТ:\n")
+        for cat, pred in ml_predictions.items():
+            name = ML_CATEGORY_NAMES.get(cat, cat)
+            conf = pred["confidence"]
+            parts.append(f"  {name}: {conf:.0f}% вероятность\n")
+        parts.append("  ⚠️ ML модель обучена на исторических данных бота\n\n")
+
+    # 🤖 ENSEMBLE ML - Multiple models voting
+    ensemble_result = get_ensemble_prediction(ml_features, "match_result")
+    ensemble_context = format_ensemble_prediction(ensemble_result, lang)
+    if ensemble_context:
+        parts.append(ensemble_context)
+        parts.append("\n\n")
+
+    # Store features for future ML training (will be linked to prediction later)
+    # Features are stored in match context for saving after Claude response
+
+    # ===== LEARNING FROM PAST ERRORS =====
+    # Get lessons from past prediction errors for this league
+    learning_context = get_learning_context(comp_code)
+    if learning_context:
+        parts.append(f"\n{learning_context}\n\n")
+        parts.append("⚠️ ВАЖНО: Учти эти уроки при анализе! Не повторяй прошлые ошибки.\n\n")
+
+    # ===== SMART LEARNING - CONDITION-BASED FEEDBACK =====
+    # Tell Claude about specific conditions that historically led to errors/successes
+    # This influences HOW Claude analyzes, not just adjusts confidence after
+    smart_learning_context = get_smart_learning_context_for_claude(ml_features, comp_code)
+    if smart_learning_context:
+        parts.append(f"{smart_learning_context}\n\n")
 
-🎯 **ОСНОВНАЯ СТАВКА** (Уверенность: X%):
-[Тип ставки] @ [коэфф]
-📊 Value: [твоя вероятность]% - [implied]% = [+X% VALUE]
-💰 Банк: X%
-📝 Почему: [основано на edge stacking выше]
+    # ===== ROI-BASED RECOMMENDATIONS =====
+    # Show which bets are actually PROFITABLE, not just winning
+    roi_context = get_roi_based_recommendations(ml_features)
+    if roi_context:
+        parts.append(f"{roi_context}\n\n")
 
-📈 **АЛЬТЕРНАТИВЫ (3 шт):**
-[ALT1] [Ставка] @ [коэфф] | [X]%
-[ALT2] [Ставка] @ [коэфф] | [X]%
-[ALT3] [Ставка] @ [коэфф] | [X]%
+    # User settings for filtering
+    filter_info = ""
+    if user_settings:
+        filter_info = f"""
+User preferences:
+- Min odds: {user_settings.get('min_odds', 1.3)}
+- Max odds: {user_settings.get('max_odds', 3.0)}
+- Risk level: {user_settings.get('risk_level', 'medium')}
+"""
 
-⚠️ **РИСКИ / TRAP GAMES:**
-[Конкретные риски + есть ли признаки trap game]
+    analysis_data = "".join(parts)
 
-✅ **ВЕРДИКТ:**
-[🔥 СИЛЬНАЯ (3+ факторов) / ⚡ ХОРОШАЯ (2 фактора) / ⚠️ РИСКОВАННАЯ (1 фактор) / 🚫 ПРОПУСТИТЬ]
+    # Language instruction
+    lang_instruction = LANG_INSTRUCTIONS.get(lang, LANG_INSTRUCTIONS["ru"])
 
-Bank: 85%+=5%, 75-84%=4%, 65-74%=3%, 55-64%=2%, <55%=skip"""
+    prompt = ANALYSIS_PROMPT_TMPL.format(lang_instruction=lang_instruction,
+                                         analysis_data=analysis_data,
+                                         filter_info=filter_info, home=home, away=away)
 
     try:
-        message = claude_client.messages.create(
-            model="claude-sonnet-4-20250514",
-            max_tokens=1500,
-            messages=[{"role": "user", "content": prompt}]
-        )
+        analysis_text = await claude_complete_cached(prompt, max_tokens=1500, system=ANALYSIS_SYSTEM_PROMPT,
+                                                     on_progress=on_progress)
         # Add league_code to features for learning system
         if ml_features:
             ml_features["league_code"] = comp_code
-        return message.content[0].text, ml_features
+        return analysis_text, ml_features
     except Exception as e:
         logger.error(f"Analysis error: {e}")
         return f"Error: {e}", None
 
 
+# League filter codes -> lowercased competition names (substring-matched in get_recommendations_enhanced)
+_RECOMMENDATION_LEAGUE_NAMES_LC = {
+    "PL": "premier league",
+    "PD": "primera division",
+    "BL1": "bundesliga",
+    "SA": "serie a",
+    "FL1": "ligue 1",
+    "CL": "uefa champions league",
+    "BSA": "brasileirão"
+}
+
+
+async def _recommendation_matches_text(matches: list, lang: str, user_tz: str) -> tuple[str, int]:
+    """Context lines for each match of the recommendations prompt and how many matches they cover."""
+    # Form data - one concurrent fetch per distinct team
+    top_matches = [(m, match_view(m)) for m in matches]
+    team_ids = list({tid for _, v in top_matches for tid in (v.home_id, v.away_id) if tid})
+    form_results = await asyncio.gather(*(get_team_form(tid) for tid in team_ids),
+                                        return_exceptions=True)
+    forms_by_id = {tid: (None if isinstance(res, Exception) else res)
+                   for tid, res in zip(team_ids, form_results)}
+
+    matches_data = []
+    for m, v in top_matches:
+        home, away, comp, utc_date = v.home, v.away, v.comp, v.utc
+
+        home_form = forms_by_id.get(v.home_id)
+        away_form = forms_by_id.get(v.away_id)
+
+        # Get warnings
+        warnings = get_match_warnings(m, home_form, away_form, lang)
+
+        # Format match time for user's timezone
+        match_time = format_match_datetime(utc_date, user_tz, lang) if utc_date else ""
+
+        info_lines = [f"{home} vs {away} ({comp})"]
+        if match_time:
+            info_lines.append(f"  {match_time}")
+        if warnings:
+            info_lines.append("  ⚠️ " + ", ".join(warnings))
+        if home_form:
+            info_lines.append(f"  {home} форма: {home_form['form']}")
+        if away_form:
+            info_lines.append(f"  {away} форма: {away_form['form']}")
+
+        matches_data.append("\n".join(info_lines))
+
+    return "\n\n".join(matches_data), len(matches_data)
+
+
 async def get_recommendations_enhanced(matches: list, user_query: str = "",
                                        user_settings: Optional[dict] = None,
                                        league_filter: Optional[str] = None,
@@ -12261,53 +13289,13 @@ async def get_recommendations_enhanced(matches: list, user_query: str = "",
 
     # Filter by league
     if league_filter:
-        league_names = {
-            "PL": "Premier League",
-            "PD": "Primera Division",
-            "BL1": "Bundesliga",
-            "SA": "Serie A",
-            "FL1": "Ligue 1",
-            "CL": "UEFA Champions League",
-            "BSA": "Brasileirão"
-        }
-        target_league = league_names.get(league_filter, league_filter) or ""
-        matches = [m for m in matches if target_league.lower() in (m.get("competition", {}).get("name") or "").lower()]
+        target_lc = _RECOMMENDATION_LEAGUE_NAMES_LC.get(league_filter) or league_filter.lower()
+        matches = [m for m in matches if target_lc in (m.get("competition", {}).get("name") or "").lower()]
 
     if not matches:
         return "❌ Нет матчей для выбранной лиги." if lang == "ru" else "❌ No matches for selected league."
 
-    # Get form data for top matches (async)
-    matches_data = []
-    for m in matches[:8]:
-        home = m.get("homeTeam", {}).get("name", "?")
-        away = m.get("awayTeam", {}).get("name", "?")
-        comp = m.get("competition", {}).get("name", "?")
-        home_id = m.get("homeTeam", {}).get("id")
-        away_id = m.get("awayTeam", {}).get("id")
-        utc_date = m.get("utcDate", "")
-
-        home_form = await get_team_form(home_id) if home_id else None
-        away_form = await get_team_form(away_id) if away_id else None
-
-        # Get warnings
-        warnings = get_match_warnings(m, home_form, away_form, lang)
-
-        # Format match time for user's timezone
-        match_time = format_match_datetime(utc_date, user_tz, lang) if utc_date else ""
-
-        match_info = f"{home} vs {away} ({comp})"
-        if match_time:
-            match_info += f"\n  {match_time}"
-        if warnings:
-            match_info += f"\n  ⚠️ " + ", ".join(warnings)
-        if home_form:
-            match_info += f"\n  {home} форма: {home_form['form']}"
-        if away_form:
-            match_info += f"\n  {away} форма: {away_form['form']}"
-
-        matches_data.append(match_info)
-
-    matches_text = "\n\n".join(matches_data)
+    matches_text, match_count = await _recommendation_matches_text(matches[:8], lang, user_tz)
     
     # User preferences
     filter_info = ""
@@ -12323,68 +13311,18 @@ FILTER BY USER PREFERENCES:
 """
     
     # Language instruction
-    lang_map = {
-        "ru": "Отвечай на русском языке.",
-        "en": "Respond in English.",
-        "pt": "Responda em português.",
-        "es": "Responde en español.",
-        "id": "Jawab dalam Bahasa Indonesia."
-    }
-    lang_instruction = lang_map.get(lang, lang_map["ru"])
+    lang_instruction = LANG_INSTRUCTIONS.get(lang, LANG_INSTRUCTIONS["ru"])
     
-    prompt = f"""{lang_instruction}
-
-User asked: "{user_query}"
-
-Analyze these matches with form data and give TOP 3-4 picks:
-
-{matches_text}
-
-{filter_info}
-
-RULES:
-1. VALUE BETTING FOR ROI - find bets where confidence × odds > 1.2 (20% edge)
-   Example: 65% confidence × 2.0 odds = 1.30 VALUE ✓ (good bet)
-   Example: 80% confidence × 1.3 odds = 1.04 VALUE ✗ (waste of confidence)
-
-2. PREFER HIGHER ODDS with solid confidence over "safe" low odds bets
-   - A 60% bet @ 2.2 odds (VALUE=1.32) beats 80% bet @ 1.3 odds (VALUE=1.04)
-   - Target odds range: 1.7 - 3.0 for best ROI potential
-   - Low odds (<1.5) only if confidence is 85%+
-
-3. ANALYZE ALL BET TYPES fairly - each has its place:
-   - П1/П2: good when there's clear class difference + form advantage
-   - Double Chance: safer but need decent odds (1.4+)
-   - Over/Under: check actual goals averages and H2H totals
-   - BTTS: check if both teams score regularly (>60% matches)
-   - Draw: only when teams are truly equal AND low-scoring history
-
-4. For TOP CLUBS - they rarely lose but draws happen, consider 1X or X2
-5. Cup matches = more upsets, adjust confidence down 10%
-6. If warnings present - lower confidence by 10-15%
-7. CRITICAL: Include 📅 date/time for EVERY match!
-{f'8. ONLY recommend bets with {min_confidence}%+ confidence!' if min_confidence > 0 else ''}
-
-FORMAT (STRICTLY follow this format, including the 📅 line with date/time):
-🔥 **ТОП СТАВКИ:**
-
-1️⃣ **[Home] vs [Away]** ([Competition])
-   📅 [REQUIRED: Copy the exact date/time from match data, e.g. "📅 Сегодня 21:00"]
-   ⚡ [Bet type] @ ~X.XX
-   📊 Уверенность: X%
-   📝 [1-2 sentences why]
-
-2️⃣ ...
-
-💡 **Общий совет:** [1 sentence]"""
+    confidence_rule = f"8. ONLY recommend bets with {min_confidence}%+ confidence!" if min_confidence > 0 else ""
+    prompt = RECOMMENDATIONS_PROMPT_TMPL.format(lang_instruction=lang_instruction,
+                                                user_query=user_query, matches_text=matches_text,
+                                                filter_info=filter_info,
+                                                confidence_rule=confidence_rule)
 
     try:
-        message = claude_client.messages.create(
-            model="claude-sonnet-4-20250514",
-            max_tokens=1200,
-            messages=[{"role": "user", "content": prompt}]
-        )
-        return message.content[0].text
+        # Reply is one pick block per match (TOP 3-4 at most) plus a short tip
+        max_tokens = min(1200, 400 + 200 * min(match_count, 4))
+        return await claude_complete_cached(prompt, max_tokens=max_tokens, system=RECOMMENDATIONS_SYSTEM_PROMPT)
     except Exception as e:
         logger.error(f"Recommendations error: {e}")
         return None
@@ -12477,7 +13415,7 @@ Silakan pilih bahasa Anda:"""
 
 async def menu_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show main menu (can be called anytime)"""
-    user_data = get_user(update.effective_user.id)
+    user_data = get_user_cached(update.effective_user.id)
     if not user_data:
         lang = detect_language(update.effective_user)
         is_new = create_user(update.effective_user.id, update.effective_user.username, lang)
@@ -12495,8 +13433,9 @@ async def menu_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await show_main_menu(update, context, lang)
 
 
-async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, lang: str):
-    """Show the main inline menu"""
+@lru_cache(maxsize=16)
+def _main_menu_markup(lang: str) -> InlineKeyboardMarkup:
+    """Main inline menu for a language - built once, markups are immutable"""
     keyboard = [
         [InlineKeyboardButton(get_text("recommendations", lang), callback_data="cmd_recommend"),
          InlineKeyboardButton(get_text("today", lang), callback_data="cmd_today")],
@@ -12510,7 +13449,17 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, lan
          InlineKeyboardButton(get_text("referral_btn", lang), callback_data="cmd_referral")],
         [InlineKeyboardButton(get_text("help", lang), callback_data="cmd_help")]
     ]
+    return InlineKeyboardMarkup(keyboard)
 
+
+@lru_cache(maxsize=16)
+def _back_markup(lang: str) -> InlineKeyboardMarkup:
+    """Single "back to menu" button for a language"""
+    return InlineKeyboardMarkup([[InlineKeyboardButton(get_text("back", lang), callback_data="cmd_start")]])
+
+
+async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, lang: str):
+    """Show the main inline menu"""
     text = f"""⚽ **AI Betting Bot v14**
 
 {get_text('welcome', lang)}
@@ -12525,44 +13474,60 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, lan
     )
     await update.message.reply_text(
         get_text("choose_action", lang),
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=_main_menu_markup(lang)
     )
 
 
+def _day_matches_text(matches: list, lang: str, user_tz: str, label_key: str) -> str:
+    """Match list for /today, /tomorrow and their menu buttons, up to 5 per competition."""
+    by_comp = defaultdict(list)
+    for m in matches:
+        comp_matches = by_comp[m.get("competition", {}).get("name", "Other")]
+        if len(comp_matches) < 5:
+            comp_matches.append(match_view(m))
+
+    parts = [f"{get_text(label_key, lang)} ({get_tz_offset_str(user_tz)}):\n\n"]
+    for comp, ms in by_comp.items():
+        parts.append(f"🏆 **{comp}**\n")
+        parts.extend(f"  ⏰ {convert_utc_to_user_tz(v.utc, user_tz)} | {v.home} vs {v.away}\n" for v in ms)
+        parts.append("\n")
+    return "".join(parts)
+
+
+async def _render_day(query, user, lang: str, date_filter: str, label_key: str, rec_callback: str) -> None:
+    """cmd_today / cmd_tomorrow menu buttons: edit the message into that day's match list."""
+    user_tz = user.get("timezone", "Europe/Moscow") if user else "Europe/Moscow"
+    await edit_message_throttled(query, get_text("analyzing", lang))
+    matches = await get_day_matches(date_filter)
+    if not matches:
+        await edit_message_throttled(query, get_text("no_matches", lang))
+        return
+
+    keyboard = [
+        [InlineKeyboardButton(get_text(f"recs_{date_filter}", lang), callback_data=rec_callback)],
+        [InlineKeyboardButton(get_text("back", lang), callback_data="cmd_start")]
+    ]
+    await edit_message_throttled(query, _day_matches_text(matches, lang, user_tz, label_key),
+                                 reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+
+
 async def today_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show today's matches"""
-    user = get_user(update.effective_user.id)
+    user = get_user_cached(update.effective_user.id)
     lang = user.get("language", "ru") if user else "ru"
     user_tz = user.get("timezone", "Europe/Moscow") if user else "Europe/Moscow"
     exclude_cups = user.get("exclude_cups", 0) if user else 0
 
     status = await update.message.reply_text(get_text("analyzing", lang))
 
-    matches = await get_matches(date_filter="today")
+    matches = await get_day_matches("today")
     matches = filter_cup_matches(matches, exclude=bool(exclude_cups))
 
     if not matches:
         await status.edit_text(get_text("no_matches", lang))
         return
     
-    by_comp = {}
-    for m in matches:
-        comp = m.get("competition", {}).get("name", "Other")
-        if comp not in by_comp:
-            by_comp[comp] = []
-        by_comp[comp].append(m)
-    
-    tz_info = get_tz_offset_str(user_tz)
-    text = f"{get_text('matches_today', lang)} ({tz_info}):\n\n"
-
-    for comp, ms in by_comp.items():
-        text += f"🏆 **{comp}**\n"
-        for m in ms[:5]:
-            home = m.get("homeTeam", {}).get("name", "?")
-            away = m.get("awayTeam", {}).get("name", "?")
-            time_str = convert_utc_to_user_tz(m.get("utcDate", ""), user_tz)
-            text += f"  ⏰ {time_str} | {home} vs {away}\n"
-        text += "\n"
+    text = _day_matches_text(matches, lang, user_tz, "matches_today")
 
     keyboard = [
         [InlineKeyboardButton(get_text("recs_today", lang), callback_data="rec_today")],
@@ -12574,36 +13539,19 @@ async def today_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def tomorrow_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show tomorrow's matches"""
-    user = get_user(update.effective_user.id)
+    user = get_user_cached(update.effective_user.id)
     lang = user.get("language", "ru") if user else "ru"
     user_tz = user.get("timezone", "Europe/Moscow") if user else "Europe/Moscow"
     
     status = await update.message.reply_text(get_text("analyzing", lang))
     
-    matches = await get_matches(date_filter="tomorrow")
+    matches = await get_day_matches("tomorrow")
     
     if not matches:
         await status.edit_text(get_text("no_matches", lang))
         return
     
-    by_comp = {}
-    for m in matches:
-        comp = m.get("competition", {}).get("name", "Other")
-        if comp not in by_comp:
-            by_comp[comp] = []
-        by_comp[comp].append(m)
-    
-    tz_info = get_tz_offset_str(user_tz)
-    text = f"{get_text('matches_tomorrow', lang)} ({tz_info}):\n\n"
-
-    for comp, ms in by_comp.items():
-        text += f"🏆 **{comp}**\n"
-        for m in ms[:5]:
-            home = m.get("homeTeam", {}).get("name", "?")
-            away = m.get("awayTeam", {}).get("name", "?")
-            time_str = convert_utc_to_user_tz(m.get("utcDate", ""), user_tz)
-            text += f"  ⏰ {time_str} | {home} vs {away}\n"
-        text += "\n"
+    text = _day_matches_text(matches, lang, user_tz, "matches_tomorrow")
 
     keyboard = [
         [InlineKeyboardButton(get_text("recs_tomorrow", lang), callback_data="rec_tomorrow")],
@@ -12613,10 +13561,28 @@ async def tomorrow_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await status.edit_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
 
 
+@lru_cache(maxsize=256)
+def _settings_markup(lang: str, min_odds, max_odds, risk_level: str,
+                     exclude_cups: bool, tz_display: str) -> InlineKeyboardMarkup:
+    """Settings keyboard for one combination of language and current values"""
+    sl = SETTINGS_LABELS.get(lang, SETTINGS_LABELS["ru"])
+    cups_status = f"✅ {sl['yes']}" if exclude_cups else f"❌ {sl['no']}"
+    keyboard = [
+        [InlineKeyboardButton(f"📉 {sl['min']}: {min_odds}", callback_data="set_min_odds")],
+        [InlineKeyboardButton(f"📈 {sl['max']}: {max_odds}", callback_data="set_max_odds")],
+        [InlineKeyboardButton(f"⚠️ {sl['risk']}: {risk_level}", callback_data="set_risk")],
+        [InlineKeyboardButton(f"🏆 {sl['exclude_cups']}: {cups_status}", callback_data="toggle_exclude_cups")],
+        [InlineKeyboardButton("🌍 Language", callback_data="set_language")],
+        [InlineKeyboardButton(f"🕐 {sl['tz']}: {tz_display}", callback_data="set_timezone")],
+        [InlineKeyboardButton(get_text("back", lang), callback_data="cmd_start")]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+
 async def settings_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show settings menu"""
     user_id = update.effective_user.id
-    user = get_user(user_id)
+    user = get_user_cached(user_id)
 
     if not user:
         lang = detect_language(update.effective_user)
@@ -12629,35 +13595,20 @@ async def settings_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 lang,
                 "organic"
             )
-        user = get_user(user_id)
+        user = get_user_cached(user_id)
     
     lang = user.get("language", "ru")
     user_tz = user.get("timezone", "Europe/Moscow")
     tz_display = get_tz_offset_str(user_tz)
     
-    # Localized settings labels
-    settings_labels = {
-        "ru": {"title": "⚙️ **НАСТРОЙКИ**", "min": "Мин. коэфф", "max": "Макс. коэфф", "risk": "Риск", "tz": "Часовой пояс", "premium": "Премиум", "yes": "Да", "no": "Нет", "tap_to_change": "Нажми на параметр чтобы изменить:", "exclude_cups": "Исключить кубки"},
-        "en": {"title": "⚙️ **SETTINGS**", "min": "Min odds", "max": "Max odds", "risk": "Risk", "tz": "Timezone", "premium": "Premium", "yes": "Yes", "no": "No", "tap_to_change": "Tap to change:", "exclude_cups": "Exclude cups"},
-        "pt": {"title": "⚙️ **CONFIGURAÇÕES**", "min": "Odds mín", "max": "Odds máx", "risk": "Risco", "tz": "Fuso horário", "premium": "Premium", "yes": "Sim", "no": "Não", "tap_to_change": "Toque para alterar:", "exclude_cups": "Excluir copas"},
-        "es": {"title": "⚙️ **AJUSTES**", "min": "Cuota mín", "max": "Cuota máx", "risk": "Riesgo", "tz": "Zona horaria", "premium": "Premium", "yes": "Sí", "no": "No", "tap_to_change": "Toca para cambiar:", "exclude_cups": "Excluir copas"},
-        "id": {"title": "⚙️ **PENGATURAN**", "min": "Odds min", "max": "Odds maks", "risk": "Risiko", "tz": "Zona waktu", "premium": "Premium", "yes": "Ya", "no": "Tidak", "tap_to_change": "Ketuk untuk mengubah:", "exclude_cups": "Kecualikan piala"},
-    }
-    sl = settings_labels.get(lang, settings_labels["ru"])
+    sl = SETTINGS_LABELS.get(lang, SETTINGS_LABELS["ru"])
 
     # Exclude cups toggle
     exclude_cups = user.get('exclude_cups', 0)
     cups_status = f"✅ {sl['yes']}" if exclude_cups else f"❌ {sl['no']}"
 
-    keyboard = [
-        [InlineKeyboardButton(f"📉 {sl['min']}: {user['min_odds']}", callback_data="set_min_odds")],
-        [InlineKeyboardButton(f"📈 {sl['max']}: {user['max_odds']}", callback_data="set_max_odds")],
-        [InlineKeyboardButton(f"⚠️ {sl['risk']}: {user['risk_level']}", callback_data="set_risk")],
-        [InlineKeyboardButton(f"🏆 {sl['exclude_cups']}: {cups_status}", callback_data="toggle_exclude_cups")],
-        [InlineKeyboardButton("🌍 Language", callback_data="set_language")],
-        [InlineKeyboardButton(f"🕐 {sl['tz']}: {tz_display}", callback_data="set_timezone")],
-        [InlineKeyboardButton(get_text("back", lang), callback_data="cmd_start")]
-    ]
+    reply_markup = _settings_markup(lang, user['min_odds'], user['max_odds'], user['risk_level'],
+                                    bool(exclude_cups), tz_display)
 
     premium_status = f"✅ {sl['yes']}" if user.get('is_premium') else f"❌ {sl['no']}"
     text = f"""{sl['title']}
@@ -12673,15 +13624,26 @@ async def settings_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 {sl['tap_to_change']}"""
     
     if update.callback_query:
-        await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        await update.callback_query.edit_message_text(text, reply_markup=reply_markup, parse_mode="Markdown")
     else:
-        await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        await update.message.reply_text(text, reply_markup=reply_markup, parse_mode="Markdown")
+
+
+@lru_cache(maxsize=16)
+def _favorites_markup(lang: str) -> InlineKeyboardMarkup:
+    """Favorites menu keyboard for a language"""
+    add_league_label = {"ru": "➕ Добавить лигу", "en": "➕ Add league", "pt": "➕ Adicionar liga", "es": "➕ Añadir liga", "id": "➕ Tambah liga"}
+    keyboard = [
+        [InlineKeyboardButton(add_league_label.get(lang, add_league_label["en"]), callback_data="add_fav_league")],
+        [InlineKeyboardButton(get_text("back", lang), callback_data="cmd_start")]
+    ]
+    return InlineKeyboardMarkup(keyboard)
 
 
 async def favorites_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show favorites menu"""
     user_id = update.effective_user.id
-    user = get_user(user_id)
+    user = get_user_cached(user_id)
     lang = user.get("language", "ru") if user else "ru"
     
     teams = get_favorite_teams(user_id)
@@ -12707,22 +13669,16 @@ async def favorites_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     text += "\n💡 Напиши название команды и нажми ⭐" if lang == "ru" else "\n💡 Type team name and tap ⭐"
     
-    add_league_label = {"ru": "➕ Добавить лигу", "en": "➕ Add league", "pt": "➕ Adicionar liga", "es": "➕ Añadir liga", "id": "➕ Tambah liga"}
-    keyboard = [
-        [InlineKeyboardButton(add_league_label.get(lang, add_league_label["en"]), callback_data="add_fav_league")],
-        [InlineKeyboardButton(get_text("back", lang), callback_data="cmd_start")]
-    ]
-    
     if update.callback_query:
-        await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        await update.callback_query.edit_message_text(text, reply_markup=_favorites_markup(lang), parse_mode="Markdown")
     else:
-        await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        await update.message.reply_text(text, reply_markup=_favorites_markup(lang), parse_mode="Markdown")
 
 
 async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int = 0):
     """Show user statistics with categories and pagination"""
     user_id = update.effective_user.id
-    user = get_user(user_id)
+    user = get_user_cached(user_id)
     lang = user.get("language", "ru") if user else "ru"
 
     stats = get_user_stats(user_id, page=page)
@@ -12800,21 +13756,9 @@ async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE, page: in
 
     # Stats by category
     if stats["categories"]:
-        cat_names = {
-            "totals_over": "ТБ 2.5",
-            "totals_under": "ТМ 2.5",
-            "outcomes_home": "П1",
-            "outcomes_away": "П2",
-            "outcomes_draw": "Ничья",
-            "btts": "Обе забьют",
-            "double_chance": "Двойной шанс",
-            "handicap": "Форы",
-            "other": "Другое"
-        }
-
         text += "📋 По типам ставок:\n"
         for cat, data in stats["categories"].items():
-            cat_name = cat_names.get(cat, cat)
+            cat_name = STATS_CATEGORY_NAMES.get(cat, cat)
             push_info = f" (+{data['push']}🔄)" if data.get('push', 0) > 0 else ""
             text += f"  • {cat_name}: {data['correct']}/{data['total'] - data.get('push', 0)} ({data['rate']}%){push_info}\n"
         text += "\n"
@@ -12824,29 +13768,13 @@ async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE, page: in
     total_pages = stats.get("total_pages", 1)
     page_info = f" (стр. {current_page + 1}/{total_pages})" if total_pages > 1 else ""
 
-    text += f"{'─'*25}\n📝 Последние прогнозы{page_info}:\n"
-    for p in stats.get("predictions", []):
-        if p["is_correct"] is None:
-            emoji = "⏳"
-            result_text = "ожидаем"
-        elif p["is_correct"] == 1:
-            emoji = "✅"
-            result_text = p["result"] or "выиграл"
-        elif p["is_correct"] == 2:
-            emoji = "🔄"
-            result_text = f"{p['result']} (возврат)"
-        else:
-            emoji = "❌"
-            result_text = p["result"] or "проиграл"
-
-        home_short = p["home"][:10] + ".." if len(p["home"]) > 12 else p["home"]
-        away_short = p["away"][:10] + ".." if len(p["away"]) > 12 else p["away"]
-
-        text += f"{emoji} {home_short} - {away_short}\n"
-        text += f"    📊 {p['bet_type']} ({p['confidence']}%) → {result_text}\n"
+    parts = [text, f"{'─'*25}\n📝 Последние прогнозы{page_info}:\n"]
+    parts.extend(f"{p['emoji']} {md_escape(p['home_short'])} - {md_escape(p['away_short'])}\n"
+                 f"    📊 {md_escape(p['bet_type'])} ({p['confidence']}%) → {md_escape(p['result_text'])}\n"
+                 for p in stats.get("predictions", []))
+    text = "".join(parts)
 
     # Build keyboard with pagination
-    refresh_label = {"ru": "🔄 Обновить", "en": "🔄 Refresh", "pt": "🔄 Atualizar", "es": "🔄 Actualizar", "id": "🔄 Perbarui"}
 
     # Pagination buttons
     nav_buttons = []
@@ -12858,7 +13786,7 @@ async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE, page: in
     keyboard = []
     if nav_buttons:
         keyboard.append(nav_buttons)
-    keyboard.append([InlineKeyboardButton(refresh_label.get(lang, refresh_label["en"]), callback_data="cmd_stats")])
+    keyboard.append([InlineKeyboardButton(REFRESH_LABELS.get(lang, REFRESH_LABELS["en"]), callback_data="cmd_stats")])
     keyboard.append([InlineKeyboardButton(get_text("back", lang), callback_data="cmd_start")])
 
     if update.callback_query:
@@ -12867,6 +13795,7 @@ async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE, page: in
         await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
 
 
+@per_user_lock
 async def debug_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Debug command to check user status and limits (ADMIN ONLY)"""
     user_id = update.effective_user.id
@@ -12882,7 +13811,7 @@ async def debug_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"User {user_id} not found in DB")
         return
     
-    can_use, remaining, use_bonus = check_daily_limit(user_id)
+    can_use, remaining, use_bonus = await asyncio.to_thread(check_daily_limit, user_id)
     bonus_predictions = user.get('bonus_predictions', 0)
 
     text = f"""🔧 DEBUG INFO
@@ -12919,15 +13848,16 @@ async def debug_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
 
 
+@per_user_lock
 async def recommend_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Get recommendations with user preferences"""
     user_id = update.effective_user.id
-    user = get_user(user_id)
+    user = get_user_cached(user_id)
     lang = user.get("language", "ru") if user else "ru"
     exclude_cups = user.get("exclude_cups", 0) if user else 0
 
     # Check daily limit
-    can_use, remaining, use_bonus = check_daily_limit(user_id)
+    can_use, remaining, use_bonus = await asyncio.to_thread(check_daily_limit, user_id)
     if not can_use:
         # Check if user can claim referral bonus
         ref_bonus = check_referral_bonus_eligible(user_id)
@@ -12949,7 +13879,7 @@ async def recommend_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     status = await update.message.reply_text(get_text("analyzing", lang))
 
-    matches = await get_matches(days=7)
+    matches = await get_upcoming_matches(7)
     matches = filter_cup_matches(matches, exclude=bool(exclude_cups))
 
     if not matches:
@@ -12980,7 +13910,7 @@ async def recommend_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             keyboard.append(bet_btn)
         keyboard.append([InlineKeyboardButton(get_text("today", lang), callback_data="cmd_today"),
              InlineKeyboardButton(get_text("referral_btn", lang), callback_data="cmd_referral")])
-        increment_daily_usage(user_id)
+        await asyncio.to_thread(increment_daily_usage, user_id)
         try:
             await status.edit_text(social_header + recs, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
         except Exception as e:
@@ -12991,15 +13921,16 @@ async def recommend_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await status.edit_text(get_text("analysis_error", lang))
 
 
+@per_user_lock
 async def sure_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Get only HIGH CONFIDENCE (75%+) recommendations"""
     user_id = update.effective_user.id
-    user = get_user(user_id)
+    user = get_user_cached(user_id)
     lang = user.get("language", "ru") if user else "ru"
     exclude_cups = user.get("exclude_cups", 0) if user else 0
 
     # Check daily limit
-    can_use, remaining, use_bonus = check_daily_limit(user_id)
+    can_use, remaining, use_bonus = await asyncio.to_thread(check_daily_limit, user_id)
     if not can_use:
         text = get_limit_text(lang)
         keyboard = []
@@ -13011,7 +13942,7 @@ async def sure_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     status = await update.message.reply_text(get_text("sure_searching", lang))
 
-    matches = await get_matches(days=7)
+    matches = await get_upcoming_matches(7)
     matches = filter_cup_matches(matches, exclude=bool(exclude_cups))
 
     if not matches:
@@ -13035,7 +13966,7 @@ async def sure_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             keyboard.append(bet_btn)
         keyboard.append([InlineKeyboardButton("📊 Все ставки", callback_data="cmd_recommend"),
              InlineKeyboardButton(get_text("referral_btn", lang), callback_data="cmd_referral")])
-        increment_daily_usage(user_id)
+        await asyncio.to_thread(increment_daily_usage, user_id)
         await status.edit_text(header + recs, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
     else:
         await status.edit_text(get_text("no_sure_bets", lang))
@@ -13043,7 +13974,7 @@ async def sure_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Help command"""
-    user = get_user(update.effective_user.id)
+    user = get_user_cached(update.effective_user.id)
     lang = user.get("language", "ru") if user else "ru"
 
     text = f"""❓ **ПОМОЩЬ**
@@ -13079,12 +14010,10 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • BTTS - Обе забьют
 • 1X/X2 - Двойной шанс"""
 
-    keyboard = [[InlineKeyboardButton(get_text("back", lang), callback_data="cmd_start")]]
-
     if update.callback_query:
-        await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        await update.callback_query.edit_message_text(text, reply_markup=_back_markup(lang), parse_mode="Markdown")
     else:
-        await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        await update.message.reply_text(text, reply_markup=_back_markup(lang), parse_mode="Markdown")
 
 
 def get_geo_prices_text(geo: str) -> str:
@@ -13108,17 +14037,16 @@ async def premium_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Check if monetization is disabled - show "coming soon"
     if not MONETIZATION_ENABLED:
         coming_soon_text = get_text("premium_coming_soon", lang)
-        keyboard = [[InlineKeyboardButton(get_text("back", lang), callback_data="cmd_start")]]
         if update.callback_query:
             await update.callback_query.edit_message_text(
                 coming_soon_text,
-                reply_markup=InlineKeyboardMarkup(keyboard),
+                reply_markup=_back_markup(lang),
                 parse_mode="Markdown"
             )
         else:
             await update.message.reply_text(
                 coming_soon_text,
-                reply_markup=InlineKeyboardMarkup(keyboard),
+                reply_markup=_back_markup(lang),
                 parse_mode="Markdown"
             )
         return
@@ -13128,10 +14056,11 @@ async def premium_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Check if already premium
     is_prem = user.get("is_premium", 0) if user else 0
-    expires = user.get("premium_expires") if user else None
+    expires = user.get("premium_expires_ts") if user else None
 
     if is_prem and expires:
-        status_text = get_text("premium_status", lang).format(date=expires[:10]) + "\n\n"
+        expires_date = datetime.fromtimestamp(expires).strftime("%Y-%m-%d")
+        status_text = get_text("premium_status", lang).format(date=expires_date) + "\n\n"
     else:
         status_text = ""
 
@@ -13218,7 +14147,7 @@ async def premium_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def referral_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show referral program info and stats"""
     user_id = update.effective_user.id
-    user = get_user(user_id)
+    user = get_user_cached(user_id)
     lang = user.get("language", "ru") if user else "ru"
 
     # Get referral stats
@@ -13277,101 +14206,66 @@ async def referral_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "id": "🎁 Klaim +3 prediksi"
         }
         keyboard.append([InlineKeyboardButton(claim_btn_text.get(lang, claim_btn_text["en"]), callback_data="claim_ref_bonus")])
-    keyboard.append([InlineKeyboardButton(get_text("referral_invite_btn", lang), url=f"https://t.me/share/url?url={ref_link}&text=🔥")])
-    keyboard.append([InlineKeyboardButton(get_text("back", lang), callback_data="cmd_start")])
-
-    if update.callback_query:
-        await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
-    else:
-        await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
-
-
-async def history_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Show prediction history with filters"""
-    user_id = update.effective_user.id
-    user = get_user(user_id)
-    lang = user.get("language", "ru") if user else "ru"
-
-    # Parse filter from arguments: /history [all|wins|losses|pending] [count]
-    args = context.args if context.args else []
-    filter_type = "all"
-    limit = 10
-
-    for arg in args:
-        if arg in ["all", "wins", "losses", "pending"]:
-            filter_type = arg
-        elif arg.isdigit():
-            limit = min(int(arg), 50)  # Max 50
-
-    conn = get_db_connection()
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
+    keyboard.append([InlineKeyboardButton(get_text("referral_invite_btn", lang), url=f"https://t.me/share/url?url={ref_link}&text=🔥")])
+    keyboard.append([InlineKeyboardButton(get_text("back", lang), callback_data="cmd_start")])
 
-    # Build query based on filter
-    if filter_type == "wins":
-        c.execute("""SELECT * FROM predictions WHERE user_id = ? AND is_correct = 1
-                     ORDER BY predicted_at DESC LIMIT ?""", (user_id, limit))
-    elif filter_type == "losses":
-        c.execute("""SELECT * FROM predictions WHERE user_id = ? AND is_correct = 0
-                     ORDER BY predicted_at DESC LIMIT ?""", (user_id, limit))
-    elif filter_type == "pending":
-        c.execute("""SELECT * FROM predictions WHERE user_id = ? AND is_correct IS NULL
-                     ORDER BY predicted_at DESC LIMIT ?""", (user_id, limit))
+    if update.callback_query:
+        await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
     else:
-        c.execute("""SELECT * FROM predictions WHERE user_id = ?
-                     ORDER BY predicted_at DESC LIMIT ?""", (user_id, limit))
+        await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
 
-    predictions = c.fetchall()
-    conn.close()
 
-    if not predictions:
-        no_history = {
-            "ru": "📜 История пуста. Сделайте прогноз!",
-            "en": "📜 No history yet. Make a prediction!",
-            "pt": "📜 Histórico vazio. Faça uma previsão!",
-            "es": "📜 Sin historial. ¡Haz una predicción!",
-            "id": "📜 Riwayat kosong. Buat prediksi!"
-        }
-        await update.message.reply_text(no_history.get(lang, no_history["ru"]))
-        return
+def _fetch_history(user_id: int, filter_type: str, limit: int) -> list:
+    """Latest predictions of a user for /history (all / wins / losses / pending)."""
+    with ro_cursor() as c:
+        c.row_factory = sqlite3.Row  # per cursor - the pooled connection stays tuple-based
 
-    # Build history text
-    filter_labels = {
-        "all": {"ru": "ВСЕ", "en": "ALL", "pt": "TODOS", "es": "TODOS", "id": "SEMUA"},
-        "wins": {"ru": "ПОБЕДЫ", "en": "WINS", "pt": "VITÓRIAS", "es": "VICTORIAS", "id": "MENANG"},
-        "losses": {"ru": "ПОРАЖЕНИЯ", "en": "LOSSES", "pt": "DERROTAS", "es": "DERROTAS", "id": "KALAH"},
-        "pending": {"ru": "ОЖИДАЮТ", "en": "PENDING", "pt": "PENDENTES", "es": "PENDIENTES", "id": "MENUNGGU"}
-    }
-    filter_label = filter_labels[filter_type].get(lang, filter_labels[filter_type]["en"])
+        # Build query based on filter
+        if filter_type == "wins":
+            c.execute("""SELECT * FROM predictions WHERE user_id = ? AND is_correct = 1
+                         ORDER BY predicted_at DESC LIMIT ?""", (user_id, limit))
+        elif filter_type == "losses":
+            c.execute("""SELECT * FROM predictions WHERE user_id = ? AND is_correct = 0
+                         ORDER BY predicted_at DESC LIMIT ?""", (user_id, limit))
+        elif filter_type == "pending":
+            c.execute("""SELECT * FROM predictions WHERE user_id = ? AND is_correct IS NULL
+                         ORDER BY predicted_at DESC LIMIT ?""", (user_id, limit))
+        else:
+            c.execute("""SELECT * FROM predictions WHERE user_id = ?
+                         ORDER BY predicted_at DESC LIMIT ?""", (user_id, limit))
 
-    text = f"📜 **ИСТОРИЯ ПРОГНОЗОВ** ({filter_label})\n\n"
+        return c.fetchall()
 
+
+def _history_text(predictions: list, filter_label: str) -> str:
+    """Markdown history list shared by /history and the history_* filter buttons."""
+    parts = [f"📜 **ИСТОРИЯ ПРОГНОЗОВ** ({filter_label})\n\n"]
     for p in predictions:
         date_str = p["predicted_at"][:10] if p["predicted_at"] else "?"
-        home = p["home_team"] or "?"
-        away = p["away_team"] or "?"
-        bet = p["bet_type"] or "?"
+        home = md_escape(p["home_team"] or "?")
+        away = md_escape(p["away_team"] or "?")
+        bet = md_escape(p["bet_type"] or "?")
         conf = p["confidence"] or 0
         odds = p["odds"] or 0
 
-        # Result emoji
         if p["is_correct"] is None:
             result_emoji = "⏳"
-            result_text = "Ожидает"
         elif p["is_correct"] == 1:
             result_emoji = "✅"
-            result_text = "WIN"
         else:
             result_emoji = "❌"
-            result_text = "LOSE"
 
-        text += f"{result_emoji} **{home}** vs **{away}**\n"
-        text += f"   📅 {date_str} | {bet} @ {odds:.2f} ({conf}%)\n"
+        parts.append(f"{result_emoji} **{home}** vs **{away}**\n"
+                     f"   📅 {date_str} | {bet} @ {odds:.2f} ({conf}%)\n")
         if p["result"]:
-            text += f"   📊 Счёт: {p['result']}\n"
-        text += "\n"
+            parts.append(f"   📊 Счёт: {md_escape(p['result'])}\n")
+        parts.append("\n")
+    return "".join(parts)
 
-    # Add filter buttons
+
+@lru_cache(maxsize=16)
+def _history_markup(lang: str) -> InlineKeyboardMarkup:
+    """History filter buttons, shared by /history and the history_* callbacks"""
     keyboard = [
         [InlineKeyboardButton("🔄 Все", callback_data="history_all"),
          InlineKeyboardButton("✅ Победы", callback_data="history_wins")],
@@ -13379,63 +14273,117 @@ async def history_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
          InlineKeyboardButton("⏳ Ожидают", callback_data="history_pending")],
         [InlineKeyboardButton(get_text("back", lang), callback_data="cmd_start")]
     ]
+    return InlineKeyboardMarkup(keyboard)
 
-    await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
 
-
-async def admin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Admin panel - only for admins"""
+@per_user_lock
+async def history_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show prediction history with filters"""
     user_id = update.effective_user.id
+    user = get_user_cached(user_id)
+    lang = user.get("language", "ru") if user else "ru"
 
-    if not is_admin(user_id):
-        await update.message.reply_text("⛔ Только для администраторов")
-        return
+    # Parse filter from arguments: /history [all|wins|losses|pending] [count]
+    args = context.args if context.args else []
+    filter_type = "all"
+    limit = 10
 
-    # Get stats
-    conn = get_db_connection()
-    c = conn.cursor()
+    for arg in args:
+        if arg in ["all", "wins", "losses", "pending"]:
+            filter_type = arg
+        elif arg.isdigit():
+            limit = min(int(arg), 50)  # Max 50
 
-    # Total users
-    c.execute("SELECT COUNT(*) FROM users")
-    total_users = c.fetchone()[0]
+    predictions = await asyncio.to_thread(_fetch_history, user_id, filter_type, limit)
 
-    # Active today (safe query - column may not exist)
-    try:
-        c.execute("SELECT COUNT(*) FROM users WHERE last_active > datetime('now', '-1 day')")
-        active_today = c.fetchone()[0]
-    except:
-        active_today = "N/A"
+    if not predictions:
+        await update.message.reply_text(NO_HISTORY_TEXT.get(lang, NO_HISTORY_TEXT["ru"]))
+        return
 
-    # Premium users (safe query)
-    try:
-        c.execute("SELECT COUNT(*) FROM users WHERE is_premium = 1")
-        premium_users = c.fetchone()[0]
-    except:
-        premium_users = 0
+    # Build history text
+    filter_label = HISTORY_FILTER_LABELS[filter_type].get(lang, HISTORY_FILTER_LABELS[filter_type]["en"])
 
-    # Total predictions
-    c.execute("SELECT COUNT(*) FROM predictions")
-    total_predictions = c.fetchone()[0]
+    text = _history_text(predictions, filter_label)
+
+    # Add filter buttons
+    await update.message.reply_text(text, reply_markup=_history_markup(lang), parse_mode="Markdown")
+
+
+def _collect_admin_stats() -> dict:
+    """Counters for the admin panel - one pass over users and one over predictions."""
+    query = """
+        SELECT u.total, {active}, u.premium,
+               p.total, p.verified, p.correct, p.pending,
+               (SELECT COUNT(*) FROM live_subscribers)
+        FROM (SELECT COUNT(*) AS total,
+                     {active_sum}
+                     COALESCE(SUM(is_premium = 1), 0) AS premium
+              FROM users) u,
+             (SELECT COUNT(*) AS total,
+                     COUNT(is_correct) AS verified,
+                     COALESCE(SUM(is_correct = 1), 0) AS correct,
+                     COALESCE(SUM(is_correct IS NULL), 0) AS pending
+              FROM predictions) p
+    """
+    with ro_cursor() as c:
+        try:
+            c.execute(query.format(active="u.active",
+                                   active_sum="COALESCE(SUM(last_active > datetime('now', '-1 day')), 0) AS active,"))
+        except sqlite3.OperationalError:
+            # last_active column may not exist on old databases
+            c.execute(query.format(active="'N/A'", active_sum=""))
+        (total_users, active_today, premium_users, total_predictions,
+         verified, correct, pending_count, live_subs) = c.fetchone()
 
-    # Verified predictions
-    c.execute("SELECT COUNT(*), SUM(CASE WHEN is_correct = 1 THEN 1 ELSE 0 END) FROM predictions WHERE is_correct IS NOT NULL")
-    row = c.fetchone()
-    verified = row[0] or 0
-    correct = row[1] or 0
     accuracy = round(correct / verified * 100, 1) if verified > 0 else 0
 
-    # Live subscribers (from live_subscribers table)
-    c.execute("SELECT COUNT(*) FROM live_subscribers")
-    live_subs = c.fetchone()[0]
+    return {
+        "total_users": total_users,
+        "active_today": active_today,
+        "premium_users": premium_users,
+        "total_predictions": total_predictions,
+        "verified": verified,
+        "correct": correct,
+        "accuracy": accuracy,
+        "live_subs": live_subs,
+        "pending_count": pending_count,
+    }
 
-    # Pending predictions (waiting for results)
-    c.execute("SELECT COUNT(*) FROM predictions WHERE is_correct IS NULL")
-    pending_count = c.fetchone()[0]
 
-    conn.close()
+# Admin-only keyboards are Russian-only, so one immutable markup each is enough
+ADMIN_PANEL_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📢 Рассылка", callback_data="admin_broadcast"),
+     InlineKeyboardButton("👥 Юзеры", callback_data="admin_users")],
+    [InlineKeyboardButton("📊 Детальная статистика", callback_data="admin_stats"),
+     InlineKeyboardButton("📈 Источники", callback_data="admin_sources")],
+    [InlineKeyboardButton("🎯 Анализ точности", callback_data="admin_accuracy"),
+     InlineKeyboardButton("🤖 ML статистика", callback_data="admin_ml_stats")],
+    [InlineKeyboardButton("🧠 Обучение", callback_data="admin_learning"),
+     InlineKeyboardButton("🔔 Live-алерты", callback_data="admin_live_status")],
+    [InlineKeyboardButton("🧹 Очистить дубликаты", callback_data="admin_clean_dups"),
+     InlineKeyboardButton("▶️ Продолжить рассылку", callback_data="admin_resume_broadcast")],
+    [InlineKeyboardButton("🔙 В меню", callback_data="cmd_start")]
+])
+
+MLSTATUS_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔄 Обучить модели", callback_data="ml_train")],
+    [InlineKeyboardButton("🔙 В админку", callback_data="cmd_admin")]
+])
+
+
+async def admin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin panel - only for admins"""
+    user_id = update.effective_user.id
+
+    if not is_admin(user_id):
+        await update.message.reply_text("⛔ Только для администраторов")
+        return
+
+    # Get stats
+    stats = await asyncio.to_thread(_collect_admin_stats)
 
     # Get clean stats (without duplicates)
-    clean = get_clean_stats()
+    clean = await asyncio.to_thread(get_clean_stats)
     duplicates_info = ""
     if clean["duplicates_count"] > 0:
         duplicates_info = f"\n⚠️ **Дубликаты:** {clean['duplicates_count']} (искажают статистику!)"
@@ -13443,17 +14391,17 @@ async def admin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = f"""👑 **АДМИН-ПАНЕЛЬ**
 
 📊 **Статистика бота:**
-├ Всего юзеров: {total_users}
-├ Активных сегодня: {active_today}
-├ Premium: {premium_users}
-└ Live подписчики: {live_subs}
+├ Всего юзеров: {stats['total_users']}
+├ Активных сегодня: {stats['active_today']}
+├ Premium: {stats['premium_users']}
+└ Live подписчики: {stats['live_subs']}
 
 🎯 **Прогнозы:**
-├ Всего: {total_predictions}
-├ Проверенных: {verified}
-├ Верных: {correct}
-├ Точность (сырая): {accuracy}%
-└ ⏳ Pending: {pending_count}
+├ Всего: {stats['total_predictions']}
+├ Проверенных: {stats['verified']}
+├ Верных: {stats['correct']}
+├ Точность (сырая): {stats['accuracy']}%
+└ ⏳ Pending: {stats['pending_count']}
 
 📈 **Чистая статистика (без дубликатов):**
 ├ Уникальных: {clean['clean_total']}
@@ -13479,20 +14427,7 @@ async def admin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 ├ Админов: {len(ADMIN_IDS)}
 └ Твой ID: {user_id}"""
 
-    keyboard = [
-        [InlineKeyboardButton("📢 Рассылка", callback_data="admin_broadcast"),
-         InlineKeyboardButton("👥 Юзеры", callback_data="admin_users")],
-        [InlineKeyboardButton("📊 Детальная статистика", callback_data="admin_stats"),
-         InlineKeyboardButton("📈 Источники", callback_data="admin_sources")],
-        [InlineKeyboardButton("🎯 Анализ точности", callback_data="admin_accuracy"),
-         InlineKeyboardButton("🤖 ML статистика", callback_data="admin_ml_stats")],
-        [InlineKeyboardButton("🧠 Обучение", callback_data="admin_learning"),
-         InlineKeyboardButton("🔔 Live-алерты", callback_data="admin_live_status")],
-        [InlineKeyboardButton("🧹 Очистить дубликаты", callback_data="admin_clean_dups"),
-         InlineKeyboardButton("🔙 В меню", callback_data="cmd_start")]
-    ]
-
-    await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+    await update.message.reply_text(text, reply_markup=ADMIN_PANEL_MARKUP, parse_mode="Markdown")
 
 
 async def accuracy_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -13777,40 +14712,198 @@ async def accuracy_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text(text)
 
 
-async def broadcast_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Broadcast message to all users - admin only"""
-    user_id = update.effective_user.id
+# Broadcast pacing: Telegram allows ~30 msg/s overall, keep a little headroom
+BROADCAST_RATE = 28.0
+BROADCAST_CONCURRENCY = 8
+BROADCAST_PROGRESS_EVERY = 500
+_broadcast_bucket = {"tokens": 1.0, "updated": time.monotonic()}
+_broadcast_bucket_lock = asyncio.Lock()
 
-    if not is_admin(user_id):
-        await update.message.reply_text("⛔ Только для администраторов")
-        return
 
-    if not context.args:
-        await update.message.reply_text("❌ Использование: /broadcast <текст сообщения>")
-        return
+async def acquire_broadcast_token() -> None:
+    """Wait until the broadcast rate budget allows another message."""
+    await _take_bucket_token(_broadcast_bucket, _broadcast_bucket_lock, BROADCAST_RATE, 1.0)
 
-    message = " ".join(context.args)
 
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT user_id FROM users")
-    users = c.fetchall()
-    conn.close()
+def _count_users() -> int:
+    with ro_cursor() as c:
+        c.execute("SELECT COUNT(*) FROM users")
+        return c.fetchone()[0]
+
+
+def _fetch_user_ids_page(after_id: int, limit: int) -> list[int]:
+    """One page of user ids greater than after_id, in primary key order."""
+    with ro_cursor() as c:
+        c.execute("SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?", (after_id, limit))
+        return [uid for (uid,) in c]
+
 
-    sent = 0
-    failed = 0
+async def iter_user_ids(after_id: int = -1, page_size: int = 500):
+    """Yield every user id above after_id, reading the users table one keyset page at a time.
 
-    await update.message.reply_text(f"📢 Начинаю рассылку {len(users)} юзерам...")
+    Each page is read in a worker thread on a pooled connection that is
+    returned straight away, so a long broadcast holds neither the full id
+    list nor a database connection.
+    """
+    while True:
+        page = await asyncio.to_thread(_fetch_user_ids_page, after_id, page_size)
+        for uid in page:
+            yield uid
+        if len(page) < page_size:
+            return
+        after_id = page[-1]
+
+
+def _create_broadcast(message: str, admin_chat_id: int) -> str:
+    bid = uuid.uuid4().hex
+    with write_cursor() as c:
+        c.execute("INSERT INTO broadcasts (id, message, admin_chat_id) VALUES (?, ?, ?)",
+                  (bid, message, admin_chat_id))
+    return bid
+
+
+def _load_broadcast(bid: str) -> Optional[tuple]:
+    """(message, admin_chat_id, last_sent_user_id, sent, failed) of one broadcast."""
+    with ro_cursor() as c:
+        c.execute("""SELECT message, admin_chat_id, last_sent_user_id, sent, failed
+                     FROM broadcasts WHERE id = ?""", (bid,))
+        return c.fetchone()
+
+
+def _save_broadcast_progress(bid: str, last_sent_user_id: int, sent: int, failed: int,
+                             finished: bool = False) -> None:
+    with write_cursor() as c:
+        c.execute("""UPDATE broadcasts SET last_sent_user_id = ?, sent = ?, failed = ?,
+                            status = ?, finished_at = CASE WHEN ? THEN datetime('now') END
+                     WHERE id = ?""",
+                  (last_sent_user_id, sent, failed, "done" if finished else "running", finished, bid))
+
+
+def _unfinished_broadcast_ids() -> list[str]:
+    with ro_cursor() as c:
+        c.execute("SELECT id FROM broadcasts WHERE status = 'running' ORDER BY created_at")
+        return [bid for (bid,) in c]
+
+
+# Broadcasts being sent by this process: id -> Task
+_broadcast_tasks: dict = {}
+
+
+async def _run_broadcast(bot, bid: str) -> None:
+    """Send one broadcast to every user from its last checkpoint.
+
+    Users are streamed by iter_user_ids in primary key order and sent
+    behind the semaphore and rate bucket. Every BROADCAST_PROGRESS_EVERY
+    users the in-flight sends are drained and the last user id and counters
+    are saved, so a restart resends at most that many users.
+    """
+    state = await asyncio.to_thread(_load_broadcast, bid)
+    if state is None:
+        return
+    message, admin_chat_id, after_id, sent, failed = state
+    text = f"📢 **Объявление:**\n\n{message}"
+    total = await asyncio.to_thread(_count_users)
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+    status_msg = None
+    if admin_chat_id:
+        action = "Продолжаю" if after_id > -1 else "Начинаю"
+        try:
+            status_msg = await bot.send_message(admin_chat_id, f"📢 {action} рассылку {total} юзерам...")
+        except Exception as e:
+            logger.warning(f"Broadcast {bid}: could not notify admin: {e}")
 
-    for (uid,) in users:
+    async def send_one(uid: int) -> None:
+        nonlocal sent, failed
         try:
-            await context.bot.send_message(uid, f"📢 **Объявление:**\n\n{message}", parse_mode="Markdown")
+            await acquire_broadcast_token()
+            await bot.send_message(uid, text, parse_mode="Markdown")
             sent += 1
-            await asyncio.sleep(0.05)  # Rate limiting
         except Exception:
             failed += 1
+        finally:
+            sem.release()
+
+    async def checkpoint(last_uid: int) -> None:
+        if in_flight:
+            await asyncio.gather(*in_flight)
+        await asyncio.to_thread(_save_broadcast_progress, bid, last_uid, sent, failed)
+        if status_msg:
+            try:
+                await status_msg.edit_text(f"📢 Рассылка: {sent}/{total} отправлено, ошибок: {failed}")
+            except Exception as e:
+                logger.debug(f"Broadcast progress edit failed: {e}")
+
+    # Acquire the slot before creating the task so at most
+    # BROADCAST_CONCURRENCY sends are alive at once
+    in_flight = set()
+    dispatched = 0
+    async for uid in iter_user_ids(after_id, BROADCAST_PROGRESS_EVERY):
+        await sem.acquire()
+        task = asyncio.create_task(send_one(uid))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+        after_id = uid
+        dispatched += 1
+        if dispatched % BROADCAST_PROGRESS_EVERY == 0:
+            await checkpoint(after_id)
+    if in_flight:
+        await asyncio.gather(*in_flight)
+
+    await asyncio.to_thread(_save_broadcast_progress, bid, after_id, sent, failed, True)
+    logger.info(f"Broadcast {bid} finished: sent={sent}, failed={failed}")
+    if admin_chat_id:
+        try:
+            await bot.send_message(admin_chat_id, f"✅ Рассылка завершена!\n├ Отправлено: {sent}\n└ Ошибок: {failed}")
+        except Exception as e:
+            logger.warning(f"Broadcast {bid}: could not notify admin: {e}")
+
+
+def _start_broadcast_task(bot, bid: str) -> bool:
+    """Run a broadcast in the background unless it is already running here."""
+    if bid in _broadcast_tasks:
+        return False
+    task = asyncio.create_task(_run_broadcast(bot, bid))
+    _broadcast_tasks[bid] = task
+
+    def done(t, bid=bid):
+        _broadcast_tasks.pop(bid, None)
+        if not t.cancelled() and t.exception() is not None:
+            logger.error(f"Broadcast {bid} stopped: {t.exception()}")
+
+    task.add_done_callback(done)
+    return True
+
 
-    await update.message.reply_text(f"✅ Рассылка завершена!\n├ Отправлено: {sent}\n└ Ошибок: {failed}")
+async def resume_broadcasts(bot) -> int:
+    """Restart every unfinished broadcast (on startup or from the admin panel)."""
+    started = 0
+    for bid in await asyncio.to_thread(_unfinished_broadcast_ids):
+        if _start_broadcast_task(bot, bid):
+            started += 1
+    if started:
+        logger.info(f"Resumed {started} broadcast(s)")
+    return started
+
+
+async def broadcast_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Broadcast message to all users - admin only.
+
+    The send runs as a background task; progress is reported in this chat.
+    """
+    user_id = update.effective_user.id
+
+    if not is_admin(user_id):
+        await update.message.reply_text("⛔ Только для администраторов")
+        return
+
+    if not context.args:
+        await update.message.reply_text("❌ Использование: /broadcast <текст сообщения>")
+        return
+
+    message = " ".join(context.args)
+    bid = await asyncio.to_thread(_create_broadcast, message, update.effective_chat.id)
+    _start_broadcast_task(context.bot, bid)
 
 
 async def addpremium_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -13843,7 +14936,7 @@ async def addpremium_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     days = int(context.args[1]) if len(context.args) > 1 and context.args[1].isdigit() else 30
 
     # Use grant_premium function for proper expiry handling
-    success = grant_premium(target_id, days)
+    success = await asyncio.to_thread(grant_premium, target_id, days)
 
     if success:
         expires_text = "навсегда" if days >= 36500 else f"на {days} дней"
@@ -13871,12 +14964,10 @@ async def removepremium_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     target_id = int(context.args[0])
 
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("UPDATE users SET is_premium = 0 WHERE user_id = ?", (target_id,))
-    affected = c.rowcount
-    conn.commit()
-    conn.close()
+    with write_cursor() as c:
+        c.execute("UPDATE users SET is_premium = 0 WHERE user_id = ?", (target_id,))
+        affected = c.rowcount
+    invalidate_user_cache(target_id)
 
     if affected > 0:
         await update.message.reply_text(f"✅ Премиум убран у юзера {target_id}")
@@ -13955,6 +15046,19 @@ async def cleanfavs_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(text, parse_mode="Markdown")
 
 
+def _fetch_user_info(target_id: int) -> tuple:
+    """(users row or None, prediction count) for /userinfo."""
+    with ro_cursor() as c:
+        c.row_factory = sqlite3.Row
+        c.execute("SELECT * FROM users WHERE user_id = ?", (target_id,))
+        row = c.fetchone()
+
+        # Get prediction count
+        c.execute("SELECT COUNT(*) FROM predictions WHERE user_id = ?", (target_id,))
+        pred_count = c.fetchone()[0]
+    return row, pred_count
+
+
 async def userinfo_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Get user info - admin only"""
     user_id = update.effective_user.id
@@ -13969,36 +15073,26 @@ async def userinfo_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     target_id = int(context.args[0])
 
-    conn = get_db_connection()
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE user_id = ?", (target_id,))
-    row = c.fetchone()
+    row, pred_count = await asyncio.to_thread(_fetch_user_info, target_id)
 
     if not row:
         await update.message.reply_text(f"❌ Юзер {target_id} не найден")
-        conn.close()
         return
 
-    # Get prediction count
-    c.execute("SELECT COUNT(*) FROM predictions WHERE user_id = ?", (target_id,))
-    pred_count = c.fetchone()[0]
-
-    conn.close()
-
-    # Parse user data safely
-    username = row['username'] if 'username' in row.keys() else None
-    first_name = row['first_name'] if 'first_name' in row.keys() else None
-    language = row['language'] if 'language' in row.keys() else 'ru'
-    is_premium = row['is_premium'] if 'is_premium' in row.keys() else 0
-    live_alerts = row['live_alerts'] if 'live_alerts' in row.keys() else 0
-    created_at = row['created_at'] if 'created_at' in row.keys() else 'N/A'
-    last_active = row['last_active'] if 'last_active' in row.keys() else 'N/A'
+    # Parse user data safely (older databases may lack some columns)
+    d = dict(row)
+    username = d.get('username')
+    first_name = d.get('first_name')
+    language = d.get('language', 'ru')
+    is_premium = d.get('is_premium', 0)
+    live_alerts = d.get('live_alerts', 0)
+    created_at = d.get('created_at', 'N/A')
+    last_active = d.get('last_active', 'N/A')
 
     text = f"""👤 **Информация о юзере {target_id}**
 
-├ Username: @{username or 'нет'}
-├ Имя: {first_name or 'нет'}
+├ Username: @{md_escape(username or 'нет')}
+├ Имя: {md_escape(first_name or 'нет')}
 ├ Язык: {language}
 ├ Premium: {'✅' if is_premium else '❌'}
 ├ Live-алерты: {'✅' if live_alerts else '❌'}
@@ -14029,18 +15123,8 @@ async def mlstatus_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 """
 
     if status["data_counts"]:
-        category_names = {
-            "outcomes_home": "П1",
-            "outcomes_away": "П2",
-            "outcomes_draw": "Ничья",
-            "totals_over": "ТБ 2.5",
-            "totals_under": "ТМ 2.5",
-            "btts": "BTTS",
-            "double_chance": "Двойной шанс",
-            "handicap": "Фора"
-        }
         for cat, data in status["data_counts"].items():
-            name = category_names.get(cat, cat)
+            name = MLSTATUS_CATEGORY_NAMES.get(cat, cat)
             ready = "✅" if data["verified"] >= status["min_samples"] else f"⏳ {data['verified']}/{status['min_samples']}"
             text += f"├ {name}: {data['total']} всего, {data['verified']} проверено {ready}\n"
     else:
@@ -14050,7 +15134,7 @@ async def mlstatus_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if status["models"]:
         for cat, info in status["models"].items():
-            name = category_names.get(cat, cat)
+            name = MLSTATUS_CATEGORY_NAMES.get(cat, cat)
             text += f"├ {name}: {info['accuracy']:.1%} точность ({info['samples']} samples)\n"
     else:
         text += "├ Модели ещё не обучены\n"
@@ -14059,12 +15143,7 @@ async def mlstatus_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if status["ready_to_train"]:
         text += f"\n⚡ **Готовы к обучению:** {', '.join(status['ready_to_train'])}"
 
-    keyboard = [
-        [InlineKeyboardButton("🔄 Обучить модели", callback_data="ml_train")],
-        [InlineKeyboardButton("🔙 В админку", callback_data="cmd_admin")]
-    ]
-
-    await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+    await update.message.reply_text(text, reply_markup=MLSTATUS_MARKUP, parse_mode="Markdown")
 
 
 async def mltrain_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -14345,6 +15424,73 @@ async def roi_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(text, parse_mode="Markdown")
 
 
+# Callback edits: at most one edit per message every EDIT_MIN_INTERVAL seconds.
+# Edits requested meanwhile collapse into the latest text (trailing edit), and a
+# RetryAfter from Telegram is waited out instead of surfacing to the handler.
+EDIT_MIN_INTERVAL = 1.0
+_edit_pending: dict = {}  # message key -> {"query", "text", "kwargs", "waiters"}
+_edit_workers: dict = {}  # message key -> Task flushing that message's edits
+
+
+def _edit_key(query):
+    if query.message:
+        return (query.message.chat_id, query.message.message_id)
+    return query.inline_message_id
+
+
+async def _flush_edits(key) -> None:
+    """Send the latest pending edit for one message, pacing and retrying as needed."""
+    next_at = 0.0
+    try:
+        while True:
+            wait = next_at - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            entry = _edit_pending.pop(key, None)
+            if entry is None:
+                return
+            try:
+                result = await entry["query"].edit_message_text(entry["text"], **entry["kwargs"])
+            except RetryAfter as e:
+                next_at = time.monotonic() + e.retry_after
+                # Retry with whatever text is newest by then
+                newer = _edit_pending.setdefault(key, entry)
+                if newer is not entry:
+                    newer["waiters"][:0] = entry["waiters"]
+                continue
+            except Exception as e:
+                result = e
+            next_at = time.monotonic() + EDIT_MIN_INTERVAL
+            for waiter in entry["waiters"]:
+                if waiter.done():
+                    continue
+                if isinstance(result, Exception):
+                    waiter.set_exception(result)
+                else:
+                    waiter.set_result(result)
+    finally:
+        _edit_workers.pop(key, None)
+
+
+async def edit_message_throttled(query, text: str, **kwargs):
+    """query.edit_message_text() behind the per-message throttle above.
+
+    Returns once the edit carrying this text, or a newer one that replaced it, went out.
+    """
+    key = _edit_key(query)
+    entry = _edit_pending.get(key)
+    if entry is None:
+        entry = _edit_pending[key] = {"waiters": []}
+    entry.update(query=query, text=text, kwargs=kwargs)
+    waiter = asyncio.get_running_loop().create_future()
+    entry["waiters"].append(waiter)
+    if key not in _edit_workers:
+        _edit_workers[key] = asyncio.create_task(_flush_edits(key))
+    return await waiter
+
+
+@per_user_lock
 async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle all callback queries"""
     query = update.callback_query
@@ -14352,7 +15498,7 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     data = query.data
     user_id = query.from_user.id
-    user = get_user(user_id)
+    user = get_user_cached(user_id)
     lang = user.get("language", "ru") if user else "ru"
 
     # Initial language selection for new users
@@ -14435,7 +15581,7 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
         keyboard.append([InlineKeyboardButton(get_text("stats", selected_lang), callback_data="cmd_stats"),
              InlineKeyboardButton(get_text("help", selected_lang), callback_data="cmd_help")])
 
-        await query.edit_message_text(
+        await edit_message_throttled(query,
             welcome_text,
             reply_markup=InlineKeyboardMarkup(keyboard),
             parse_mode="Markdown"
@@ -14458,21 +15604,8 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
 
     # Command callbacks
     if data == "cmd_start":
-        keyboard = [
-            [InlineKeyboardButton(get_text("recommendations", lang), callback_data="cmd_recommend"),
-             InlineKeyboardButton(get_text("today", lang), callback_data="cmd_today")],
-            [InlineKeyboardButton(get_text("tomorrow", lang), callback_data="cmd_tomorrow"),
-             InlineKeyboardButton(get_text("leagues", lang), callback_data="cmd_leagues")],
-            [InlineKeyboardButton(get_text("live_alerts", lang), callback_data="cmd_live"),
-             InlineKeyboardButton(get_text("settings", lang), callback_data="cmd_settings")],
-            [InlineKeyboardButton(get_text("favorites", lang), callback_data="cmd_favorites"),
-             InlineKeyboardButton(get_text("stats", lang), callback_data="cmd_stats")],
-            [InlineKeyboardButton(get_text("premium_btn", lang), callback_data="cmd_premium"),
-             InlineKeyboardButton(get_text("referral_btn", lang), callback_data="cmd_referral")],
-            [InlineKeyboardButton(get_text("help", lang), callback_data="cmd_help")]
-        ]
-        await query.edit_message_text(f"⚽ **AI Betting Bot v14** - {get_text('choose_action', lang)}",
-                                       reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        await edit_message_throttled(query, f"⚽ **AI Betting Bot v14** - {get_text('choose_action', lang)}",
+                                     reply_markup=_main_menu_markup(lang), parse_mode="Markdown")
 
     elif data == "cmd_referral":
         await referral_cmd(update, context)
@@ -14492,7 +15625,7 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
                 [InlineKeyboardButton(get_text("recommendations", lang), callback_data="cmd_recommend")],
                 [InlineKeyboardButton(get_text("back", lang), callback_data="cmd_start")]
             ]
-            await query.edit_message_text(claimed_text.get(lang, claimed_text["en"]), reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+            await edit_message_throttled(query, claimed_text.get(lang, claimed_text["en"]), reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
         else:
             error_text = {
                 "ru": "❌ Бонус недоступен. Пригласи 2 друзей чтобы получить.",
@@ -14502,7 +15635,7 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
                 "id": "❌ Bonus tidak tersedia. Undang 2 teman untuk mendapatkannya."
             }
             keyboard = [[InlineKeyboardButton(get_text("back", lang), callback_data="cmd_referral")]]
-            await query.edit_message_text(error_text.get(lang, error_text["en"]), reply_markup=InlineKeyboardMarkup(keyboard))
+            await edit_message_throttled(query, error_text.get(lang, error_text["en"]), reply_markup=InlineKeyboardMarkup(keyboard))
 
     elif data == "cmd_premium":
         await premium_cmd(update, context)
@@ -14510,7 +15643,7 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
     # Crypto payment handlers
     elif data.startswith("pay_crypto_"):
         days = int(data.replace("pay_crypto_", ""))
-        await query.edit_message_text("⏳ Создаю счёт на оплату...")
+        await edit_message_throttled(query, "⏳ Создаю счёт на оплату...")
 
         # Show currency selection
         keyboard = [
@@ -14524,7 +15657,7 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
 Тариф: **{days} дней** за **${price}**
 
 Оплата через @CryptoBot — безопасно и мгновенно!"""
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        await edit_message_throttled(query, text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
 
     elif data.startswith("crypto_pay_"):
         # Format: crypto_pay_{days}_{currency}
@@ -14532,7 +15665,7 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
         days = int(parts[0])
         currency = parts[1]
 
-        await query.edit_message_text("⏳ Создаю инвойс...")
+        await edit_message_throttled(query, "⏳ Создаю инвойс...")
 
         # Create invoice via CryptoBot
         result = await create_crypto_invoice(user_id, days, currency)
@@ -14555,22 +15688,22 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
                 [InlineKeyboardButton("🔙 Назад", callback_data="cmd_premium")]
             ]
 
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        await edit_message_throttled(query, text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
 
     elif data == "cmd_recommend":
         # Check limit
-        can_use, _, use_bonus = check_daily_limit(user_id)
+        can_use, _, use_bonus = await asyncio.to_thread(check_daily_limit, user_id)
         if not can_use:
             text = get_limit_text(lang)
             keyboard = []
             premium_btns = get_premium_buttons(user_id, lang)
             if premium_btns:
                 keyboard.append(premium_btns)
-            await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None)
+            await edit_message_throttled(query, text, reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None)
             return
 
-        await query.edit_message_text(get_text("analyzing", lang))
-        matches = await get_matches(days=7)
+        await edit_message_throttled(query, get_text("analyzing", lang))
+        matches = await get_upcoming_matches(7)
         if matches:
             user_tz = user.get("timezone", "Europe/Moscow") if user else "Europe/Moscow"
             recs = await get_recommendations_enhanced(matches, "", user, lang=lang, user_tz=user_tz)
@@ -14579,74 +15712,16 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
             if bet_btn:
                 keyboard.append(bet_btn)
             keyboard.append([InlineKeyboardButton(get_text("back", lang), callback_data="cmd_start")])
-            increment_daily_usage(user_id)
-            await query.edit_message_text(recs or get_text("no_matches", lang), reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+            await asyncio.to_thread(increment_daily_usage, user_id)
+            await edit_message_throttled(query, recs or get_text("no_matches", lang), reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
         else:
-            await query.edit_message_text(get_text("no_matches", lang))
+            await edit_message_throttled(query, get_text("no_matches", lang))
     
     elif data == "cmd_today":
-        user_tz = user.get("timezone", "Europe/Moscow") if user else "Europe/Moscow"
-        await query.edit_message_text(get_text("analyzing", lang))
-        matches = await get_matches(date_filter="today")
-        if not matches:
-            await query.edit_message_text(get_text("no_matches", lang))
-            return
-        
-        by_comp = {}
-        for m in matches:
-            comp = m.get("competition", {}).get("name", "Other")
-            if comp not in by_comp:
-                by_comp[comp] = []
-            by_comp[comp].append(m)
-        
-        tz_info = get_tz_offset_str(user_tz)
-        text = f"{get_text('matches_today', lang)} ({tz_info}):\n\n"
-        for comp, ms in by_comp.items():
-            text += f"🏆 **{comp}**\n"
-            for m in ms[:5]:
-                home = m.get("homeTeam", {}).get("name", "?")
-                away = m.get("awayTeam", {}).get("name", "?")
-                time_str = convert_utc_to_user_tz(m.get("utcDate", ""), user_tz)
-                text += f"  ⏰ {time_str} | {home} vs {away}\n"
-            text += "\n"
+        await _render_day(query, user, lang, "today", "matches_today", "rec_today")
 
-        keyboard = [
-            [InlineKeyboardButton(get_text("recs_today", lang), callback_data="rec_today")],
-            [InlineKeyboardButton(get_text("back", lang), callback_data="cmd_start")]
-        ]
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
-    
     elif data == "cmd_tomorrow":
-        user_tz = user.get("timezone", "Europe/Moscow") if user else "Europe/Moscow"
-        await query.edit_message_text(get_text("analyzing", lang))
-        matches = await get_matches(date_filter="tomorrow")
-        if not matches:
-            await query.edit_message_text(get_text("no_matches", lang))
-            return
-        
-        by_comp = {}
-        for m in matches:
-            comp = m.get("competition", {}).get("name", "Other")
-            if comp not in by_comp:
-                by_comp[comp] = []
-            by_comp[comp].append(m)
-        
-        tz_info = get_tz_offset_str(user_tz)
-        text = f"{get_text('matches_tomorrow', lang)} ({tz_info}):\n\n"
-        for comp, ms in by_comp.items():
-            text += f"🏆 **{comp}**\n"
-            for m in ms[:5]:
-                home = m.get("homeTeam", {}).get("name", "?")
-                away = m.get("awayTeam", {}).get("name", "?")
-                time_str = convert_utc_to_user_tz(m.get("utcDate", ""), user_tz)
-                text += f"  ⏰ {time_str} | {home} vs {away}\n"
-            text += "\n"
-        
-        keyboard = [
-            [InlineKeyboardButton(get_text("recs_tomorrow", lang), callback_data="rec_tomorrow")],
-            [InlineKeyboardButton(get_text("back", lang), callback_data="cmd_start")]
-        ]
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        await _render_day(query, user, lang, "tomorrow", "matches_tomorrow", "rec_tomorrow")
 
     elif data == "cmd_leagues":
         keyboard = [
@@ -14663,7 +15738,7 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
             [InlineKeyboardButton(get_text("more_leagues", lang), callback_data="cmd_leagues2")],
             [InlineKeyboardButton(get_text("back", lang), callback_data="cmd_start")]
         ]
-        await query.edit_message_text(get_text("top_leagues", lang), reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        await edit_message_throttled(query, get_text("top_leagues", lang), reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
     
     elif data == "cmd_leagues2":
         keyboard = [
@@ -14681,7 +15756,7 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
              InlineKeyboardButton("🏆 DFB-Pokal", callback_data="league_DFB")],
             [InlineKeyboardButton(get_text("top_leagues", lang).replace("**", "").replace(":", ""), callback_data="cmd_leagues")]
         ]
-        await query.edit_message_text(get_text("other_leagues", lang), reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        await edit_message_throttled(query, get_text("other_leagues", lang), reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
     
     elif data == "cmd_settings":
         await settings_cmd(update, context)
@@ -14695,7 +15770,7 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
         update_user_settings(user_id, daily_requests=0, last_request_date="")
         user_after = get_user(user_id)
         logger.info(f"DEBUG: After reset - requests={user_after.get('daily_requests')}, last_date={user_after.get('last_request_date')}")
-        await query.edit_message_text(
+        await edit_message_throttled(query,
             get_text("limit_reset", lang).format(user_id=user_id, limit=FREE_DAILY_LIMIT)
         )
 
@@ -14709,7 +15784,7 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
         update_user_settings(user_id, is_premium=0, daily_requests=0, last_request_date="")
         user_after = get_user(user_id)
         logger.info(f"DEBUG: After remove premium - is_premium={user_after.get('is_premium')}, requests={user_after.get('daily_requests')}")
-        await query.edit_message_text(
+        await edit_message_throttled(query,
             get_text("premium_removed", lang).format(
                 user_id=user_id,
                 premium=user_after.get('is_premium'),
@@ -14732,98 +15807,43 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
     elif data.startswith("history_"):
         # History filter callbacks
         filter_type = data.replace("history_", "")
-        conn = get_db_connection()
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-
-        if filter_type == "wins":
-            c.execute("""SELECT * FROM predictions WHERE user_id = ? AND is_correct = 1
-                         ORDER BY predicted_at DESC LIMIT 10""", (user_id,))
-        elif filter_type == "losses":
-            c.execute("""SELECT * FROM predictions WHERE user_id = ? AND is_correct = 0
-                         ORDER BY predicted_at DESC LIMIT 10""", (user_id,))
-        elif filter_type == "pending":
-            c.execute("""SELECT * FROM predictions WHERE user_id = ? AND is_correct IS NULL
-                         ORDER BY predicted_at DESC LIMIT 10""", (user_id,))
-        else:
-            c.execute("""SELECT * FROM predictions WHERE user_id = ?
-                         ORDER BY predicted_at DESC LIMIT 10""", (user_id,))
-
-        predictions = c.fetchall()
-        conn.close()
+        predictions = await asyncio.to_thread(_fetch_history, user_id, filter_type, 10)
 
-        filter_labels = {
-            "all": {"ru": "ВСЕ", "en": "ALL", "pt": "TODOS", "es": "TODOS", "id": "SEMUA"},
-            "wins": {"ru": "ПОБЕДЫ", "en": "WINS", "pt": "VITÓRIAS", "es": "VICTORIAS", "id": "MENANG"},
-            "losses": {"ru": "ПОРАЖЕНИЯ", "en": "LOSSES", "pt": "DERROTAS", "es": "DERROTAS", "id": "KALAH"},
-            "pending": {"ru": "ОЖИДАЮТ", "en": "PENDING", "pt": "PENDENTES", "es": "PENDIENTES", "id": "MENUNGGU"}
-        }
-        filter_label = filter_labels.get(filter_type, filter_labels["all"]).get(lang, "ALL")
+        filter_label = HISTORY_FILTER_LABELS.get(filter_type, HISTORY_FILTER_LABELS["all"]).get(lang, "ALL")
 
         if not predictions:
             text = f"📜 **ИСТОРИЯ** ({filter_label})\n\nНет прогнозов."
         else:
-            text = f"📜 **ИСТОРИЯ ПРОГНОЗОВ** ({filter_label})\n\n"
-            for p in predictions:
-                date_str = p["predicted_at"][:10] if p["predicted_at"] else "?"
-                home = p["home_team"] or "?"
-                away = p["away_team"] or "?"
-                bet = p["bet_type"] or "?"
-                conf = p["confidence"] or 0
-                odds = p["odds"] or 0
-
-                if p["is_correct"] is None:
-                    result_emoji = "⏳"
-                elif p["is_correct"] == 1:
-                    result_emoji = "✅"
-                else:
-                    result_emoji = "❌"
-
-                text += f"{result_emoji} **{home}** vs **{away}**\n"
-                text += f"   📅 {date_str} | {bet} @ {odds:.2f} ({conf}%)\n"
-                if p["result"]:
-                    text += f"   📊 Счёт: {p['result']}\n"
-                text += "\n"
-
-        keyboard = [
-            [InlineKeyboardButton("🔄 Все", callback_data="history_all"),
-             InlineKeyboardButton("✅ Победы", callback_data="history_wins")],
-            [InlineKeyboardButton("❌ Поражения", callback_data="history_losses"),
-             InlineKeyboardButton("⏳ Ожидают", callback_data="history_pending")],
-            [InlineKeyboardButton(get_text("back", lang), callback_data="cmd_start")]
-        ]
+            text = _history_text(predictions, filter_label)
 
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        await edit_message_throttled(query, text, reply_markup=_history_markup(lang), parse_mode="Markdown")
 
     elif data == "cmd_help":
         await help_cmd(update, context)
     
     elif data == "cmd_live":
         if user_id in live_subscribers:
-            live_subscribers.remove(user_id)
             remove_live_subscriber(user_id)
-            await query.edit_message_text(
+            await edit_message_throttled(query,
                 get_text("live_alerts_off", lang),
                 parse_mode="Markdown"
             )
         else:
-            live_subscribers.add(user_id)
             add_live_subscriber(user_id)
-            keyboard = [[InlineKeyboardButton(get_text("back", lang), callback_data="cmd_start")]]
-            await query.edit_message_text(
+            await edit_message_throttled(query,
                 get_text("live_alerts_on", lang),
-                reply_markup=InlineKeyboardMarkup(keyboard),
+                reply_markup=_back_markup(lang),
                 parse_mode="Markdown"
             )
 
     elif data == "ml_train":
         if not is_admin(user_id):
-            await query.edit_message_text("⛔ Только для администраторов")
+            await edit_message_throttled(query, "⛔ Только для администраторов")
             return
 
-        await query.edit_message_text("🔄 Запускаю обучение моделей...")
+        await edit_message_throttled(query, "🔄 Запускаю обучение моделей...")
 
-        results = train_all_models()
+        results = await asyncio.to_thread(train_all_models)
 
         if results:
             text = "✅ **Обучение завершено:**\n\n"
@@ -14833,11 +15853,11 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
             text = "❌ Недостаточно данных для обучения.\nНужно минимум 100 проверенных прогнозов на категорию."
 
         keyboard = [[InlineKeyboardButton("🔙 ML статус", callback_data="cmd_mlstatus")]]
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        await edit_message_throttled(query, text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
 
     elif data == "cmd_mlstatus":
         if not is_admin(user_id):
-            await query.edit_message_text("⛔ Только для администраторов")
+            await edit_message_throttled(query, "⛔ Только для администраторов")
             return
 
         status = get_ml_status()
@@ -14859,11 +15879,11 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
             [InlineKeyboardButton("🔄 Обучить", callback_data="ml_train")],
             [InlineKeyboardButton("🔙 Назад", callback_data="cmd_admin")]
         ]
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        await edit_message_throttled(query, text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
 
     elif data == "cmd_admin":
         if not is_admin(user_id):
-            await query.edit_message_text("⛔ Только для администраторов")
+            await edit_message_throttled(query, "⛔ Только для администраторов")
             return
         # Simplified admin panel for callback
         text = "👑 **АДМИН-ПАНЕЛЬ**\n\nИспользуй /admin для полной статистики"
@@ -14871,11 +15891,11 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
             [InlineKeyboardButton("🤖 ML система", callback_data="cmd_mlstatus")],
             [InlineKeyboardButton("🔙 В меню", callback_data="cmd_start")]
         ]
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        await edit_message_throttled(query, text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
 
     elif data == "admin_broadcast":
         if not is_admin(user_id):
-            await query.edit_message_text("⛔ Только для администраторов")
+            await edit_message_throttled(query, "⛔ Только для администраторов")
             return
         text = """📢 **Рассылка**
 
@@ -14886,11 +15906,21 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
 Пример:
 `/broadcast 🎉 Новая функция! Теперь доступны live-алерты!`"""
         keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="cmd_admin")]]
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        await edit_message_throttled(query, text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+
+    elif data == "admin_resume_broadcast":
+        if not is_admin(user_id):
+            await edit_message_throttled(query, "⛔ Только для администраторов")
+            return
+        started = await resume_broadcasts(context.bot)
+        text = (f"▶️ Продолжено рассылок: {started}" if started
+                else "✅ Незавершённых рассылок нет")
+        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="cmd_admin")]]
+        await edit_message_throttled(query, text, reply_markup=InlineKeyboardMarkup(keyboard))
 
     elif data == "admin_users":
         if not is_admin(user_id):
-            await query.edit_message_text("⛔ Только для администраторов")
+            await edit_message_throttled(query, "⛔ Только для администраторов")
             return
 
         try:
@@ -14921,14 +15951,14 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
                 text += f"• {prem_icon}{name} ({date})\n"
 
             keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="cmd_admin")]]
-            await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+            await edit_message_throttled(query, text, reply_markup=InlineKeyboardMarkup(keyboard))
         except Exception as e:
             logger.error(f"Admin users error: {e}")
-            await query.edit_message_text(f"❌ Ошибка: {e}")
+            await edit_message_throttled(query, f"❌ Ошибка: {e}")
 
     elif data == "admin_sources" or data.startswith("admin_sources_filter_"):
         if not is_admin(user_id):
-            await query.edit_message_text("⛔ Только для администраторов")
+            await edit_message_throttled(query, "⛔ Только для администраторов")
             return
 
         try:
@@ -14968,14 +15998,14 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
                 )])
 
             keyboard_rows.append([InlineKeyboardButton("🔙 Назад", callback_data="cmd_admin")])
-            await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard_rows), parse_mode="Markdown")
+            await edit_message_throttled(query, text, reply_markup=InlineKeyboardMarkup(keyboard_rows), parse_mode="Markdown")
         except Exception as e:
             logger.error(f"Admin sources error: {e}")
-            await query.edit_message_text(f"❌ Ошибка: {e}")
+            await edit_message_throttled(query, f"❌ Ошибка: {e}")
 
     elif data.startswith("admin_users_src_"):
         if not is_admin(user_id):
-            await query.edit_message_text("⛔ Только для администраторов")
+            await edit_message_throttled(query, "⛔ Только для администраторов")
             return
 
         try:
@@ -15007,14 +16037,14 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
                 text += f"• {prem_icon}{name} ({date})\n"
 
             keyboard = [[InlineKeyboardButton("🔙 К источникам", callback_data="admin_sources")]]
-            await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+            await edit_message_throttled(query, text, reply_markup=InlineKeyboardMarkup(keyboard))
         except Exception as e:
             logger.error(f"Admin users by source error: {e}")
-            await query.edit_message_text(f"❌ Ошибка: {e}")
+            await edit_message_throttled(query, f"❌ Ошибка: {e}")
 
     elif data == "admin_stats":
         if not is_admin(user_id):
-            await query.edit_message_text("⛔ Только для администраторов")
+            await edit_message_throttled(query, "⛔ Только для администраторов")
             return
 
         conn = get_db_connection()
@@ -15086,12 +16116,12 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
 """
 
         keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="cmd_admin")]]
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        await edit_message_throttled(query, text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
 
     elif data == "cmd_admin":
         # Return to admin panel (simplified)
         if not is_admin(user_id):
-            await query.edit_message_text("⛔ Только для администраторов")
+            await edit_message_throttled(query, "⛔ Только для администраторов")
             return
         text = "👑 **АДМИН-ПАНЕЛЬ**\n\nИспользуй /admin для полной статистики"
         keyboard = [
@@ -15101,14 +16131,14 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
             [InlineKeyboardButton("🧹 Очистить дубликаты", callback_data="admin_clean_dups")],
             [InlineKeyboardButton("🔙 В меню", callback_data="cmd_start")]
         ]
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        await edit_message_throttled(query, text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
 
     elif data == "admin_accuracy":
         if not is_admin(user_id):
-            await query.edit_message_text("⛔ Только для администраторов")
+            await edit_message_throttled(query, "⛔ Только для администраторов")
             return
 
-        await query.edit_message_text("📊 Собираю статистику точности...")
+        await edit_message_throttled(query, "📊 Собираю статистику точности...")
 
         conn = get_db_connection()
         c = conn.cursor()
@@ -15188,7 +16218,7 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
             [InlineKeyboardButton("📋 Полный отчёт → /accuracy", callback_data="admin_accuracy_full")],
             [InlineKeyboardButton("🔙 В админ-панель", callback_data="cmd_start")]
         ]
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        await edit_message_throttled(query, text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
 
     elif data == "admin_accuracy_full":
         # Just tell user to use /accuracy command for full report
@@ -15196,7 +16226,7 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
 
     elif data == "admin_ml_stats":
         if not is_admin(user_id):
-            await query.edit_message_text("⛔ Только для администраторов")
+            await edit_message_throttled(query, "⛔ Только для администраторов")
             return
 
         try:
@@ -15273,14 +16303,14 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
                  InlineKeyboardButton("🤖 ML система", callback_data="cmd_mlstatus")],
                 [InlineKeyboardButton("🔙 Назад", callback_data="cmd_admin")]
             ]
-            await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+            await edit_message_throttled(query, text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
         except Exception as e:
             logger.error(f"Admin ML stats error: {e}")
-            await query.edit_message_text(f"❌ Ошибка: {e}")
+            await edit_message_throttled(query, f"❌ Ошибка: {e}")
 
     elif data == "admin_live_status":
         if not is_admin(user_id):
-            await query.edit_message_text("⛔ Только для администраторов")
+            await edit_message_throttled(query, "⛔ Только для администраторов")
             return
 
         try:
@@ -15345,14 +16375,14 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
             text += "⚙️ **Интервал проверки:** каждые 10 мин\n"
 
             keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="cmd_admin")]]
-            await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+            await edit_message_throttled(query, text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
         except Exception as e:
             logger.error(f"Admin live status error: {e}")
-            await query.edit_message_text(f"❌ Ошибка: {e}")
+            await edit_message_throttled(query, f"❌ Ошибка: {e}")
 
     elif data == "admin_clean_dups":
         if not is_admin(user_id):
-            await query.edit_message_text("⛔ Только для администраторов")
+            await edit_message_throttled(query, "⛔ Только для администраторов")
             return
         # Clean duplicate predictions
         result = clean_duplicate_predictions()
@@ -15368,11 +16398,11 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
             text = "✅ Дубликатов не найдено!"
 
         keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="cmd_admin")]]
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        await edit_message_throttled(query, text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
 
     elif data == "admin_learning":
         if not is_admin(user_id):
-            await query.edit_message_text("⛔ Только для администраторов")
+            await edit_message_throttled(query, "⛔ Только для администраторов")
             return
 
         try:
@@ -15441,20 +16471,20 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
             text += "\n💡 Система учится с каждым проверенным прогнозом!"
 
             keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="cmd_admin")]]
-            await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+            await edit_message_throttled(query, text, reply_markup=InlineKeyboardMarkup(keyboard))
         except Exception as e:
             logger.error(f"Admin learning stats error: {e}")
-            await query.edit_message_text(f"❌ Ошибка: {e}")
+            await edit_message_throttled(query, f"❌ Ошибка: {e}")
 
     # League selection
     elif data.startswith("league_"):
         code = data.replace("league_", "")
         league_name = COMPETITIONS.get(code, code)
-        await query.edit_message_text(get_text("loading", lang).format(name=league_name))
+        await edit_message_throttled(query, get_text("loading", lang).format(name=league_name))
         matches = await get_matches(code, days=14)
 
         if not matches:
-            await query.edit_message_text(get_text("no_matches_league", lang).format(name=league_name))
+            await edit_message_throttled(query, get_text("no_matches_league", lang).format(name=league_name))
             return
 
         text = f"🏆 **{league_name}**\n\n"
@@ -15472,28 +16502,26 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
             [InlineKeyboardButton(get_text("recommendations", lang), callback_data=f"rec_{code}")],
             [InlineKeyboardButton(get_text("back_to_leagues", lang), callback_data="cmd_leagues")]
         ]
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        await edit_message_throttled(query, text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
     
     # Recommendations for specific context
     elif data.startswith("rec_"):
         # Check limit
-        can_use, _, use_bonus = check_daily_limit(user_id)
+        can_use, _, use_bonus = await asyncio.to_thread(check_daily_limit, user_id)
         if not can_use:
             text = get_limit_text(lang)
             keyboard = []
             premium_btns = get_premium_buttons(user_id, lang)
             if premium_btns:
                 keyboard.append(premium_btns)
-            await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None)
+            await edit_message_throttled(query, text, reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None)
             return
 
         context_type = data.replace("rec_", "")
-        await query.edit_message_text(get_text("analyzing", lang))
+        await edit_message_throttled(query, get_text("analyzing", lang))
 
-        if context_type == "today":
-            matches = await get_matches(date_filter="today")
-        elif context_type == "tomorrow":
-            matches = await get_matches(date_filter="tomorrow")
+        if context_type in ("today", "tomorrow"):
+            matches = await get_day_matches(context_type)
         else:
             matches = await get_matches(context_type, days=14)
 
@@ -15505,10 +16533,10 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
             if bet_btn:
                 keyboard.append(bet_btn)
             keyboard.append([InlineKeyboardButton(get_text("back", lang), callback_data="cmd_start")])
-            increment_daily_usage(user_id)
-            await query.edit_message_text(recs or get_text("no_matches", lang), reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+            await asyncio.to_thread(increment_daily_usage, user_id)
+            await edit_message_throttled(query, recs or get_text("no_matches", lang), reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
         else:
-            await query.edit_message_text(get_text("no_matches", lang))
+            await edit_message_throttled(query, get_text("no_matches", lang))
 
     # Settings changes
     elif data == "set_min_odds":
@@ -15521,7 +16549,7 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
              InlineKeyboardButton("2.5", callback_data="min_2.5")],
             [InlineKeyboardButton(get_text("back", lang), callback_data="cmd_settings")]
         ]
-        await query.edit_message_text(get_text("select_min_odds", lang), reply_markup=InlineKeyboardMarkup(keyboard))
+        await edit_message_throttled(query, get_text("select_min_odds", lang), reply_markup=InlineKeyboardMarkup(keyboard))
 
     elif data.startswith("min_"):
         value = float(data.replace("min_", ""))
@@ -15539,7 +16567,7 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
              InlineKeyboardButton("10.0", callback_data="max_10.0")],
             [InlineKeyboardButton(get_text("back", lang), callback_data="cmd_settings")]
         ]
-        await query.edit_message_text(get_text("select_max_odds", lang), reply_markup=InlineKeyboardMarkup(keyboard))
+        await edit_message_throttled(query, get_text("select_max_odds", lang), reply_markup=InlineKeyboardMarkup(keyboard))
 
     elif data.startswith("max_"):
         value = float(data.replace("max_", ""))
@@ -15554,7 +16582,7 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
             [InlineKeyboardButton("🔴 High (aggressive)", callback_data="risk_high")],
             [InlineKeyboardButton(get_text("back", lang), callback_data="cmd_settings")]
         ]
-        await query.edit_message_text(get_text("select_risk", lang), reply_markup=InlineKeyboardMarkup(keyboard))
+        await edit_message_throttled(query, get_text("select_risk", lang), reply_markup=InlineKeyboardMarkup(keyboard))
 
     elif data.startswith("risk_"):
         value = data.replace("risk_", "")
@@ -15585,7 +16613,7 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
             [InlineKeyboardButton("🇮🇩 Indonesia", callback_data="lang_id")],
             [InlineKeyboardButton(get_text("back", lang), callback_data="cmd_settings")]
         ]
-        await query.edit_message_text(get_text("select_language", lang), reply_markup=InlineKeyboardMarkup(keyboard))
+        await edit_message_throttled(query, get_text("select_language", lang), reply_markup=InlineKeyboardMarkup(keyboard))
     
     elif data.startswith("lang_"):
         new_lang = data.replace("lang_", "")
@@ -15624,7 +16652,7 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
              InlineKeyboardButton("🇺🇸 New York", callback_data="tz_new_york")],
             [InlineKeyboardButton(get_text("back", lang), callback_data="cmd_settings")]
         ]
-        await query.edit_message_text(get_text("select_timezone", lang), reply_markup=InlineKeyboardMarkup(keyboard))
+        await edit_message_throttled(query, get_text("select_timezone", lang), reply_markup=InlineKeyboardMarkup(keyboard))
 
     elif data.startswith("tz_"):
         tz_key = data.replace("tz_", "")
@@ -15646,7 +16674,7 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
             [InlineKeyboardButton("🇧🇷 BSA", callback_data="fav_league_BSA")],
             [InlineKeyboardButton(get_text("back", lang), callback_data="cmd_favorites")]
         ]
-        await query.edit_message_text(get_text("select_league", lang), reply_markup=InlineKeyboardMarkup(keyboard))
+        await edit_message_throttled(query, get_text("select_league", lang), reply_markup=InlineKeyboardMarkup(keyboard))
 
     elif data.startswith("fav_league_"):
         code = data.replace("fav_league_", "")
@@ -15664,26 +16692,26 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
         match_id = data.replace("analyze_match_", "")
 
         # Check daily limit (counts as analysis)
-        can_use, _, use_bonus = check_daily_limit(user_id)
+        can_use, _, use_bonus = await asyncio.to_thread(check_daily_limit, user_id)
         if not can_use:
             text = get_limit_text(lang)
             keyboard = []
             premium_btns = get_premium_buttons(user_id, lang)
             if premium_btns:
                 keyboard.append(premium_btns)
-            await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None)
+            await edit_message_throttled(query, text, reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None)
             return
 
-        await query.edit_message_text(get_text("analyzing", lang))
+        await edit_message_throttled(query, get_text("analyzing", lang))
 
         # Fetch match by ID
         try:
             session = await get_http_session()
             url = f"{FOOTBALL_API_URL}/matches/{match_id}"
             headers = {"X-Auth-Token": FOOTBALL_API_KEY}
-            async with session.get(url, headers=headers) as resp:
+            async with football_api_get(session, url, headers=headers) as resp:
                 if resp.status == 200:
-                    match_data = await resp.json()
+                    match_data = json.loads(await resp.read())
                     matches = [match_data]  # Wrap in list for get_recommendations_enhanced
                 else:
                     matches = []
@@ -15707,12 +16735,13 @@ _{get_text('change_in_settings', selected_lang)}_{referral_msg}"""
             if bet_btn:
                 keyboard.append(bet_btn)
             keyboard.append([InlineKeyboardButton(get_text("back", lang), callback_data="cmd_start")])
-            increment_daily_usage(user_id)  # Count as usage
-            await query.edit_message_text(recs or get_text("no_matches", lang), reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+            await asyncio.to_thread(increment_daily_usage, user_id)  # Count as usage
+            await edit_message_throttled(query, recs or get_text("no_matches", lang), reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
         else:
-            await query.edit_message_text(get_text("no_matches", lang))
+            await edit_message_throttled(query, get_text("no_matches", lang))
 
 
+@per_user_lock
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Main message handler"""
     user_text = update.message.text.strip()
@@ -15802,7 +16831,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     status = await update.message.reply_text(get_text("analyzing", lang))
     
     # Parse query
-    parsed = parse_user_query(user_text)
+    parsed = await asyncio.to_thread(parse_user_query, user_text)
     intent = parsed.get("intent", "unknown")
     teams = parsed.get("teams", [])
     league = parsed.get("league")
@@ -15851,7 +16880,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if intent == "recommend":
         # Check limit
-        can_use, _, use_bonus = check_daily_limit(user_id)
+        can_use, _, use_bonus = await asyncio.to_thread(check_daily_limit, user_id)
         if not can_use:
             text = get_limit_text(lang)
             keyboard = []
@@ -15862,7 +16891,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         await status.edit_text(get_text("analyzing_bets", lang))
-        matches = await get_matches(days=7)
+        matches = await get_upcoming_matches(7)
         if not matches:
             await status.edit_text(get_text("no_matches", lang))
             return
@@ -15874,7 +16903,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if bet_btn:
                 keyboard.append(bet_btn)
             keyboard.append([InlineKeyboardButton(get_text("today", lang), callback_data="cmd_today")])
-            increment_daily_usage(user_id)
+            await asyncio.to_thread(increment_daily_usage, user_id)
             await status.edit_text(recs, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
         else:
             await status.edit_text(get_text("analysis_error", lang))
@@ -15886,17 +16915,16 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await status.edit_text(get_text("no_matches", lang))
             return
         
-        by_comp = {}
+        by_comp = defaultdict(list)
         for m in matches:
-            comp = m.get("competition", {}).get("name", "Other")
-            if comp not in by_comp:
-                by_comp[comp] = []
-            by_comp[comp].append(m)
+            comp_matches = by_comp[m.get("competition", {}).get("name", "Other")]
+            if len(comp_matches) < 3:
+                comp_matches.append(m)
         
         text = get_text("upcoming_matches", lang) + "\n\n"
         for comp, ms in list(by_comp.items())[:5]:
             text += f"🏆 **{comp}**\n"
-            for m in ms[:3]:
+            for m in ms:
                 home = m.get("homeTeam", {}).get("name", "?")
                 away = m.get("awayTeam", {}).get("name", "?")
                 text += f"  • {home} vs {away}\n"
@@ -15908,7 +16936,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Team search - detailed analysis
     # Check limit first
-    can_use, _, use_bonus = check_daily_limit(user_id)
+    can_use, _, use_bonus = await asyncio.to_thread(check_daily_limit, user_id)
     if not can_use:
         text = get_limit_text(lang)
         keyboard = []
@@ -15967,8 +16995,12 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await status.edit_text(get_text("match_found", lang).format(home=home, away=away, comp=comp))
 
-    # Enhanced analysis - returns (text, ml_features)
-    analysis, ml_features = await analyze_match_enhanced(match, user, lang)
+    async def show_partial(partial: str):
+        # Plain text: partial Markdown may be unbalanced; the final edit below formats it
+        await status.edit_text(partial[-4000:])
+
+    # Enhanced analysis - returns (text, ml_features); the reply is shown as it streams
+    analysis, ml_features = await analyze_match_enhanced(match, user, lang, on_progress=show_partial)
 
     # Extract and save prediction - parse ONLY from MAIN BET section
     try:
@@ -16055,8 +17087,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             home_id = match.get("homeTeam", {}).get("id")
             away_id = match.get("awayTeam", {}).get("id")
             if home_id and away_id:
-                home_form = await get_team_form(home_id)
-                away_form = await get_team_form(away_id)
+                home_form, away_form = await asyncio.gather(get_team_form(home_id), get_team_form(away_id))
                 bet_type, confidence, totals_warning = validate_totals_prediction(
                     bet_type, confidence, home_form, away_form
                 )
@@ -16117,7 +17148,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         match_time = match.get("utcDate") if match else None
         save_prediction(user_id, match_id, home, away, bet_type, confidence, odds_value,
                         ml_features=ml_features, bet_rank=1, league_code=league_code, match_time=match_time)
-        increment_daily_usage(user_id)
+        await asyncio.to_thread(increment_daily_usage, user_id)
         logger.info(f"Saved MAIN: {home} vs {away}, {bet_type}, {confidence}%, odds={odds_value}, league={league_code}")
 
         # Parse and save ALTERNATIVE predictions (bet_rank=2,3,4) with same ML features
@@ -16185,19 +17216,17 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def live_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Toggle live alerts subscription (with DB persistence)"""
     user_id = update.effective_user.id
-    user_data = get_user(user_id)
+    user_data = get_user_cached(user_id)
     lang = user_data.get("language", "ru") if user_data else "ru"
 
     if user_id in live_subscribers:
-        live_subscribers.remove(user_id)
-        remove_live_subscriber(user_id)  # Save to DB
+        remove_live_subscriber(user_id)  # Updates set + DB
         await update.message.reply_text(
             get_text("live_alerts_off", lang),
             parse_mode="Markdown"
         )
     else:
-        live_subscribers.add(user_id)
-        add_live_subscriber(user_id)  # Save to DB
+        add_live_subscriber(user_id)  # Updates set + DB
         await update.message.reply_text(
             get_text("live_alerts_on", lang),
             parse_mode="Markdown"
@@ -16264,8 +17293,7 @@ async def check_results_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text("🔄 Проверяю результаты...")
     
-    pending = get_pending_predictions()
-    user_pending = [p for p in pending if p.get("user_id") == user_id]
+    user_pending = get_pending_predictions(user_id)
     
     if not user_pending:
         await update.message.reply_text("✅ Нет прогнозов, ожидающих результата.")
@@ -16292,12 +17320,12 @@ async def check_results_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             url = f"{FOOTBALL_API_URL}/matches/{match_id}"
             session = await get_http_session()
-            async with session.get(url, headers=headers) as r:
+            async with football_api_get(session, url, headers=headers) as r:
                 if r.status != 200:
                     text += f"   ⚠️ API error\n\n"
                     continue
 
-                match_data = await r.json()
+                match_data = json.loads(await r.read())
             status = match_data.get("status")
             
             if status == "FINISHED":
@@ -16357,7 +17385,6 @@ async def force_check_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Group by match_id to avoid duplicate API calls
-    from collections import defaultdict
     by_match = defaultdict(list)
     without_match_id = 0
     for p in pending:
@@ -16393,7 +17420,7 @@ async def force_check_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
             # Add timeout
             async with asyncio.timeout(10):
-                async with session.get(url, headers=headers) as r:
+                async with football_api_get(session, url, headers=headers) as r:
                     if r.status == 429:
                         # Rate limited - wait and continue
                         logger.warning(f"Rate limited at match {match_id}")
@@ -16405,7 +17432,7 @@ async def force_check_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         logger.warning(f"API error {r.status} for match {match_id}")
                         continue
 
-                    match_data = await r.json()
+                    match_data = json.loads(await r.read())
 
             status = match_data.get("status")
 
@@ -16589,7 +17616,6 @@ async def forceresults_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Group by (user_id, match_id)
-    from collections import defaultdict
     grouped = defaultdict(list)
     no_match_id = 0
 
@@ -16626,16 +17652,15 @@ async def forceresults_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if match_id not in match_results:
                 url = f"{FOOTBALL_API_URL}/matches/{match_id}"
                 session = await get_http_session()
-                async with session.get(url, headers=headers) as r:
+                async with football_api_get(session, url, headers=headers) as r:
                     if r.status == 200:
-                        match_results[match_id] = await r.json()
+                        match_results[match_id] = json.loads(await r.read())
                     elif r.status == 429:
                         await asyncio.sleep(3)
                         continue
                     else:
                         errors += 1
                         continue
-                await asyncio.sleep(0.3)
 
             match = match_results.get(match_id)
             if not match:
@@ -16811,7 +17836,20 @@ async def analyze_all_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     progress_msg = await update.message.reply_text("⏳ Прогресс: 0%")
 
+    # Pipeline (at most two analyses in flight): match i+1 is analyzed while match i is
+    # awaited, parsed and saved, so the Claude round-trips overlap instead of adding up.
+    # Analyses start at least 3 s apart to avoid rate limiting.
+    last_start = time.monotonic()
+    next_task = asyncio.create_task(analyze_match_enhanced(matches[0], None, "ru"))
+
     for i, match in enumerate(matches):
+        analysis_task = next_task
+        next_task = None
+        if i + 1 < total:
+            await asyncio.sleep(max(0.0, 3 - (time.monotonic() - last_start)))
+            last_start = time.monotonic()
+            next_task = asyncio.create_task(analyze_match_enhanced(matches[i + 1], None, "ru"))
+
         home = match.get("homeTeam", {}).get("name", "?")
         away = match.get("awayTeam", {}).get("name", "?")
         match_id = match.get("id")
@@ -16821,8 +17859,8 @@ async def analyze_all_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         match_time = match_utc_date[:16].replace("T", " ") if match_utc_date else ""  # Display format
 
         try:
-            # Run full analysis with ML features
-            analysis, ml_features = await analyze_match_enhanced(match, None, "ru")
+            # Full analysis with ML features (started one iteration ahead)
+            analysis, ml_features = await analysis_task
 
             if analysis and "AI unavailable" not in analysis:
                 results["analyzed"] += 1
@@ -16946,10 +17984,6 @@ async def analyze_all_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             except Exception as e:
                 logger.warning(f"Progress update failed: {e}")
 
-        # Delay between analyses to avoid rate limiting
-        if i < total - 1:
-            await asyncio.sleep(3)
-
     # Build summary
     summary = f"""✅ **Массовый анализ завершён!**
 
@@ -17060,11 +18094,13 @@ async def check_live_matches(context: ContextTypes.DEFAULT_TYPE):
                 pass
 
         # Use enhanced form for ML features with match date for rest days
-        home_form_enhanced = await get_team_form_enhanced(home_id, upcoming_match_date=match_date) if home_id else None
-        away_form_enhanced = await get_team_form_enhanced(away_id, upcoming_match_date=match_date) if away_id else None
-        odds = await get_odds(home, away)
-        h2h = await get_h2h(match_id) if match_id else None
-        standings = await get_standings(comp_code)
+        home_form_enhanced, away_form_enhanced, odds, h2h, standings = await asyncio.gather(
+            get_team_form_enhanced(home_id, upcoming_match_date=match_date) if home_id else _async_none(),
+            get_team_form_enhanced(away_id, upcoming_match_date=match_date) if away_id else _async_none(),
+            get_odds(home, away),
+            get_h2h(match_id) if match_id else _async_none(),
+            get_standings(comp_code),
+        )
 
         # Calculate congestion and motivation for ML features
         congestion = get_congestion_analysis(home_form_enhanced, away_form_enhanced)
@@ -17073,12 +18109,9 @@ async def check_live_matches(context: ContextTypes.DEFAULT_TYPE):
         away_pos = 10
         total_teams = 20
         if standings:
-            for team in standings.get("standings", []):
-                team_name = team.get("team", {}).get("name", "").lower()
-                if home.lower() in team_name or team_name in home.lower():
-                    home_pos = team.get("position", 10)
-                if away.lower() in team_name or team_name in away.lower():
-                    away_pos = team.get("position", 10)
+            standings_index = _index_standings(standings)
+            home_pos = _standings_position(standings_index, home)
+            away_pos = _standings_position(standings_index, away)
             total_teams = len(standings.get("standings", [])) or 20
 
         is_cup = "cup" in comp.lower() or "copa" in comp.lower() or "coupe" in comp.lower()
@@ -17194,7 +18227,8 @@ If you find a VALUE bet (confidence × odds > 1.2 AND odds >= 1.60), respond wit
 If no good bet exists (low confidence OR odds too low), respond: {{"alert": false}}"""
 
         try:
-            message = claude_client.messages.create(
+            message = await asyncio.to_thread(
+                claude_client.messages.create,
                 model="claude-sonnet-4-20250514",
                 max_tokens=400,
                 messages=[{"role": "user", "content": analysis_prompt}]
@@ -18304,7 +19338,8 @@ IMPORTANT:
 - If bet won - what was the decisive factor?
 - Write naturally, not template phrases"""
 
-                message = claude_client.messages.create(
+                message = await asyncio.to_thread(
+                    claude_client.messages.create,
                     model="claude-sonnet-4-20250514",
                     max_tokens=200,
                     messages=[{"role": "user", "content": prompt}]
@@ -18513,7 +19548,8 @@ async def generate_claude_result_explanation(
 Формат ответа - только текст объяснения, без заголовков."""
 
         # === 5. CALL CLAUDE API ===
-        message = claude_client.messages.create(
+        message = await asyncio.to_thread(
+            claude_client.messages.create,
             model="claude-sonnet-4-20250514",
             max_tokens=300,
             messages=[{"role": "user", "content": prompt}]
@@ -18603,6 +19639,11 @@ async def track_upcoming_odds(context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Track odds job error: {e}")
 
 
+async def expire_premium_job(context: ContextTypes.DEFAULT_TYPE):
+    """Background job: expire all outdated premium subscriptions in one UPDATE."""
+    await asyncio.to_thread(expire_premium_subscriptions)
+
+
 async def update_key_players_job(context: ContextTypes.DEFAULT_TYPE):
     """
     Background job to update key players database from API.
@@ -18669,7 +19710,6 @@ async def check_predictions_results(context: ContextTypes.DEFAULT_TYPE):
     headers = {"X-Auth-Token": FOOTBALL_API_KEY}
 
     # Group predictions by (user_id, match_id) for combined notifications
-    from collections import defaultdict
     grouped = defaultdict(list)
     no_match_id = 0
     for pred in pending:
@@ -18699,16 +19739,15 @@ async def check_predictions_results(context: ContextTypes.DEFAULT_TYPE):
             if match_id not in match_results:
                 url = f"{FOOTBALL_API_URL}/matches/{match_id}"
                 session = await get_http_session()
-                async with session.get(url, headers=headers) as r:
+                async with football_api_get(session, url, headers=headers) as r:
                     if r.status == 200:
-                        match_results[match_id] = await r.json()
+                        match_results[match_id] = json.loads(await r.read())
                     elif r.status == 429:
                         logger.warning(f"Rate limited fetching match {match_id}, will retry later")
                         await asyncio.sleep(2)
                         continue
                     else:
                         logger.warning(f"API error {r.status} for match {match_id}")
-                await asyncio.sleep(0.3)
 
             match = match_results.get(match_id)
             if not match:
@@ -18822,12 +19861,11 @@ async def check_predictions_results(context: ContextTypes.DEFAULT_TYPE):
             if match_id not in match_results:
                 url = f"{FOOTBALL_API_URL}/matches/{match_id}"
                 session = await get_http_session()
-                async with session.get(url, headers=headers) as r:
+                async with football_api_get(session, url, headers=headers) as r:
                     if r.status == 200:
-                        match_results[match_id] = await r.json()
+                        match_results[match_id] = json.loads(await r.read())
                     elif r.status != 200:
                         logger.warning(f"API error {r.status} for bot alert match {match_id}")
-                await asyncio.sleep(0.3)
 
             match = match_results.get(match_id)
             if not match or match.get("status") != "FINISHED":
@@ -19408,7 +20446,7 @@ async def send_new_user_onboarding(context: ContextTypes.DEFAULT_TYPE, user_id:
     """Send onboarding sequence for new users - shows ONLY strong stats (>70%) for marketing"""
     try:
         # Get real bot stats
-        bot_stats = get_bot_accuracy_stats()
+        bot_stats = await asyncio.to_thread(get_bot_accuracy_stats)
 
         # Build stats text showing ONLY strong points (>70%)
         strong_points = []
@@ -19599,7 +20637,7 @@ async def send_inactive_user_reminder(context: ContextTypes.DEFAULT_TYPE, user_i
         text = reminder_texts.get(lang, reminder_texts["en"])
 
         # Add stats for credibility - only if >70%
-        bot_stats = get_bot_accuracy_stats()
+        bot_stats = await asyncio.to_thread(get_bot_accuracy_stats)
         accuracy = bot_stats.get("overall_accuracy", 0)
 
         if accuracy >= 70:
@@ -19737,7 +20775,7 @@ async def send_reengagement_alerts(context: ContextTypes.DEFAULT_TYPE):
                 text = messages.get(lang, messages["en"])
 
                 # Add strong stats if available
-                bot_stats = get_bot_accuracy_stats()
+                bot_stats = await asyncio.to_thread(get_bot_accuracy_stats)
                 accuracy = bot_stats.get("overall_accuracy", 0)
                 if accuracy >= 70:
                     stats_line = {
@@ -20283,7 +21321,7 @@ async def handle_postback(request):
 
         logger.info(f"Received postback: {data}")
 
-        result = process_1win_postback(data)
+        result = await asyncio.to_thread(process_1win_postback, data)
 
         return web.json_response(result)
     except Exception as e:
@@ -20315,7 +21353,7 @@ async def handle_crypto_webhook(request):
 
         logger.info(f"Received crypto webhook: {data}")
 
-        result = process_crypto_webhook(data)
+        result = await asyncio.to_thread(process_crypto_webhook, data)
 
         # If payment successful, notify user via bot
         if result.get("status") == "success":
@@ -20362,6 +21400,7 @@ def main():
             print(f"   - {error}")
 
     init_db()
+    expire_premium_subscriptions()
 
     # Load persistent subscribers from DB
     live_subscribers = load_live_subscribers()
@@ -20381,7 +21420,9 @@ def main():
     print(f"   👑 Admins: {len(ADMIN_IDS)}" if ADMIN_IDS else "   ⚠️ No admins configured")
     print(f"   🔗 Affiliate: 1win")
     
-    app = Application.builder().token(TELEGRAM_TOKEN).build()
+    # Updates from different users are handled concurrently; @per_user_lock keeps
+    # each user's own requests in order
+    app = Application.builder().token(TELEGRAM_TOKEN).concurrent_updates(True).build()
     
     # Commands
     app.add_handler(CommandHandler("start", start_cmd))
@@ -20433,6 +21474,7 @@ def main():
     
     # Job Queue
     job_queue = app.job_queue
+    job_queue.run_repeating(expire_premium_job, interval=60, first=60)  # Every minute - batch premium expiry
     job_queue.run_repeating(check_live_matches, interval=600, first=120)
     job_queue.run_repeating(send_daily_digest, interval=7200, first=300)
     job_queue.run_repeating(check_predictions_results, interval=600, first=180)  # Every 10 min (was 20)
@@ -20475,6 +21517,7 @@ def main():
         await app.initialize()
         await app.start()
         await app.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+        await resume_broadcasts(app.bot)
 
         # Keep running until stopped
         try:
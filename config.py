@@ -3,7 +3,7 @@ Configuration module for AI Betting Bot v14
 All environment variables and constants are defined here.
 """
 import os
-from typing import Set
+from typing import FrozenSet
 
 # ===== API KEYS (from environment) =====
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
@@ -62,11 +62,11 @@ WEB_SERVER_PORT = int(os.getenv("PORT", "8080"))
 # ===== ADMIN CONFIGURATION =====
 # Admin user IDs (add your Telegram user ID here)
 # Get your ID by messaging @userinfobot on Telegram
-ADMIN_IDS: Set[int] = {
+ADMIN_IDS: FrozenSet[int] = frozenset(
     int(admin_id.strip())
     for admin_id in os.getenv("ADMIN_IDS", "").split(",")
     if admin_id.strip().isdigit()
-}
+)
 
 # Support username for manual payment/help (without @)
 SUPPORT_USERNAME = os.getenv("SUPPORT_USERNAME", "alex4udak")
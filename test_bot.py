@@ -9,13 +9,39 @@ import pytest
 import hmac
 import hashlib
 import re
+import asyncio
+from functools import wraps
 
 
 # ============= COPY OF FUNCTIONS FOR TESTING =============
 # These are exact copies from bot_secure.py for isolated testing
 
+# Precompiled handicap value parser for check_bet_result
+_HANDICAP_RE = re.compile(r'\(?([-+]?\d+\.?\d*)\)?')
+
+# Exact bet_type -> result check (hot path: canonical bet types saved by the bot).
+# Anything not listed falls through to the keyword scan in check_bet_result.
+_BET_RESULT_EXACT = {
+    "П1": lambda h, a: h > a,
+    "1": lambda h, a: h > a,
+    "П2": lambda h, a: a > h,
+    "2": lambda h, a: a > h,
+    "Х": lambda h, a: h == a,
+    "12": lambda h, a: h != a,
+    "ТБ 2.5": lambda h, a: h + a > 2.5,
+    "ТМ 2.5": lambda h, a: h + a < 2.5,
+    "BTTS": lambda h, a: h > 0 and a > 0,
+    "1X": lambda h, a: h >= a,
+    "X2": lambda h, a: a >= h,
+}
+
+
 def check_bet_result(bet_type, home_score, away_score):
     """Check if bet was correct based on score"""
+    exact_check = _BET_RESULT_EXACT.get(bet_type)
+    if exact_check is not None:
+        return exact_check(home_score, away_score)
+
     total_goals = home_score + away_score
     bet_lower = bet_type.lower() if bet_type else ""
     bet_upper = bet_type.upper() if bet_type else ""
@@ -23,7 +49,7 @@ def check_bet_result(bet_type, home_score, away_score):
     # Handicaps (Фора)
     if "фора" in bet_lower or "handicap" in bet_lower:
         # Parse handicap value
-        handicap_match = re.search(r'\(?([-+]?\d+\.?\d*)\)?', bet_type)
+        handicap_match = _HANDICAP_RE.search(bet_type)
         if handicap_match:
             handicap = float(handicap_match.group(1))
 
@@ -155,6 +181,42 @@ def verify_webhook_signature(payload: str, signature: str, secret: str) -> bool:
     return hmac.compare_digest(expected, signature)
 
 
+# Per-user handler locks: user_id -> [Lock, handlers holding or waiting for it, owner task]
+_user_locks: dict = {}
+
+
+def per_user_lock(func):
+    """Serialize a handler per user: one user's requests run in order,
+    different users run concurrently. Locks are dropped once idle.
+
+    Reentrant per task, so a locked handler may dispatch to another locked
+    handler for the same user (handle_message -> recommend_cmd).
+    """
+    @wraps(func)
+    async def wrapper(update, context, *args, **kwargs):
+        if update.effective_user is None:
+            return await func(update, context, *args, **kwargs)
+        uid = update.effective_user.id
+        entry = _user_locks.get(uid)
+        if entry is not None and entry[2] is asyncio.current_task():
+            return await func(update, context, *args, **kwargs)
+        if entry is None:
+            entry = _user_locks[uid] = [asyncio.Lock(), 0, None]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                entry[2] = asyncio.current_task()
+                try:
+                    return await func(update, context, *args, **kwargs)
+                finally:
+                    entry[2] = None
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                _user_locks.pop(uid, None)
+    return wrapper
+
+
 # ============= TESTS =============
 
 class TestCheckBetResult:
@@ -428,6 +490,57 @@ class TestVerifyWebhookSignature:
         assert verify_webhook_signature(tampered_payload, signature, secret) == False
 
 
+
+class _FakeUpdate:
+    def __init__(self, user_id):
+        self.effective_user = type("User", (), {"id": user_id})()
+
+
+class TestPerUserLock:
+    """Tests for per_user_lock decorator"""
+
+    def test_nested_dispatch_same_user(self):
+        @per_user_lock
+        async def inner(update, context):
+            return "inner"
+
+        @per_user_lock
+        async def outer(update, context):
+            return await inner(update, context)
+
+        result = asyncio.run(asyncio.wait_for(outer(_FakeUpdate(1), None), timeout=1))
+        assert result == "inner"
+        assert _user_locks == {}
+
+    def test_same_user_serialized_other_user_parallel(self):
+        log = []
+
+        @per_user_lock
+        async def handler(update, context, tag):
+            log.append(("start", tag))
+            await asyncio.sleep(0.01)
+            log.append(("end", tag))
+
+        async def run():
+            await asyncio.gather(handler(_FakeUpdate(1), None, "a1"),
+                                 handler(_FakeUpdate(1), None, "a2"),
+                                 handler(_FakeUpdate(2), None, "b1"))
+
+        asyncio.run(run())
+        assert log.index(("end", "a1")) < log.index(("start", "a2"))
+        assert log.index(("start", "b1")) < log.index(("end", "a1"))
+        assert _user_locks == {}
+
+    def test_lock_released_after_exception(self):
+        @per_user_lock
+        async def failing(update, context):
+            raise ValueError("boom")
+
+        with pytest.raises(ValueError):
+            asyncio.run(failing(_FakeUpdate(3), None))
+        assert _user_locks == {}
+
+
 # Run with: pytest test_bot.py -v
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])